@@ -0,0 +1,23 @@
+# Gunicorn configuration of the similarity webservice.
+#
+# By default, every worker loads its own copy of the model in the background
+# and serves the other routes meanwhile. Set SIMILARITY_PRELOAD_MODEL=1 to
+# load the model once in the master process instead, so that the workers
+# share its weights copy-on-write. No requests are served until then.
+
+from similarity_webservice.loading import freeze_heap, preload_model_enabled
+
+
+preload_app = preload_model_enabled()
+
+
+def when_ready(server):
+    if preload_app:
+        freeze_heap()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        from similarity_webservice.app import init_forked_worker
+
+        init_forked_worker(worker.app.wsgi())
@@ -0,0 +1,204 @@
+from typing import Optional
+
+import click
+import math
+import numpy as np
+import os
+import time
+
+
+def ann_min_size() -> int:
+    """The collection size from which on an ANN index is built and used."""
+
+    return int(os.environ.get("SIMILARITY_ANN_MIN_SIZE", 100000))
+
+
+def ann_probes() -> int:
+    """The number of inverted lists that are scanned per query."""
+
+    return int(os.environ.get("SIMILARITY_ANN_PROBES", 16))
+
+
+def _assign(features: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536):
+    """Assign each feature vector to the centroid with the largest inner product."""
+
+    assignment = np.empty(features.shape[0], dtype=np.int64)
+    for start in range(0, features.shape[0], chunk_size):
+        chunk = features[start : start + chunk_size]
+        assignment[start : start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignment
+
+
+class IVFIndex:
+    """An inverted file index for approximate inner product search.
+
+    The feature vectors are partitioned into lists by k-means clustering.
+    A query only scores the vectors in the lists whose centroids are closest
+    to it. The index only stores the partitioning, the feature vectors
+    themselves are passed to :meth:`search`.
+    """
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def build(
+        cls,
+        features: np.ndarray,
+        n_lists: Optional[int] = None,
+        iterations: int = 10,
+        seed: int = 0,
+    ):
+        """Build the index by clustering the given feature vectors."""
+
+        features = np.asarray(features, dtype=np.float32)
+        if n_lists is None:
+            n_lists = max(1, int(math.sqrt(features.shape[0])))
+        n_lists = min(n_lists, features.shape[0])
+
+        # Train the centroids on a sample of the data
+        rng = np.random.default_rng(seed)
+        sample_size = min(features.shape[0], 256 * n_lists)
+        sample = features[rng.choice(features.shape[0], sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignment = _assign(sample, centroids)
+            counts = np.bincount(assignment, minlength=n_lists)
+            starts = np.cumsum(counts) - counts
+            empty = counts == 0
+
+            # Sum up the members of each cluster as contiguous ranges
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(
+                sample[np.argsort(assignment, kind="stable")], starts[~empty], axis=0
+            )
+            centroids = sums / np.maximum(counts, 1)[:, None].astype(np.float32)
+
+            # Restart empty clusters from a random sample
+            centroids[empty] = sample[rng.integers(sample_size, size=empty.sum())]
+
+            # The scores are inner products, so we cluster on the unit sphere
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            centroids /= np.maximum(norms, 1e-12)
+
+        # Sort the vectors by list, so that each list is a contiguous range
+        assignment = _assign(features, centroids)
+        order = np.argsort(assignment, kind="stable").astype(np.int64)
+        offsets = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        return cls(centroids, order, offsets)
+
+    def search(
+        self,
+        features: np.ndarray,
+        queries: np.ndarray,
+        k: int,
+        n_probe: Optional[int] = None,
+    ):
+        """Search the approximate top-k vectors for each query.
+
+        :returns: A tuple of ``(indices, scores)`` lists with one array per
+            query, in descending order of score.
+        """
+
+        if n_probe is None:
+            n_probe = ann_probes()
+        n_probe = min(n_probe, self.centroids.shape[0])
+
+        all_indices, all_scores = [], []
+        lists = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :n_probe]
+        for query, probed in zip(queries, lists):
+            candidates = np.concatenate(
+                [self.order[self.offsets[i] : self.offsets[i + 1]] for i in probed]
+            )
+            scores = features[candidates] @ query
+
+            top = min(k, len(candidates))
+            if top == 0:
+                best = np.empty(0, dtype=np.int64)
+            else:
+                best = np.argpartition(-scores, top - 1)[:top]
+                best = best[np.argsort(-scores[best])]
+            all_indices.append(candidates[best])
+            all_scores.append(scores[best])
+
+        return all_indices, all_scores
+
+    def save(self, filename: str) -> None:
+        """Write the index to a file."""
+
+        with open(filename, "wb") as f:
+            np.savez(
+                f, centroids=self.centroids, order=self.order, offsets=self.offsets
+            )
+
+    @classmethod
+    def load(cls, filename: str):
+        """Read an index that was written with :meth:`save`."""
+
+        with np.load(filename) as arrays:
+            return cls(arrays["centroids"], arrays["order"], arrays["offsets"])
+
+
+def recall_at_k(
+    index: IVFIndex,
+    features: np.ndarray,
+    queries: np.ndarray,
+    k: int,
+    n_probe: Optional[int] = None,
+) -> float:
+    """The fraction of the exact top-k results that the index finds."""
+
+    exact = np.argsort(-(queries @ features.T), axis=1)[:, :k]
+    approximate, _ = index.search(features, queries, k, n_probe=n_probe)
+    found = sum(len(np.intersect1d(e, a)) for e, a in zip(exact, approximate))
+    return found / exact.size
+
+
+def clustered_vectors(size: int, dim: int, clusters: int, seed: int = 0):
+    """Generate unit vectors that are grouped around random centers."""
+
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=size)]
+    vectors += 0.5 * rng.standard_normal((size, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@click.command()
+@click.option("--size", default=100000, help="Number of vectors.", show_default=True)
+@click.option("--dim", default=256, help="Vector dimension.", show_default=True)
+@click.option("--queries", default=100, help="Number of queries.", show_default=True)
+@click.option("--k", default=10, help="Number of results.", show_default=True)
+@click.option("--probes", default=16, help="Lists per query.", show_default=True)
+def benchmark(size, dim, queries, k, probes):
+    """Benchmark recall@k and latency of the IVF index against exact search."""
+
+    data = clustered_vectors(size + queries, dim, clusters=max(1, size // 100))
+    features, query_vectors = data[:size], data[size:]
+
+    start = time.perf_counter()
+    index = IVFIndex.build(features)
+    click.echo(f"Built index with {len(index.centroids)} lists")
+    click.echo(f"Build time: {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    for query in query_vectors:
+        np.argpartition(-(features @ query), k)[:k]
+    exact_time = (time.perf_counter() - start) / queries
+
+    start = time.perf_counter()
+    for query in query_vectors:
+        index.search(features, query[None], k, n_probe=probes)
+    ann_time = (time.perf_counter() - start) / queries
+
+    recall = recall_at_k(index, features, query_vectors, k, n_probe=probes)
+    click.echo(f"Exact search: {1000 * exact_time:.2f}ms per query")
+    click.echo(f"IVF search: {1000 * ann_time:.2f}ms per query")
+    click.echo(f"Recall@{k}: {recall:.3f}")
+
+
+if __name__ == "__main__":
+    benchmark()
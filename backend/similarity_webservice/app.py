@@ -3,18 +3,36 @@ from similarity_webservice.model import (
     require_api_key,
     add_collection,
     collection_info,
+    collection_name,
+    collection_is_heidicon,
     list_collections,
     delete_collection,
     update_collection_content,
+    append_collection_content,
+    remove_collection_content,
+    patch_collection_content,
+    iter_content_batches,
     update_collection_name,
+    update_collection_dtype,
     images_as_csv,
     startup_sanity_check,
-    ensure_collection_id,
+    upgrade_database_schema,
+    migrate_embedding_blobs,
+    migrate_image_entries,
+    enqueue_job,
+    cancel_jobs,
+    get_job,
+    finetuning_status,
 )
-from similarity_webservice.vision import (
-    load_model_and_vis_preprocess,
-    finetune_model,
-    similarity_search,
+from similarity_webservice.cache import feature_cache
+from similarity_webservice.jobs import start_job_workers, wake_job_workers
+from similarity_webservice.loading import (
+    model_load_timeout,
+    model_status,
+    preload_model,
+    preload_model_enabled,
+    start_model_loading,
+    wait_for_model,
 )
 
 import base64
@@ -23,7 +41,45 @@ import flask_cors
 import logging
 import os
 import sqlalchemy
-import threading
+import unicodedata
+import urllib.parse
+
+
+def model_unavailable():
+    """The response to search requests while the model is not available."""
+
+    status = model_status()
+    if status["state"] == "failed":
+        message = f"The model could not be loaded: {status['error']}"
+    else:
+        message = "The model is still loading, please try again later"
+
+    response = flask.jsonify(message=message, message_type="error")
+    response.status_code = 503
+    response.headers["Retry-After"] = "10"
+    return response
+
+
+def decode_image(data):
+    """Decode a base64 encoded image, optionally given as a data URL."""
+
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    if "," in data:
+        data = data.split(",")[1]
+    return base64.b64decode(data)
+
+
+def search_parameters(data) -> tuple:
+    """The number of results and the minimum score of a search request.
+
+    Raises a ValueError if the number of results is negative.
+    """
+
+    num_results = int(data.get("num_results", 5))
+    if num_results < 0:
+        raise ValueError("The number of results must not be negative")
+    return num_results, float(data.get("threshold", 0.0)) / 100
 
 
 def create_app(instantiate_model=True):
@@ -44,9 +100,15 @@ def create_app(instantiate_model=True):
         "SQLALCHEMY_DATABASE_URI", "sqlite:///similarity_webservice.db"
     )
 
-    # Lazily load the model and vis_processors
-    if instantiate_model:
-        load_model_and_vis_preprocess()
+    # Load the model and vis_processors in the background. Routes that do
+    # not need the model are served in the meantime. When preloading for
+    # forked workers, the weights are loaded right away instead and the
+    # workers start the rest in init_forked_worker.
+    preload = instantiate_model and preload_model_enabled()
+    if preload:
+        preload_model()
+    elif instantiate_model:
+        start_model_loading()
 
     # Enable CORS for all routes
     flask_cors.CORS(app)
@@ -54,6 +116,22 @@ def create_app(instantiate_model=True):
     # Initialize the database
     db.init_app(app)
 
+    @app.route("/api/ready", methods=["GET"])
+    def route_ready():
+        """Check whether the webservice is ready to answer search requests.
+
+        All other routes are served while the model is still loading.
+
+        :resjson string state: The state of the model, one of ``not_loaded``,
+            ``loading``, ``ready`` or ``failed``.
+        :resjson string error: The error message if the model could not be loaded.
+        :resjson float load_time: The time it took to load the model in seconds.
+        :status 200: The model is loaded and searches can be performed.
+        :status 503: The model is not loaded (yet).
+        """
+        status = model_status()
+        return flask.jsonify(**status), 200 if status["state"] == "ready" else 503
+
     @app.route("/api/verify", methods=["POST"])
     @require_api_key
     def route_verify():
@@ -73,7 +151,9 @@ def create_app(instantiate_model=True):
         :reqheader API-Key: The API key.
         :reqjson string name: The name of the collection to be created.
         :reqjson string heidicon_tag: The HeidICON tag to be associated with the collection, if this collection is managed through HeidICON.
+        :reqjson string embedding_dtype: The data type to store embeddings in: float32 (default), float16 or int8.
         :status 200: The collection was created successfully.
+        :status 400: The request was malformed.
         """
         data = flask.request.json
 
@@ -85,7 +165,15 @@ def create_app(instantiate_model=True):
         if heidicon_tag == "":
             heidicon_tag = None
 
-        coll = add_collection(data["name"], heidicon_tag=heidicon_tag)
+        try:
+            coll = add_collection(
+                data["name"],
+                heidicon_tag=heidicon_tag,
+                embedding_dtype=data.get("embedding_dtype", "float32"),
+            )
+        except ValueError as e:
+            return flask.jsonify(message=str(e), message_type="error"), 400
+
         return (
             flask.jsonify(
                 message="Collection created", message_type="push", id=coll.id
@@ -106,6 +194,7 @@ def create_app(instantiate_model=True):
         """
         try:
             delete_collection(id)
+            feature_cache.invalidate(str(id))
             return flask.jsonify(message="Collection deleted", message_type="push")
         except sqlalchemy.exc.NoResultFound:
             return (
@@ -138,17 +227,18 @@ def create_app(instantiate_model=True):
         """
         Download the CSV file for a collection.
 
+        The file is streamed to the client row by row, so that large
+        collections do not need to be held in memory as a whole.
+
         :param id: The ID of the collection to download the CSV file for.
 
         :status 200: The CSV file was downloaded successfully.
         :status 400: The collection to download the CSV file for was not found.
         """
         try:
-            return flask.send_file(
-                images_as_csv(id),
-                as_attachment=True,
-                download_name=f"{collection_info(id)['name']}.csv",
-                mimetype="text/csv",
+            filename = f"{collection_name(id)}.csv"
+            response = flask.Response(
+                flask.stream_with_context(images_as_csv(id)), mimetype="text/csv"
             )
         except sqlalchemy.exc.NoResultFound:
             return (
@@ -158,6 +248,20 @@ def create_app(instantiate_model=True):
                 400,
             )
 
+        # Quote the file name in the same way as flask.send_file does
+        try:
+            filename.encode("ascii")
+            names = {"filename": filename}
+        except UnicodeEncodeError:
+            simple = unicodedata.normalize("NFKD", filename)
+            quoted = urllib.parse.quote(filename, safe="!#$&+-.^_`|~")
+            names = {
+                "filename": simple.encode("ascii", "ignore").decode("ascii"),
+                "filename*": f"UTF-8''{quoted}",
+            }
+        response.headers.set("Content-Disposition", "attachment", **names)
+        return response
+
     @app.route("/api/collection/<id>/info", methods=["GET"])
     def route_info_collection(id):
         """
@@ -165,7 +269,9 @@ def create_app(instantiate_model=True):
 
         :param id: The ID of the collection to get information about.
         :resjson bool number_of_images: The number of images in the collection.
-        :resjson bool requires_finetuning: Whether the collection requires finetuning.
+        :resjson bool requires_finetuning: Whether the collection requires finetuning,
+            e.g. because it was modified or finetuned with a different model.
+        :resjson string embedding_model: The model that computed the embeddings.
         :resjson string name: The name of the collection.
         :resjson string last_modified: The date the collection was last modified.
         :resjson string last_finetuned: The date the collection was last finetuned.
@@ -176,7 +282,46 @@ def create_app(instantiate_model=True):
         :status 400: The collection to get information about was not found.
         """
         try:
-            return flask.jsonify(**collection_info(id))
+            info = collection_info(id)
+        except sqlalchemy.exc.NoResultFound:
+            return (
+                flask.jsonify(
+                    message=f"Collection with id={id} not found", message_type="error"
+                ),
+                400,
+            )
+
+        # Embeddings of another model cannot be compared to the queries. The
+        # loaded model is only known once it is ready.
+        if info["last_finetuned"] is not None and model_status()["state"] == "ready":
+            from similarity_webservice.vision import embedding_model_matches
+
+            if not embedding_model_matches(info["embedding_model"]):
+                info["requires_finetuning"] = True
+
+        return flask.jsonify(**info)
+
+    @app.route("/api/collection/<id>/progress", methods=["GET"])
+    def route_progress_collection(id):
+        """
+        Get the progress of the finetuning of a collection.
+
+        This is cheap to poll: If the finetuning runs in the process that serves
+        the request, the progress is taken from memory. Otherwise, it reflects
+        what was last written to the database.
+
+        :param id: The ID of the collection.
+        :resjson bool running: Whether the collection is currently being finetuned.
+        :resjson int progress: The progress of the finetuning in percent.
+        :resjson int processed: The number of images that were processed.
+        :resjson int total: The number of images that need to be processed.
+        :resjson float rate: The throughput in images per second.
+        :resjson float eta: The estimated remaining time in seconds.
+        :status 200: The progress was returned successfully.
+        :status 400: The collection was not found.
+        """
+        try:
+            return flask.jsonify(**finetuning_status(id))
         except sqlalchemy.exc.NoResultFound:
             return (
                 flask.jsonify(
@@ -191,19 +336,37 @@ def create_app(instantiate_model=True):
         """
         Upload new content for a collection.
 
-        Note that this currently does not allow incremental updates, but replaces the
-        content of the collection. If you want to add images, download the CSV file
-        with :http:get:`/api/collection/{id}/csvfile`, add the new images and upload the
-        resulting CSV file.
+        Note that this replaces the content of the collection. To add, remove or
+        change some images, use :http:post:`/api/collection/{id}/content/append`,
+        :http:post:`/api/collection/{id}/content/remove` or
+        :http:post:`/api/collection/{id}/content/patch` instead.
+
+        For collections that are managed through HeidICON, the request body is
+        ignored. Instead, the content is synced from HeidICON in a background
+        job and the collection is finetuned afterwards if its content changed.
+        HeidICON collections are also refreshed regularly without this request.
 
         :reqheader API-Key: The API key.
         :param id: The ID of the collection to update.
-        :reqjson string content: The new content of the collection as a base64 encoded string.
-        :status 200: The collection was updated successfully.
-        :status 400: The collection to update was not found.
+        :reqjson string content: The new content of the collection as a CSV file in the
+            same format as for :http:post:`/api/collection/{id}/content/append`.
+        :resjson int job: The ID of the sync job, for HeidICON collections.
+        :status 200: The collection was updated or the sync job was queued successfully.
+        :status 400: The collection to update was not found or the content is invalid.
         """
         try:
+            if collection_is_heidicon(id):
+                job = enqueue_job(id, "sync")
+                wake_job_workers(app)
+                return flask.jsonify(
+                    message="Collection update from HeidICON queued",
+                    message_type="push",
+                    job=job.id,
+                )
+
             update_collection_content(id, flask.request.data.decode("utf-8"))
+        except ValueError as e:
+            return flask.jsonify(message=str(e), message_type="error"), 400
         except sqlalchemy.exc.NoResultFound:
             return (
                 flask.jsonify(
@@ -214,6 +377,59 @@ def create_app(instantiate_model=True):
 
         return flask.jsonify(message="Collection updated", message_type="push")
 
+    @app.route("/api/collection/<id>/content/<operation>", methods=["POST"])
+    @require_api_key
+    def route_edit_collection_content(id, operation):
+        """
+        Incrementally edit the content of a collection.
+
+        The request body is a CSV file in the same format as for
+        :http:post:`/api/collection/{id}/updatecontent`. It is parsed while it
+        is received, so large uploads are not held in memory. The operation is
+        one of:
+
+        * ``append``: Add the rows to the collection.
+        * ``remove``: Remove all rows with the image URLs in the first column.
+        * ``patch``: Replace the rows with the same image URL, add all others.
+
+        :reqheader API-Key: The API key.
+        :param id: The ID of the collection to update.
+        :param operation: One of ``append``, ``remove`` or ``patch``.
+        :resjson int added: The number of added rows.
+        :resjson int removed: The number of removed rows.
+        :resjson int updated: The number of changed rows.
+        :status 200: The collection was updated successfully.
+        :status 400: The collection was not found or is managed by HeidICON.
+        :status 404: The operation is unknown.
+        """
+        if operation not in ("append", "remove", "patch"):
+            flask.abort(404)
+
+        batches = iter_content_batches(flask.request.stream)
+        counts = {"added": 0, "removed": 0, "updated": 0}
+        try:
+            if operation == "append":
+                counts["added"] = append_collection_content(id, batches)
+            elif operation == "remove":
+                counts["removed"] = remove_collection_content(id, batches)
+            else:
+                counts["updated"], counts["added"] = patch_collection_content(
+                    id, batches
+                )
+        except ValueError as e:
+            return flask.jsonify(message=str(e), message_type="error"), 400
+        except sqlalchemy.exc.NoResultFound:
+            return (
+                flask.jsonify(
+                    message=f"Collection with id={id} not found", message_type="error"
+                ),
+                400,
+            )
+
+        return flask.jsonify(
+            message="Collection updated", message_type="push", **counts
+        )
+
     @app.route("/api/collection/<id>/updatename", methods=["POST"])
     @require_api_key
     def route_update_collection_name(id):
@@ -241,6 +457,37 @@ def create_app(instantiate_model=True):
 
         return flask.jsonify(message="Collection updated", message_type="push")
 
+    @app.route("/api/collection/<id>/updatedtype", methods=["POST"])
+    @require_api_key
+    def route_update_collection_dtype(id):
+        """
+        Change the data type that the embeddings of a collection are stored in.
+
+        Quantized embeddings (float16 or int8) need 2-4x less memory. The
+        change takes effect with the next finetuning of the collection.
+
+        :reqheader API-Key: The API key.
+        :param id: The ID of the collection to update.
+        :reqjson string embedding_dtype: The data type: float32, float16 or int8.
+        :status 200: The collection was updated successfully.
+        :status 400: The collection was not found or the data type is invalid.
+        """
+        data = flask.request.json
+
+        try:
+            update_collection_dtype(id, data.get("embedding_dtype", "float32"))
+        except ValueError as e:
+            return flask.jsonify(message=str(e), message_type="error"), 400
+        except sqlalchemy.exc.NoResultFound:
+            return (
+                flask.jsonify(
+                    message=f"Collection with id={id} not found", message_type="error"
+                ),
+                400,
+            )
+
+        return flask.jsonify(message="Collection updated", message_type="push")
+
     @app.route("/api/collection/<id>/finetune", methods=["POST"])
     @require_api_key
     def route_finetune_collection(id):
@@ -249,29 +496,52 @@ def create_app(instantiate_model=True):
 
         This is a required process for the model to be usable in similarity search.
         Note, that the finetuning process takes a while to complete. Therefore,
-        this route will return immediately after starting the finetuning process.
+        this route queues a finetuning job and returns immediately. If a job for
+        the collection is already queued or running, that job is returned instead.
         You can then query the progress of the finetuning process with
-        :http:get:`/api/collection/{id}/info`.
+        :http:get:`/api/collection/{id}/info` or :http:get:`/api/job/{job_id}`.
 
         :reqheader API-Key: The API key.
         :param id: The ID of the collection to finetune the model for.
+        :resjson int job: The ID of the finetuning job.
         :status 200: The model finetuning was started successfully.
+        :status 400: The collection was not found.
         """
         try:
-            ensure_collection_id(id)
+            job = enqueue_job(id)
+            wake_job_workers(app)
+            return flask.jsonify(
+                message="Model finetuning started", message_type="push", job=job.id
+            )
+        except sqlalchemy.exc.NoResultFound:
+            return (
+                flask.jsonify(
+                    message=f"Collection with id={id} not found", message_type="error"
+                ),
+                400,
+            )
 
-            def _threaded_finetune_model(ctx, id):
-                ctx.push()
-                finetune_model(id)
+    @app.route("/api/collection/<id>/finetune/cancel", methods=["POST"])
+    @require_api_key
+    def route_cancel_finetune_collection(id):
+        """
+        Cancel the finetuning of a collection.
 
-            thread = threading.Thread(
-                target=_threaded_finetune_model,
-                args=(app.app_context(), id),
-            )
-            thread.daemon = True
-            thread.start()
+        Queued jobs are cancelled immediately, running jobs stop after the
+        batch of images they are currently working on.
+
+        :reqheader API-Key: The API key.
+        :param id: The ID of the collection to cancel finetuning for.
+        :resjson list jobs: The IDs of the cancelled jobs.
+        :status 200: The cancellation was requested successfully.
+        :status 400: The collection was not found.
+        """
+        try:
+            jobs = cancel_jobs(id)
             return flask.jsonify(
-                message="Model finetuning started", message_type="push"
+                message="Model finetuning cancelled",
+                message_type="push",
+                jobs=[job.id for job in jobs],
             )
         except sqlalchemy.exc.NoResultFound:
             return (
@@ -281,6 +551,30 @@ def create_app(instantiate_model=True):
                 400,
             )
 
+    @app.route("/api/job/<job_id>", methods=["GET"])
+    def route_job_info(job_id):
+        """
+        Get information about a background job.
+
+        :param job_id: The ID of the job.
+        :resjson int id: The ID of the job.
+        :resjson int collection: The ID of the collection the job works on.
+        :resjson string kind: The kind of job, e.g. finetune.
+        :resjson string status: One of queued, running, done, failed and cancelled.
+        :resjson string error: The error message of a failed job.
+        :status 200: The information about the job was returned successfully.
+        :status 400: The job was not found.
+        """
+        try:
+            return flask.jsonify(get_job(job_id))
+        except sqlalchemy.exc.NoResultFound:
+            return (
+                flask.jsonify(
+                    message=f"Job with id={job_id} not found", message_type="error"
+                ),
+                400,
+            )
+
     @app.route("/api/collection/<id>/search", methods=["POST"])
     def route_search(id):
         """
@@ -290,27 +584,23 @@ def create_app(instantiate_model=True):
         :reqjson string image: The image to search for as a base64 encoded string.
         :resjson list results: The list of results of the similarity search.
         :status 200: The similarity search was successful.
-        :status 400: The collection to search in was not found.
+        :status 400: The collection to search in was not found or needs to be finetuned again, or the parameters are invalid.
+        :status 503: The model is not loaded yet.
         """
+        if not wait_for_model(model_load_timeout()):
+            return model_unavailable()
+
+        from similarity_webservice.vision import similarity_search
+
         # Extract the image from the request
         try:
-            if b"," in flask.request.data:
-                image = base64.b64decode(
-                    flask.request.data.decode("utf-8").split(",")[1]
-                )
-            else:
-                image = base64.b64decode(flask.request.data)
+            image = decode_image(flask.request.data)
 
-            data = flask.request.args
-            return flask.jsonify(
-                similarity_search(
-                    id,
-                    [image],
-                    int(data.get("num_results", 5)),
-                    float(data.get("threshold", 0.0)) / 100,
-                )
-            )
+            num_results, threshold = search_parameters(flask.request.args)
+            return flask.jsonify(similarity_search(id, [image], num_results, threshold))
 
+        except ValueError as e:
+            return flask.jsonify(message=str(e), message_type="error"), 400
         except sqlalchemy.exc.NoResultFound:
             return (
                 flask.jsonify(
@@ -319,8 +609,98 @@ def create_app(instantiate_model=True):
                 400,
             )
 
+    @app.route("/api/search", methods=["POST"])
+    def route_batch_search():
+        """
+        Perform a similarity search for several images in several collections.
+
+        All query images are embedded together, which is much faster than
+        searching for them one by one with :http:post:`/api/collection/{id}/search`.
+
+        :reqjson list images: The images to search for as base64 encoded strings.
+        :reqjson list collections: The IDs of the collections to search in.
+        :reqjson int num_results: The number of results per image (default 5).
+        :reqjson float threshold: The minimum score of results in percent (default 0).
+        :resjson list results: One list of results per image, each result contains the collection ID.
+        :resjson list skipped: The collections that were not searched, e.g. because
+            they were not finetuned yet, each with a message.
+        :status 200: The similarity search was successful.
+        :status 400: The request was malformed or a collection was not found.
+        :status 503: The model is not loaded yet.
+        """
+        data = flask.request.get_json(silent=True)
+
+        if (
+            not isinstance(data, dict)
+            or not data.get("images")
+            or not data.get("collections")
+        ):
+            return (
+                flask.jsonify(
+                    message="Images or collections are missing", message_type="error"
+                ),
+                400,
+            )
+
+        if (
+            not isinstance(data["images"], list)
+            or not isinstance(data["collections"], list)
+            or not all(isinstance(image, str) for image in data["images"])
+            or not all(isinstance(id, (int, str)) for id in data["collections"])
+        ):
+            return (
+                flask.jsonify(
+                    message="Images and collections must be lists of strings and IDs",
+                    message_type="error",
+                ),
+                400,
+            )
+
+        if not wait_for_model(model_load_timeout()):
+            return model_unavailable()
+
+        from similarity_webservice.vision import batch_similarity_search
+
+        try:
+            num_results, threshold = search_parameters(data)
+            results, skipped = batch_similarity_search(
+                data["collections"],
+                [decode_image(image) for image in data["images"]],
+                num_results,
+                threshold,
+            )
+            return flask.jsonify(results=results, skipped=skipped)
+        except ValueError as e:
+            return flask.jsonify(message=str(e), message_type="error"), 400
+        except sqlalchemy.exc.NoResultFound:
+            return (
+                flask.jsonify(message="Collection not found", message_type="error"),
+                400,
+            )
+
     with app.app_context():
         db.create_all()
+        upgrade_database_schema()
+        migrate_embedding_blobs()
+        migrate_image_entries()
         startup_sanity_check()
 
+    # Process the finetuning jobs in background threads
+    if instantiate_model and not preload:
+        start_job_workers(app)
+
     return app
+
+
+def init_forked_worker(app) -> None:
+    """Prepare a worker process that was forked from a preloaded app.
+
+    This is called from the post_fork hook of gunicorn. Threads and database
+    connections of the parent process cannot be used after the fork.
+    """
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    start_model_loading()
+    start_job_workers(app)
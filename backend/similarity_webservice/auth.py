@@ -5,7 +5,13 @@ import os
 import secrets
 import sqlalchemy
 
-from similarity_webservice.model import db, add_new_apikey, list_apikeys, delete_apikey
+from similarity_webservice.model import (
+    db,
+    add_new_apikey,
+    list_apikeys,
+    delete_apikey,
+    upgrade_database_schema,
+)
 
 
 @contextlib.contextmanager
@@ -18,6 +24,7 @@ def faked_app():
 
     with app.app_context():
         db.create_all()
+        upgrade_database_schema()
         yield
 
 
@@ -0,0 +1,141 @@
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger("similarity_webservice")
+
+
+def search_batch_size() -> int:
+    """The maximum number of query images that are embedded together."""
+
+    return int(os.environ.get("SIMILARITY_SEARCH_BATCH_SIZE", 32))
+
+
+def search_batch_wait() -> float:
+    """The time in seconds that query images are gathered before embedding."""
+
+    return float(os.environ.get("SIMILARITY_SEARCH_BATCH_WAIT_MS", 5)) / 1000
+
+
+class MicroBatcher:
+    """Gather the inputs of concurrent requests into batches.
+
+    Requests submit lists of inputs and wait for their results. A background
+    thread takes the first waiting request and gathers further requests for
+    up to ``max_wait`` seconds or until ``max_batch_size`` inputs are
+    collected. It then calls ``function`` once with all inputs and passes
+    the rows of the result back to the requests.
+
+    Requests with more than ``max_batch_size`` inputs are split into chunks,
+    whose results are joined with ``concatenate``. The next chunk is only
+    queued when the previous one is done, so that other requests are not
+    blocked until the whole request is processed.
+    """
+
+    def __init__(
+        self, function, max_batch_size: int, max_wait: float, concatenate=None
+    ):
+        self.function = function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.concatenate = concatenate or (lambda parts: sum(parts, []))
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def submit(self, inputs: list) -> concurrent.futures.Future:
+        """Submit a list of inputs, the future's result has one row per input."""
+
+        future = concurrent.futures.Future()
+        self._ensure_thread()
+        if len(inputs) <= self.max_batch_size:
+            self.requests.put((inputs, future))
+        else:
+            self._submit_chunk(inputs, 0, [], future)
+        return future
+
+    def _submit_chunk(self, inputs: list, start: int, results: list, future):
+        # Stop if the caller is no longer waiting
+        if future.cancelled():
+            return
+
+        def _done(chunk):
+            error = chunk.exception()
+            if error is None:
+                results.append(chunk.result())
+                if start + self.max_batch_size < len(inputs):
+                    self._submit_chunk(
+                        inputs, start + self.max_batch_size, results, future
+                    )
+                    return
+
+            if future.set_running_or_notify_cancel():
+                if error is None:
+                    future.set_result(self.concatenate(results))
+                else:
+                    future.set_exception(error)
+
+        chunk = concurrent.futures.Future()
+        chunk.add_done_callback(_done)
+        self.requests.put((inputs[start : start + self.max_batch_size], chunk))
+
+    def __call__(self, inputs: list):
+        return self.submit(inputs).result()
+
+    def _ensure_thread(self):
+        # Threads do not survive a fork, so forked workers start their own
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.requests = queue.Queue()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+
+    def _gather(self, first):
+        batch = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            if size + len(request[0]) > self.max_batch_size:
+                return batch, request
+            batch.append(request)
+            size += len(request[0])
+
+        return batch, None
+
+    def _loop(self):
+        pending = None
+        while True:
+            first = pending if pending is not None else self.requests.get()
+            batch, pending = self._gather(first)
+
+            # Skip requests whose callers are no longer waiting
+            batch = [r for r in batch if r[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                results = self.function([x for inputs, _ in batch for x in inputs])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            logger.debug(f"Embedded {len(results)} inputs of {len(batch)} requests")
+            start = 0
+            for inputs, future in batch:
+                future.set_result(results[start : start + len(inputs)])
+                start += len(inputs)
@@ -0,0 +1,75 @@
+import collections
+import os
+import threading
+
+
+def feature_cache_budget() -> int:
+    """The memory budget of the feature cache in bytes."""
+
+    return int(float(os.environ.get("SIMILARITY_FEATURE_CACHE_MB", 1024)) * 2**20)
+
+
+class FeatureCache:
+    """A process-level LRU cache for the decoded features of collections.
+
+    Each entry is stored together with a version (the time the collection
+    was last finetuned). A lookup with a different version invalidates the
+    entry. Entries are evicted in least recently used order once the total
+    size of the cached values exceeds the memory budget.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key, version, loader, sizeof):
+        """Get the cached value for a key, calling loader() on a miss.
+
+        :param key: The key of the entry, e.g. the collection ID.
+        :param version: The version that the entry needs to match.
+        :param loader: A function that loads the value if it is not cached.
+        :param sizeof: A function that returns the size of a value in bytes.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        # Load outside of the lock to not block other collections
+        value = loader()
+        if value is None:
+            return None
+
+        size = sizeof(value)
+        with self.lock:
+            self._remove(key)
+            if size <= self.budget:
+                self.entries[key] = (version, value, size)
+                self.size += size
+                while self.size > self.budget:
+                    self._remove(next(iter(self.entries)))
+
+        return value
+
+    def invalidate(self, key=None):
+        """Remove an entry from the cache or clear the entire cache."""
+
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.size = 0
+            else:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+# Process-level cache of the decoded features of collections
+feature_cache = FeatureCache(feature_cache_budget())
@@ -0,0 +1,198 @@
+from PIL import Image
+from similarity_webservice.imagecache import ImageCache
+from typing import Optional
+
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import queue
+import threading
+import urllib.parse
+
+import requests
+
+
+logger = logging.getLogger("similarity_webservice")
+
+
+def download_workers() -> int:
+    """The number of threads that download images concurrently."""
+
+    return int(os.environ.get("SIMILARITY_DOWNLOAD_WORKERS", 16))
+
+
+def download_per_host() -> int:
+    """The maximum number of concurrent downloads from a single host."""
+
+    return int(os.environ.get("SIMILARITY_DOWNLOAD_PER_HOST", 4))
+
+
+def download_timeout() -> float:
+    """The timeout in seconds for connecting to and reading from a host."""
+
+    return float(os.environ.get("SIMILARITY_DOWNLOAD_TIMEOUT", 30))
+
+
+def create_session(pool_size: int) -> requests.Session:
+    """Create a HTTP session with a connection pool of the given size."""
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HostLimiter:
+    """Limit the number of concurrent requests per host."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    @contextlib.contextmanager
+    def __call__(self, url: str):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.setdefault(
+                host, threading.BoundedSemaphore(self.limit)
+            )
+
+        with semaphore:
+            yield
+
+
+def fetch_image(
+    session: requests.Session,
+    url: str,
+    limiter: HostLimiter,
+    timeout: float,
+    cache: Optional[ImageCache] = None,
+):
+    """Download the data of an image, using the image cache if given.
+
+    Images that were cached recently are used without a request. Older
+    cached images are revalidated with a conditional request.
+
+    :returns: A tuple of the data and its SHA-256.
+    """
+
+    entry = None if cache is None else cache.lookup(url)
+    headers = {}
+    if entry is not None:
+        if cache.is_fresh(entry):
+            data = cache.read(entry["sha256"])
+            if data is not None:
+                return data, entry["sha256"]
+
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    with limiter(url):
+        response = session.get(url, timeout=timeout, headers=headers)
+
+    if response.status_code == 304 and entry is not None:
+        data = cache.read(entry["sha256"])
+        if data is not None:
+            cache.revalidated(url, entry)
+            return data, entry["sha256"]
+
+        # The data was evicted in the meantime
+        with limiter(url):
+            response = session.get(url, timeout=timeout)
+
+    response.raise_for_status()
+    if cache is None:
+        return response.content, hashlib.sha256(response.content).hexdigest()
+
+    content_hash = cache.store(
+        url,
+        response.content,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+    return response.content, content_hash
+
+
+def iter_preprocessed_images(
+    urls: list,
+    preprocess,
+    prefetch: Optional[int] = None,
+    cache: Optional[ImageCache] = None,
+    lookup=None,
+):
+    """Download and preprocess images concurrently.
+
+    This is the producer side of the indexing pipeline: A bounded pool
+    of download workers fetches the images through a shared connection pool,
+    decodes them and applies the given preprocessing function. The results
+    are passed through a bounded queue, so that downloads never run further
+    than ``prefetch`` images ahead of the consumer.
+
+    Yields ``(index, image, content_hash, value)`` tuples in the order the
+    downloads complete, where ``index`` refers to the position in ``urls``
+    and ``content_hash`` is the SHA-256 of the downloaded data. If a
+    ``lookup`` function is given, it is called with the content hash first.
+    If it returns a value, e.g. a cached embedding, that value is passed on
+    instead of decoding and preprocessing the image. If an image could not be
+    downloaded or decoded, ``image``, ``content_hash`` and ``value`` are
+    ``None``.
+    """
+
+    workers = download_workers()
+    if prefetch is None:
+        prefetch = 4 * workers
+
+    session = create_session(workers)
+    limiter = HostLimiter(download_per_host())
+    timeout = download_timeout()
+    results = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def _put(item):
+        # Block while the consumer is busy, but give up if it went away
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _work(index, url):
+        if stop.is_set():
+            return
+
+        image = content_hash = value = None
+        try:
+            data, content_hash = fetch_image(session, url, limiter, timeout, cache)
+            if lookup is not None:
+                value = lookup(content_hash)
+            if value is None:
+                raw_image = Image.open(io.BytesIO(data)).convert("RGB")
+                image = preprocess(raw_image)
+        except Exception as e:
+            # Every index must be reported, otherwise the consumer waits forever
+            logger.warning(f"Could not download image {url}: {e}")
+            image = content_hash = value = None
+
+        _put((index, image, content_hash, value))
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        for index, url in enumerate(urls):
+            executor.submit(_work, index, url)
+
+        for _ in range(len(urls)):
+            yield results.get()
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        session.close()
@@ -0,0 +1,182 @@
+from functools import partial
+from lavis.common.dist_utils import download_cached_file
+from lavis.models.blip2_models.blip2 import LayerNorm
+from lavis.models.blip2_models.Qformer import BertConfig, BertModel
+from lavis.models.blip_models.blip_outputs import BlipOutputFeatures
+from lavis.models.eva_vit import VisionTransformer
+from typing import Optional
+
+import contextlib
+import os
+import torch
+
+
+def model_dtype() -> Optional[torch.dtype]:
+    """The data type of the vision encoder weights, e.g. ``float16``.
+
+    By default, this is float16 on GPUs and float32 on CPUs, where float16
+    is slow. The Q-Former always runs in float32.
+    """
+
+    name = os.environ.get("SIMILARITY_MODEL_DTYPE")
+    if name:
+        return getattr(torch, name)
+    return torch.float16 if torch.cuda.is_available() else torch.float32
+
+
+@contextlib.contextmanager
+def _meta_parameters():
+    """Create the parameters of new modules without allocating their memory."""
+
+    def _hook(module, name, param):
+        if param is not None:
+            return torch.nn.Parameter(param.to("meta"), param.requires_grad)
+
+    handle = torch.nn.modules.module.register_module_parameter_registration_hook(_hook)
+    try:
+        yield
+    finally:
+        handle.remove()
+
+
+class ImageOnlyBlip2(torch.nn.Module):
+    """The parts of the BLIP-2 feature extractor that embed images.
+
+    This contains the vision encoder, the Q-Former with its query tokens and
+    the image projection. The tokenizer, the text projection and the ITM
+    head are not built, and the word embeddings and text feed-forward layers
+    of the Q-Former are removed, as the queries never use them. The names of
+    the parameters match the LAVIS checkpoints.
+    """
+
+    def __init__(
+        self,
+        img_size: int = 364,
+        vision_width: int = 1408,
+        vision_depth: int = 39,
+        vision_heads: int = 16,
+        mlp_ratio: float = 4.3637,
+        num_query_token: int = 32,
+        cross_attention_freq: int = 2,
+        embed_dim: int = 256,
+        bert_config: Optional[BertConfig] = None,
+    ):
+        super().__init__()
+
+        # The EVA ViT-g of LAVIS, see lavis.models.eva_vit.create_eva_vit_g
+        self.visual_encoder = VisionTransformer(
+            img_size=img_size,
+            patch_size=14,
+            use_mean_pooling=False,
+            embed_dim=vision_width,
+            depth=vision_depth,
+            num_heads=vision_heads,
+            mlp_ratio=mlp_ratio,
+            qkv_bias=True,
+            drop_path_rate=0,
+            norm_layer=partial(torch.nn.LayerNorm, eps=1e-6),
+            use_checkpoint=False,
+        )
+        self.ln_vision = LayerNorm(vision_width)
+
+        # The defaults of BertConfig are those of bert-base-uncased
+        config = bert_config or BertConfig()
+        config.encoder_width = vision_width
+        config.add_cross_attention = True
+        config.cross_attention_freq = cross_attention_freq
+        config.query_length = num_query_token
+
+        self.Qformer = torch.nn.Module()
+        self.Qformer.bert = BertModel(config, add_pooling_layer=False)
+        self.Qformer.bert.embeddings.word_embeddings = None
+        self.Qformer.bert.embeddings.position_embeddings = None
+        for layer in self.Qformer.bert.encoder.layer:
+            layer.intermediate = None
+            layer.output = None
+
+        self.query_tokens = torch.nn.Parameter(
+            torch.zeros(1, num_query_token, config.hidden_size)
+        )
+        self.vision_proj = torch.nn.Linear(config.hidden_size, embed_dim)
+
+    @classmethod
+    def from_state_dict(cls, state_dict: dict, dtype=None, **kwargs):
+        """Build the model from the state dict of a full BLIP-2 model.
+
+        The model is built without allocating memory for or initializing its
+        weights, which are then taken from the state dict directly. The
+        weights of the vision encoder are converted to ``dtype``.
+        """
+
+        with _meta_parameters():
+            model = cls(**kwargs)
+
+        own = model.state_dict()
+        state_dict = {key: value for key, value in state_dict.items() if key in own}
+        for key, value in state_dict.items():
+            if dtype is not None and key.startswith("visual_encoder."):
+                if value.is_floating_point():
+                    state_dict[key] = value.to(dtype)
+
+        missing = [
+            name for name, _ in model.named_parameters() if name not in state_dict
+        ]
+        if missing:
+            raise RuntimeError(f"Weights missing from the checkpoint: {missing}")
+
+        model.load_state_dict(state_dict, strict=False, assign=True)
+        model.eval()
+        return model
+
+    @property
+    def device(self):
+        return self.query_tokens.device
+
+    def extract_features(self, samples: dict, mode: str = "image"):
+        """Embed images like the ``image`` mode of the LAVIS feature extractor."""
+
+        if mode != "image":
+            raise ValueError("The image-only model only supports mode 'image'")
+
+        image = samples["image"].to(self.visual_encoder.cls_token.dtype)
+        image_embeds = self.ln_vision(self.visual_encoder(image)).float()
+        image_atts = torch.ones(
+            image_embeds.size()[:-1], dtype=torch.long, device=image_embeds.device
+        )
+        query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
+
+        query_output = self.Qformer.bert(
+            query_embeds=query_tokens,
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=image_atts,
+            return_dict=True,
+        )
+        image_embeds = query_output.last_hidden_state
+        image_features = torch.nn.functional.normalize(
+            self.vision_proj(image_embeds), dim=-1
+        )
+        return BlipOutputFeatures(
+            image_embeds=image_embeds, image_embeds_proj=image_features
+        )
+
+
+def load_image_only_model(config) -> ImageOnlyBlip2:
+    """Load the image-only model for a LAVIS model config.
+
+    Only the finetuned checkpoint is loaded. The weights of the initial
+    vision encoder and of bert-base-uncased are not needed. The checkpoint
+    is memory-mapped, so that the weights of the text side are never read.
+    """
+
+    if config.get("vit_model", "eva_clip_g") != "eva_clip_g":
+        raise ValueError("The image-only model only supports the EVA ViT-g")
+
+    filename = download_cached_file(config.finetuned, check_hash=False, progress=False)
+    checkpoint = torch.load(filename, map_location="cpu", mmap=True, weights_only=True)
+    return ImageOnlyBlip2.from_state_dict(
+        checkpoint.get("model", checkpoint),
+        dtype=model_dtype(),
+        img_size=config.image_size,
+        num_query_token=config.num_query_token,
+        cross_attention_freq=config.get("cross_attention_freq", 2),
+    )
@@ -0,0 +1,184 @@
+from similarity_webservice.storage import data_directory
+from typing import Optional
+
+import click
+import hashlib
+import os
+import torch
+
+
+# The formats that the image encoder can be exported to
+EXPORT_FORMATS = {"onnx": ".onnx", "torchscript": ".pt"}
+
+
+def image_encoder_path() -> Optional[str]:
+    """The exported image encoder that is used for inference, if any.
+
+    This is either configured explicitly or an encoder that was exported to
+    the data directory with the default file name.
+    """
+
+    configured = os.environ.get("SIMILARITY_IMAGE_ENCODER")
+    if configured:
+        return configured
+
+    for suffix in EXPORT_FORMATS.values():
+        filename = os.path.join(data_directory(), f"image_encoder{suffix}")
+        if os.path.exists(filename):
+            return filename
+
+
+class ImageEncoder(torch.nn.Module):
+    """The image embedding path of the model as a standalone module.
+
+    It maps a batch of preprocessed images to one embedding per image,
+    exactly like :func:`similarity_webservice.vision.extract_features`.
+    Tracing it only records the operations of the image path, so the text
+    tower is not part of the exported graph.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image: torch.Tensor) -> torch.Tensor:
+        features = self.model.extract_features(
+            {"image": image, "text_input": ""}, mode="image"
+        )
+        return features.image_embeds_proj[:, 0, :]
+
+
+def export_torchscript(model, example: torch.Tensor, filename: str) -> None:
+    """Trace the image encoder of a model and save it as TorchScript."""
+
+    with torch.no_grad():
+        traced = torch.jit.trace(ImageEncoder(model).eval(), example, check_trace=False)
+    traced.save(filename)
+
+
+def export_onnx(
+    model, example: torch.Tensor, filename: str, quantize: bool = False
+) -> None:
+    """Export the image encoder of a model to ONNX.
+
+    :param quantize: Whether to quantize the weights to int8 dynamically.
+        This requires ``onnxruntime``.
+    """
+
+    with torch.no_grad():
+        torch.onnx.export(
+            ImageEncoder(model).eval(),
+            (example,),
+            filename,
+            input_names=["image"],
+            output_names=["embedding"],
+            dynamic_axes={"image": {0: "batch"}, "embedding": {0: "batch"}},
+            opset_version=17,
+            dynamo=False,
+        )
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized = f"{filename}.int8"
+        quantize_dynamic(filename, quantized, weight_type=QuantType.QInt8)
+        os.replace(quantized, filename)
+
+
+def _file_digest(filename: str) -> str:
+    """The SHA-256 of a file, read in chunks."""
+
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ExportedEncoder:
+    """An exported image encoder that is used instead of the eager model.
+
+    ONNX files are run with ONNX Runtime, other files are loaded as
+    TorchScript. Both run on the CPU. The name of the encoder is derived
+    from the content of the file, so that re-exporting to the same file,
+    e.g. with quantization, is recognized as a different model.
+    """
+
+    def __init__(self, filename: str):
+        kind = "onnx" if filename.endswith(".onnx") else "torchscript"
+        self.name = f"{kind}-{_file_digest(filename)[:16]}"
+        self.session = None
+        self.module = None
+        if filename.endswith(".onnx"):
+            import onnxruntime
+
+            self.session = onnxruntime.InferenceSession(
+                filename, providers=["CPUExecutionProvider"]
+            )
+        else:
+            self.module = torch.jit.load(filename, map_location="cpu").eval()
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        """Embed a batch of preprocessed images."""
+
+        images = images.cpu().float()
+        if self.session is not None:
+            (embeddings,) = self.session.run(None, {"image": images.numpy()})
+            return torch.from_numpy(embeddings)
+
+        with torch.no_grad():
+            return self.module(images)
+
+
+@click.command()
+@click.option(
+    "--format",
+    "export_format",
+    type=click.Choice(list(EXPORT_FORMATS)),
+    default="onnx",
+    help="The format to export to.",
+    show_default=True,
+)
+@click.option(
+    "--output",
+    default=None,
+    help="The file to write, defaults to image_encoder.<ext> in the data directory.",
+)
+@click.option(
+    "--quantize",
+    is_flag=True,
+    help="Quantize the weights to int8 (ONNX only).",
+)
+def export(export_format, output, quantize):
+    """Export the image encoder of the model for CPU inference.
+
+    The webservice uses an encoder in the data directory automatically.
+    """
+
+    # Importing the vision module pulls in lavis
+    from PIL import Image
+    from similarity_webservice.vision import load_eager_model
+
+    if quantize and export_format != "onnx":
+        raise click.UsageError("Only ONNX exports can be quantized")
+
+    if output is None:
+        os.makedirs(data_directory(), exist_ok=True)
+        output = os.path.join(
+            data_directory(), f"image_encoder{EXPORT_FORMATS[export_format]}"
+        )
+
+    model, vis_processors = load_eager_model()
+    model.to("cpu")
+    image = vis_processors["eval"](Image.new("RGB", (256, 256))).unsqueeze(0)
+    example = torch.cat([image, image])
+
+    if export_format == "onnx":
+        export_onnx(model, example, output, quantize=quantize)
+    else:
+        export_torchscript(model, example, output)
+    click.echo(f"Exported the image encoder to {output}")
+
+
+if __name__ == "__main__":
+    export()
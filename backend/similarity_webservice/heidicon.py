@@ -1,6 +1,71 @@
+from typing import Optional
+from urllib3.util.retry import Retry
+
+import concurrent.futures
+import os
+import threading
+import time
+
 import requests
 
 
+# The number of objects requested from EasyDB at once
+PAGE_SIZE = 1000
+
+# Cache of the tag trees of EasyDB instances, see heidicon_tags
+_tag_cache = {}
+_tag_cache_lock = threading.Lock()
+
+
+def heidicon_url() -> str:
+    """The URL of the EasyDB instance that HeidICON collections are read from."""
+
+    return os.environ.get(
+        "SIMILARITY_HEIDICON_URL", "https://heidicon.ub.uni-heidelberg.de"
+    )
+
+
+def heidicon_workers() -> int:
+    """The number of result pages that are requested from EasyDB concurrently."""
+
+    return int(os.environ.get("SIMILARITY_HEIDICON_WORKERS", 8))
+
+
+def heidicon_timeout() -> float:
+    """The timeout in seconds for requests to EasyDB."""
+
+    return float(os.environ.get("SIMILARITY_HEIDICON_TIMEOUT", 60))
+
+
+def tag_cache_ttl() -> float:
+    """The time in seconds that the tag tree of EasyDB is cached."""
+
+    return float(os.environ.get("SIMILARITY_HEIDICON_TAG_TTL", 3600))
+
+
+def create_heidicon_session(pool_size: int) -> requests.Session:
+    """Create a HTTP session for EasyDB that retries failed requests.
+
+    Connection errors and responses that indicate an overloaded server are
+    retried with exponential backoff. This includes the POST requests of the
+    EasyDB API, which do not modify any data.
+    """
+
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,
+    )
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def _identify_tag_id(tag_info: list, target_tag: str):
     """Identify the ID of a tag from a list of tags."""
 
@@ -23,80 +88,224 @@ def _identify_tag_id(tag_info: list, target_tag: str):
             return tag["tag"]["_id"]
 
 
-def extract_heidicon_content(heidicon_tag: str):
-    """Extract content from EasyDB."""
+def heidicon_tags(
+    session: requests.Session, easydb_url: str, token: str, refresh: bool = False
+) -> list:
+    """Get the tag tree of an EasyDB instance.
+
+    The tag tree rarely changes, so it is cached for tag_cache_ttl() seconds.
 
-    # Set the EasyDB instance URL
-    easydb_url = "https://heidicon.ub.uni-heidelberg.de"
+    :param refresh: Whether to request the tag tree even if it is cached.
+    """
 
-    # Get a session token
-    token = requests.get(f"{easydb_url}/api/session").json()["token"]
+    with _tag_cache_lock:
+        cached = _tag_cache.get(easydb_url)
+        if (
+            not refresh
+            and cached is not None
+            and time.monotonic() - cached[0] < tag_cache_ttl()
+        ):
+            return cached[1]
 
-    # Authenticate the session token (as an anonymous user)
-    requests.post(
-        f"{easydb_url}/api/session/authenticate",
-        params={"method": "anonymous", "token": token},
+    response = session.get(
+        f"{easydb_url}/api/tags", params={"token": token}, timeout=heidicon_timeout()
     )
+    response.raise_for_status()
+    tags = response.json()
 
-    # Receive the tags that exist on the instance
-    tags = requests.get(f"{easydb_url}/api/tags", params={"token": token}).json()
+    with _tag_cache_lock:
+        _tag_cache[easydb_url] = (time.monotonic(), tags)
+    return tags
 
-    # Identify the ID of the tag we want to extract
-    tag_id = _identify_tag_id(tags, heidicon_tag)
 
-    # The results data structure
+def _resource_content(resource: dict, easydb_url: str) -> list:
+    """Extract the downloadable images of an EasyDB object."""
+
     content = []
+    for asset in resource["ressourcen"]["asset"]:
+        for version in ["full", "huge", "small"]:
+            if version not in asset["versions"]:
+                continue
+
+            version_info = asset["versions"][version]
+            if version_info.get("_not_allowed", False) or not version_info.get(
+                "_download_allowed", True
+            ):
+                continue
 
-    # We access the EasyDB API in batches of 1000 objects
-    offset = 0
-    while offset % 1000 == 0:
-        # Search for objects with the given tag
-        objects = requests.get(
-            f"{easydb_url}/api/search",
-            params={"token": token},
-            json={
-                "search": [
-                    {
-                        "type": "in",
-                        "bool": "must",
-                        "fields": ["_tags._id"],
-                        "in": [
-                            tag_id,
-                        ],
-                    }
-                ],
-                "offset": offset,
-                "limit": 1000,
-            },
-        ).json()
-
-        # Iterate through the objects that we found
-        for resource in objects["objects"]:
-            for asset in resource["ressourcen"]["asset"]:
-                for version in ["full", "huge", "small"]:
-                    if version not in asset["versions"]:
-                        continue
-
-                    version_info = asset["versions"][version]
-                    if version_info.get("_not_allowed", False) or not version_info.get(
-                        "_download_allowed", True
-                    ):
-                        continue
-
-                    # Some assets are "failed" or "pending". We cannot use them.
-                    if version_info["status"] != "done":
-                        continue
-
-                    content.append(
-                        (
-                            version_info["download_url"],
-                            f"{easydb_url}/#/detail/{resource['_system_object_id']}",
-                        )
-                    )
-                    break
-
-        # Set up the next batch. If the current batch was smaller than 1000,
-        # we are done and can break out of the loop
-        offset += len(objects["objects"])
+            # Some assets are "failed" or "pending". We cannot use them.
+            if version_info["status"] != "done":
+                continue
+
+            content.append(
+                (
+                    version_info["download_url"],
+                    f"{easydb_url}/#/detail/{resource['_system_object_id']}",
+                )
+            )
+            break
 
     return content
+
+
+def _object_version(resource: dict) -> int:
+    """The version of an EasyDB object, which is part of its objecttype record."""
+
+    version = resource.get(resource.get("_objecttype"), {}).get("_version")
+    if version is None:
+        raise ValueError(
+            f"EasyDB object {resource.get('_system_object_id')} has no version"
+        )
+    return version
+
+
+class EasyDBClient:
+    """A client for the search API of an EasyDB instance.
+
+    All requests go through one pooled session. Use this as a context
+    manager to close the session.
+    """
+
+    def __init__(self, easydb_url: Optional[str] = None):
+        self.easydb_url = easydb_url or heidicon_url()
+        self.workers = heidicon_workers()
+        self.session = create_heidicon_session(self.workers)
+        self.token = None
+
+        # Get a session token
+        self.token = self._request("GET", "/api/session")["token"]
+
+        # Authenticate the session token (as an anonymous user)
+        self._request(
+            "POST", "/api/session/authenticate", params={"method": "anonymous"}
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.session.close()
+
+    def _request(self, method: str, path: str, params=None, json=None):
+        params = dict(params or {})
+        if self.token is not None:
+            params["token"] = self.token
+
+        response = self.session.request(
+            method,
+            f"{self.easydb_url}{path}",
+            params=params,
+            json=json,
+            timeout=heidicon_timeout(),
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def tag_id(self, heidicon_tag: str):
+        """Identify the ID of a tag by its name or ID.
+
+        If the tag is not in the cached tag tree, e.g. because it was created
+        recently, the tag tree is requested once more before giving up.
+        """
+
+        tag_id = _identify_tag_id(
+            heidicon_tags(self.session, self.easydb_url, self.token), heidicon_tag
+        )
+        if tag_id is None:
+            tag_id = _identify_tag_id(
+                heidicon_tags(self.session, self.easydb_url, self.token, refresh=True),
+                heidicon_tag,
+            )
+        return tag_id
+
+    def search(
+        self, search: list, offset: int, limit: int, format: Optional[str] = None
+    ):
+        """Request one page of the objects that match a search.
+
+        :param format: The EasyDB output format, e.g. ``"short"`` to only get
+            the IDs and versions of the objects.
+        """
+
+        query = {"search": search, "offset": offset, "limit": limit}
+        if format is not None:
+            query["format"] = format
+        return self._request("POST", "/api/search", json=query)
+
+    def search_all(self, search: list, format: Optional[str] = None) -> list:
+        """Request all objects that match a search.
+
+        The number of objects is requested first, then all pages of results
+        are requested concurrently. The objects are returned in page order.
+        """
+
+        count = self.search(search, 0, 0, format=format)["count"]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pages = pool.map(
+                lambda offset: self.search(search, offset, PAGE_SIZE, format=format),
+                range(0, count, PAGE_SIZE),
+            )
+            return [resource for page in pages for resource in page["objects"]]
+
+    def objects_by_id(self, ids: list) -> list:
+        """Request the objects with the given system object IDs."""
+
+        chunks = [ids[i : i + PAGE_SIZE] for i in range(0, len(ids), PAGE_SIZE)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pages = pool.map(
+                lambda chunk: self.search(
+                    [_in_search("_system_object_id", chunk)], 0, len(chunk)
+                ),
+                chunks,
+            )
+            return [resource for page in pages for resource in page["objects"]]
+
+
+def _in_search(field: str, values: list) -> dict:
+    """An EasyDB search clause for objects whose field has one of the values."""
+
+    return {"type": "in", "bool": "must", "fields": [field], "in": values}
+
+
+def sync_heidicon_objects(heidicon_tag: str, known: dict):
+    """Find the objects with a tag that changed compared to a known state.
+
+    Only the IDs and versions of all objects with the tag are listed. The
+    full data is only requested for objects that are new or whose version
+    changed.
+
+    :param known: A mapping from system object IDs to versions, as seen
+        during the last sync.
+    :returns: A tuple of a mapping from the IDs of new or changed objects to
+        a tuple of their version and their list of ``(image_url, repo_url)``,
+        and the set of IDs of objects that no longer have the tag.
+    :raises ValueError: If the tag does not exist. Otherwise, all known
+        objects would be considered removed.
+    """
+
+    with EasyDBClient() as client:
+        tag_id = client.tag_id(heidicon_tag)
+        if tag_id is None:
+            raise ValueError(f"Unknown HeidICON tag '{heidicon_tag}'")
+
+        search = [_in_search("_tags._id", [tag_id])]
+        current = {
+            resource["_system_object_id"]: _object_version(resource)
+            for resource in client.search_all(search, format="short")
+        }
+
+        changed_ids = [
+            id
+            for id, version in current.items()
+            if id not in known or known[id] != version
+        ]
+        changed = {
+            resource["_system_object_id"]: (
+                _object_version(resource),
+                _resource_content(resource, client.easydb_url),
+            )
+            for resource in client.objects_by_id(changed_ids)
+        }
+
+    removed = set(known) - set(current)
+    return changed, removed
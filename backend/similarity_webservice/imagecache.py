@@ -0,0 +1,218 @@
+from typing import Optional
+
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger("similarity_webservice")
+
+
+def cache_directory() -> str:
+    """The directory of the on-disk cache, following the XDG specification."""
+
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "similarity_webservice")
+
+
+def image_cache_budget() -> int:
+    """The disk space budget of the image cache in bytes, 0 disables it."""
+
+    return int(float(os.environ.get("SIMILARITY_IMAGE_CACHE_MB", 10240)) * 2**20)
+
+
+def image_cache_max_age() -> float:
+    """The time in seconds that cached images are used without revalidation."""
+
+    return float(os.environ.get("SIMILARITY_IMAGE_CACHE_MAX_AGE", 7 * 86400))
+
+
+def _sharded(directory: str, key: str, suffix: str = "") -> str:
+    return os.path.join(directory, key[:2], f"{key}{suffix}")
+
+
+def _write_atomic(filename: str, write) -> None:
+    """Write a file through a temporary file, so that readers never see partial files."""
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = f"{filename}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class ImageCache:
+    """An on-disk cache of downloaded images and their embeddings.
+
+    Image data is stored content-addressed by its SHA-256, so that an image
+    that is referenced under several URLs or in several collections is only
+    stored once. For each URL, the hash of its data and the ETag and
+    Last-Modified headers of the response are recorded, so that the image
+    can be revalidated with a conditional request. Embeddings are stored
+    by the hash of the image data and the name of the model.
+
+    Files are evicted in least recently used order, as given by their
+    modification time, once the total size exceeds the budget.
+    """
+
+    def __init__(self, directory: str, budget: int):
+        self.directory = directory
+        self.budget = budget
+        self.lock = threading.Lock()
+
+    def _url_file(self, url: str) -> str:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return _sharded(os.path.join(self.directory, "urls"), key, ".json")
+
+    def _blob_file(self, content_hash: str) -> str:
+        return _sharded(os.path.join(self.directory, "blobs"), content_hash)
+
+    def _embedding_file(self, model: str, content_hash: str) -> str:
+        directory = os.path.join(self.directory, "embeddings", model)
+        return _sharded(directory, content_hash, ".npy")
+
+    def lookup(self, url: str) -> Optional[dict]:
+        """Get the cached response metadata of a URL, if its data is cached.
+
+        :returns: A dictionary with the keys ``sha256``, ``etag``,
+            ``last_modified`` and ``fetched`` or None.
+        """
+
+        try:
+            with open(self._url_file(url), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not os.path.exists(self._blob_file(entry["sha256"])):
+            return None
+        return entry
+
+    def is_fresh(self, entry: dict) -> bool:
+        """Whether a cached URL can be used without revalidating it."""
+
+        return time.time() - entry["fetched"] < image_cache_max_age()
+
+    def read(self, content_hash: str) -> Optional[bytes]:
+        """Read cached image data by its hash."""
+
+        filename = self._blob_file(content_hash)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        os.utime(filename)
+        return data
+
+    def store(
+        self,
+        url: str,
+        data: bytes,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> str:
+        """Store the data that was downloaded from a URL.
+
+        :returns: The SHA-256 of the data.
+        """
+
+        content_hash = hashlib.sha256(data).hexdigest()
+        blob = self._blob_file(content_hash)
+        if os.path.exists(blob):
+            os.utime(blob)
+        else:
+            _write_atomic(blob, lambda f: f.write(data))
+
+        self._write_url(url, content_hash, etag, last_modified)
+        return content_hash
+
+    def revalidated(self, url: str, entry: dict) -> None:
+        """Record that the cached data of a URL is still up to date."""
+
+        self._write_url(url, entry["sha256"], entry["etag"], entry["last_modified"])
+
+    def _write_url(self, url, content_hash, etag, last_modified) -> None:
+        entry = {
+            "url": url,
+            "sha256": content_hash,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched": time.time(),
+        }
+        data = json.dumps(entry).encode("utf-8")
+        _write_atomic(self._url_file(url), lambda f: f.write(data))
+
+    def get_embedding(self, model: str, content_hash: str) -> Optional[np.ndarray]:
+        """Get the cached embedding of image data by its hash."""
+
+        filename = self._embedding_file(model, content_hash)
+        try:
+            embedding = np.load(filename)
+        except (OSError, ValueError):
+            return None
+
+        os.utime(filename)
+        return embedding
+
+    def put_embedding(self, model: str, content_hash: str, embedding) -> None:
+        """Store the embedding of image data by its hash."""
+
+        embedding = np.asarray(embedding, dtype=np.float32)
+        _write_atomic(
+            self._embedding_file(model, content_hash), lambda f: np.save(f, embedding)
+        )
+
+    def evict(self) -> int:
+        """Remove the least recently used files until the cache fits the budget.
+
+        :returns: The number of removed files.
+        """
+
+        with self.lock:
+            files = []
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    filename = os.path.join(root, name)
+                    try:
+                        stat = os.stat(filename)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, filename))
+
+            total = sum(size for _, size, _ in files)
+            removed = 0
+            for _, size, filename in sorted(files):
+                if total <= self.budget:
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+
+        if removed:
+            logger.info(f"Evicted {removed} files from the image cache")
+        return removed
+
+
+def image_cache() -> Optional[ImageCache]:
+    """The image cache as configured by the environment, or None if disabled."""
+
+    budget = image_cache_budget()
+    if budget <= 0:
+        return None
+    return ImageCache(cache_directory(), budget)
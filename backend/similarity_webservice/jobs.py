@@ -0,0 +1,145 @@
+from similarity_webservice.model import (
+    db,
+    Collection,
+    Job,
+    JobCancelled,
+    claim_job,
+    finish_job,
+    enqueue_job,
+    heartbeat_interval,
+    job_timeout,
+    record_heartbeat,
+    refresh_heidicon_collection,
+    requeue_stale_jobs,
+    schedule_heidicon_refreshes,
+)
+from typing import Optional
+
+import flask
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger("similarity_webservice")
+
+
+def job_workers() -> int:
+    """The number of worker threads that process jobs in each process."""
+
+    return int(os.environ.get("SIMILARITY_JOB_WORKERS", 1))
+
+
+def job_poll_interval() -> float:
+    """The time in seconds between two looks into the job queue."""
+
+    return float(os.environ.get("SIMILARITY_JOB_POLL_INTERVAL", 5))
+
+
+def _heartbeat_loop(app, job_id: int, stop: threading.Event):
+    while not stop.wait(heartbeat_interval()):
+        try:
+            with app.app_context():
+                record_heartbeat(job_id)
+        except Exception:
+            logger.exception(f"Could not record the heartbeat of job {job_id}")
+
+
+def run_job(job: Job) -> None:
+    """Run a job that was claimed by the current process.
+
+    While the job runs, a thread regularly records its heartbeat, so that
+    phases without progress updates, e.g. loading the model or building the
+    index, do not get the job requeued.
+    """
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(
+        target=_heartbeat_loop,
+        args=(flask.current_app._get_current_object(), job.id, stop),
+        daemon=True,
+    )
+    heartbeat.start()
+
+    try:
+        if job.kind == "finetune":
+            # Importing the vision module pulls in torch and lavis
+            from similarity_webservice.vision import finetune_model
+
+            finetune_model(job.collection, job=job)
+        elif job.kind == "sync":
+            # Re-index the collection only if its content changed
+            if refresh_heidicon_collection(job.collection):
+                enqueue_job(job.collection)
+        else:
+            raise ValueError(f"Unknown job kind '{job.kind}'")
+        finish_job(job, "done")
+    except JobCancelled:
+        db.session.rollback()
+        finish_job(job, "cancelled")
+    except Exception as e:
+        logger.exception(f"Job {job.id} for collection {job.collection} failed")
+        db.session.rollback()
+        finish_job(job, "failed", error=str(e))
+    finally:
+        stop.set()
+        heartbeat.join()
+
+        # The collection might have been deleted in the meantime
+        Collection.query.where(Collection.id == job.collection).update(
+            {"finetuning_progess": None}
+        )
+        db.session.commit()
+
+
+def _worker_loop(app, stop: threading.Event, wakeup: threading.Event):
+    while not stop.is_set():
+        try:
+            with app.app_context():
+                requeue_stale_jobs(job_timeout())
+                schedule_heidicon_refreshes()
+                job = claim_job()
+                if job is not None:
+                    run_job(job)
+                    continue
+        except Exception:
+            logger.exception("Error while processing the job queue")
+
+        wakeup.wait(job_poll_interval())
+        wakeup.clear()
+
+
+def start_job_workers(app) -> None:
+    """Start the worker threads that process the job queue of the app."""
+
+    if "similarity_jobs" in app.extensions:
+        return
+
+    stop = threading.Event()
+    wakeup = threading.Event()
+    threads = [
+        threading.Thread(target=_worker_loop, args=(app, stop, wakeup), daemon=True)
+        for _ in range(job_workers())
+    ]
+    for thread in threads:
+        thread.start()
+
+    app.extensions["similarity_jobs"] = (stop, wakeup, threads)
+
+
+def wake_job_workers(app) -> None:
+    """Notify the worker threads of this process about a new job."""
+
+    if "similarity_jobs" in app.extensions:
+        app.extensions["similarity_jobs"][1].set()
+
+
+def stop_job_workers(app, timeout: Optional[float] = None) -> None:
+    """Stop the worker threads after they finished their current job."""
+
+    stop, wakeup, threads = app.extensions.pop("similarity_jobs", (None, None, []))
+    if stop is not None:
+        stop.set()
+        wakeup.set()
+    for thread in threads:
+        thread.join(timeout)
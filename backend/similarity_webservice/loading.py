@@ -0,0 +1,120 @@
+from typing import Optional
+
+import gc
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger("similarity_webservice")
+
+# The state of the model in this process, see model_status
+_status = {"state": "not_loaded", "error": None, "load_time": None}
+_done = threading.Event()
+_lock = threading.Lock()
+_thread = None
+_pid = None
+
+
+def model_load_timeout() -> float:
+    """The time in seconds that search requests wait for the model to load."""
+
+    return float(os.environ.get("SIMILARITY_MODEL_LOAD_TIMEOUT", 60))
+
+
+def preload_model_enabled() -> bool:
+    """Whether the model is loaded before the worker processes are forked."""
+
+    return os.environ.get("SIMILARITY_PRELOAD_MODEL", "0").lower() in ("1", "true")
+
+
+def preload_model() -> None:
+    """Load the model weights in this process to share them with forked workers.
+
+    The forked workers share the pages of the weights copy-on-write, as
+    inference never writes to them. No warmup pass is run, because the
+    thread pools of torch do not survive a fork. Each worker runs its own
+    warmup in :func:`start_model_loading`.
+
+    Errors are logged and not raised, so that the service still starts. The
+    workers then load the model themselves.
+    """
+
+    try:
+        from similarity_webservice import vision
+
+        vision.load_model_and_vis_preprocess()
+    except Exception:
+        logger.exception("Could not preload the model, the workers load it instead")
+
+
+def freeze_heap() -> None:
+    """Move all objects to the permanent generation of the garbage collector.
+
+    Call this right before forking workers. The garbage collector of the
+    workers then does not touch the objects, so that their pages stay shared.
+    """
+
+    gc.collect()
+    gc.freeze()
+
+
+def _load_model():
+    # The vision module imports torch and lavis, which takes a while
+    start = time.monotonic()
+    try:
+        from similarity_webservice import vision
+
+        vision.load_model_and_vis_preprocess()
+        vision.warmup_model()
+        _status.update(state="ready", load_time=time.monotonic() - start)
+        logger.info(f"Loaded the model in {_status['load_time']:.1f}s")
+    except Exception as e:
+        logger.exception("Could not load the model")
+        _status.update(state="failed", error=str(e))
+    finally:
+        _done.set()
+
+
+def start_model_loading() -> None:
+    """Load the model and run a warmup pass in a background thread.
+
+    This returns immediately. Calling it again does nothing, unless the
+    process was forked. A forked child reuses a model that was loaded
+    before the fork and runs its own warmup pass.
+    """
+
+    global _thread, _pid
+
+    with _lock:
+        if _thread is not None and _pid == os.getpid():
+            return
+
+        _pid = os.getpid()
+        _done.clear()
+        _status.update(state="loading", error=None, load_time=None)
+        _thread = threading.Thread(target=_load_model, daemon=True)
+        _thread.start()
+
+
+def model_status() -> dict:
+    """The state of the model in this process.
+
+    :returns: A dictionary with the ``state`` (one of ``"not_loaded"``,
+        ``"loading"``, ``"ready"`` or ``"failed"``), the ``error`` of a
+        failed load and the ``load_time`` in seconds.
+    """
+
+    return dict(_status)
+
+
+def wait_for_model(timeout: Optional[float] = None) -> bool:
+    """Wait until the model is loaded, starting the load if necessary.
+
+    :returns: Whether the model is ready to use.
+    """
+
+    start_model_loading()
+    _done.wait(timeout)
+    return _status["state"] == "ready"
@@ -0,0 +1,64 @@
+import click
+import os
+
+
+def memory_usage(pid: int) -> dict:
+    """The memory usage of a process in bytes, as reported by Linux.
+
+    :returns: A dictionary with the resident set size ``rss``, the
+        proportional set size ``pss`` (shared pages are divided between the
+        processes that share them) and the unique set size ``uss`` (pages
+        that only this process uses).
+    """
+
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1]) * 1024
+
+    return {
+        "rss": values["Rss"],
+        "pss": values["Pss"],
+        "uss": values["Private_Clean"] + values["Private_Dirty"],
+    }
+
+
+def child_pids(pid: int) -> list:
+    """The IDs of the child processes of a process, e.g. the gunicorn workers."""
+
+    children = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            children.extend(int(child) for child in f.read().split())
+    return sorted(children)
+
+
+@click.command()
+@click.argument("pid", type=int)
+def measure(pid):
+    """Measure the memory usage of a gunicorn master and its workers.
+
+    The sum of the PSS values is the memory that the deployment needs.
+    The USS of a worker is the memory that each additional worker adds.
+    """
+
+    def _mb(value):
+        return f"{value / 2**20:10.1f}"
+
+    total = 0
+    click.echo(f"{'process':>16} {'RSS (MB)':>10} {'PSS (MB)':>10} {'USS (MB)':>10}")
+    for name, process in [("master", pid)] + [
+        (f"worker {child}", child) for child in child_pids(pid)
+    ]:
+        usage = memory_usage(process)
+        total += usage["pss"]
+        click.echo(
+            f"{name:>16} {_mb(usage['rss'])} {_mb(usage['pss'])} {_mb(usage['uss'])}"
+        )
+    click.echo(f"{'total':>16} {'':>10} {_mb(total)}")
+
+
+if __name__ == "__main__":
+    measure()
@@ -1,6 +1,12 @@
-from similarity_webservice.heidicon import extract_heidicon_content
-
-from datetime import datetime, timezone
+from similarity_webservice.heidicon import sync_heidicon_objects
+from similarity_webservice.quantization import EMBEDDING_DTYPES
+from similarity_webservice.storage import (
+    auxiliary_file,
+    remove_collection_files,
+    write_embeddings,
+)
+
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 import argon2
@@ -9,7 +15,15 @@ import dataclasses
 import flask
 import flask_sqlalchemy
 import functools
+import hashlib
+import hmac
 import io
+import os
+import random
+import socket
+import sqlalchemy
+import threading
+import time
 
 
 ph = argon2.PasswordHasher()
@@ -22,26 +36,182 @@ class Images(db.Model):
 
     id: int = db.Column(db.Integer, primary_key=True)
     collection: int = db.Column(db.Integer)
-    content: list = db.Column(db.JSON, nullable=False)
+
+    # The content of collections is stored in the ImageEntry table. Older
+    # versions stored it here, it is moved by migrate_image_entries on startup.
+    content: list = db.Column(db.JSON, nullable=False, default=lambda: [])
+
+    # The embeddings are stored in files in the data directory, see storage.py
+    embedding_path: str = db.Column(db.Text, nullable=True)
+    embedding_count: int = db.Column(db.Integer, nullable=True)
+
+    # Whether the stored embeddings are L2-normalized, so that their inner
+    # products are cosine similarities. Migrated data might not be.
+    normalized: bool = db.Column(db.Boolean, nullable=True)
+
+    # The model that computed the stored embeddings, see embedding_model_name.
+    # Embeddings of older versions were computed by the eager BLIP-2 model.
+    embedding_model: str = db.Column(db.Text, nullable=True)
+
+    # Embeddings of older versions were stored in the database. They are
+    # moved to files by migrate_embedding_blobs on startup.
     parquet_data: bytes = db.Column(db.LargeBinary, nullable=True)
+    ann_index: bytes = db.Column(db.LargeBinary, nullable=True)
 
 
-def images_as_csv(id: int):
-    """Return the content of a collection as a CSV file."""
+@dataclasses.dataclass
+class ImageEntry(db.Model):
+    """An image of a collection, i.e. one row of its CSV content."""
 
-    images = Images.query.where(Images.collection == id).one()
+    __table_args__ = (
+        db.Index("ix_image_entry_collection_position", "collection", "position"),
+        db.Index("ix_image_entry_collection_url", "collection", "image_url"),
+    )
 
-    # Write the content into a string buffer
-    with io.StringIO() as output:
-        writer = csv.writer(output)
-        writer.writerows(images.content)
+    id: int = db.Column(db.Integer, primary_key=True)
+    collection: int = db.Column(db.Integer, nullable=False)
+    position: int = db.Column(db.Integer, nullable=False)
+    image_url: str = db.Column(db.Text, nullable=False)
+    repo_url: str = db.Column(db.Text, nullable=True)
 
-        # Make this a binary buffer for flask
-        mem = io.BytesIO()
-        mem.write(output.getvalue().encode("utf-8"))
-        mem.seek(0)
+    # The SHA-256 of the image data and whether the image is part of the
+    # stored embeddings. Both are set when the collection is finetuned.
+    content_hash: str = db.Column(db.Text, nullable=True)
+    embedded: bool = db.Column(db.Boolean, nullable=False, default=False)
 
-        return mem
+    # The system object ID and version of the EasyDB object that the image
+    # belongs to, for collections that are managed through HeidICON
+    source_id: int = db.Column(db.Integer, nullable=True)
+    source_version: int = db.Column(db.Integer, nullable=True)
+
+
+@dataclasses.dataclass
+class HeidiconObject(db.Model):
+    """An EasyDB object of a HeidICON collection, as seen during the last sync.
+
+    Objects are recorded even if they have no usable images, e.g. because
+    their assets are still pending or could not be downloaded. They are then
+    only requested again when their version changes.
+    """
+
+    __table_args__ = (
+        db.Index("ix_heidicon_object_collection_source", "collection", "source_id"),
+    )
+
+    id: int = db.Column(db.Integer, primary_key=True)
+    collection: int = db.Column(db.Integer, nullable=False)
+    source_id: int = db.Column(db.Integer, nullable=False)
+    version: int = db.Column(db.Integer, nullable=True)
+
+
+def _chunks(items: list, size: int = 500):
+    """Split a list into chunks, e.g. to stay below SQL parameter limits."""
+
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def _entry_values(id: str, position: int, row) -> dict:
+    """The column values of an ImageEntry for a row of CSV content."""
+
+    return {
+        "collection": int(id),
+        "position": position,
+        "image_url": row[0],
+        "repo_url": row[1] if len(row) > 1 else None,
+    }
+
+
+def _insert_entries(id: str, rows, start: int = 0) -> int:
+    """Insert rows of content into a collection, starting at a given position.
+
+    :returns: The number of inserted rows.
+    """
+
+    values = [_entry_values(id, start + i, row) for i, row in enumerate(rows)]
+    if values:
+        db.session.execute(sqlalchemy.insert(ImageEntry), values)
+    return len(values)
+
+
+def _next_position(id: str) -> int:
+    """The position after the last image of a collection."""
+
+    (position,) = (
+        db.session.query(sqlalchemy.func.max(ImageEntry.position))
+        .where(ImageEntry.collection == id)
+        .one()
+    )
+    return 0 if position is None else position + 1
+
+
+def count_images(id: str, embedded: Optional[bool] = None) -> int:
+    """Count the images of a collection, optionally by embedding status."""
+
+    query = db.session.query(sqlalchemy.func.count(ImageEntry.id)).where(
+        ImageEntry.collection == id
+    )
+    if embedded is not None:
+        query = query.where(ImageEntry.embedded == embedded)
+    return query.scalar()
+
+
+def update_embedding_status(
+    embedded: list, failed: list, content_hashes: Optional[dict] = None
+) -> None:
+    """Record which images of a collection were embedded during finetuning.
+
+    :param embedded: The IDs of the entries that are part of the embeddings.
+    :param failed: The IDs of the entries that could not be embedded. They
+        are removed from the collection.
+    :param content_hashes: A mapping from entry IDs to the SHA-256 of their
+        downloaded image data.
+    """
+
+    for ids in _chunks(failed):
+        db.session.execute(sqlalchemy.delete(ImageEntry).where(ImageEntry.id.in_(ids)))
+    for ids in _chunks(embedded):
+        db.session.execute(
+            sqlalchemy.update(ImageEntry)
+            .where(ImageEntry.id.in_(ids))
+            .values(embedded=True)
+        )
+    if content_hashes:
+        db.session.execute(
+            sqlalchemy.update(ImageEntry),
+            [{"id": id, "content_hash": h} for id, h in content_hashes.items()],
+        )
+
+
+def images_as_csv(id: int, chunk_size: int = 1000):
+    """Return the content of a collection as an iterator over CSV chunks.
+
+    The collection is looked up right away, so that a missing collection
+    raises before the first chunk is produced. Each chunk contains the
+    encoded CSV lines of up to ``chunk_size`` rows.
+    """
+
+    db.session.query(Collection.id).where(Collection.id == id).one()
+
+    def _generate():
+        rows = db.session.execute(
+            sqlalchemy.select(ImageEntry.image_url, ImageEntry.repo_url)
+            .where(ImageEntry.collection == id)
+            .order_by(ImageEntry.position)
+            .execution_options(yield_per=chunk_size)
+        )
+        with io.StringIO() as output:
+            writer = csv.writer(output)
+            for partition in rows.partitions():
+                writer.writerows(
+                    (url,) if repo_url is None else (url, repo_url)
+                    for url, repo_url in partition
+                )
+                yield output.getvalue().encode("utf-8")
+                output.seek(0)
+                output.truncate()
+
+    return _generate()
 
 
 @dataclasses.dataclass
@@ -54,15 +224,25 @@ class Collection(db.Model):
     last_finetuned: datetime = db.Column(db.DateTime)
     finetuning_progess: float = db.Column(db.Integer, nullable=True, default=None)
     heidicon_tag: str = db.Column(db.Text, nullable=True)
+    heidicon_next_sync: datetime = db.Column(db.DateTime, nullable=True)
+    embedding_dtype: str = db.Column(db.Text, nullable=True, default="float32")
+
+
+def check_embedding_dtype(embedding_dtype: str) -> None:
+    """Raise a ValueError if embeddings cannot be stored in the given type."""
 
+    if embedding_dtype not in EMBEDDING_DTYPES:
+        raise ValueError(
+            f"Embedding data type must be one of {', '.join(EMBEDDING_DTYPES)}"
+        )
 
-def add_collection(name: str, heidicon_tag: Optional[str] = None):
+
+def add_collection(
+    name: str, heidicon_tag: Optional[str] = None, embedding_dtype: str = "float32"
+):
     """Add a new collection to the database."""
 
-    # If a HeidICON tag was given, extract the content from HeidICON
-    content = []
-    if heidicon_tag is not None:
-        content = extract_heidicon_content(heidicon_tag)
+    check_embedding_dtype(embedding_dtype)
 
     # Create the collection in the Collection table
     coll = Collection(
@@ -70,53 +250,403 @@ def add_collection(name: str, heidicon_tag: Optional[str] = None):
         last_modified=datetime.now(timezone.utc),
         last_finetuned=None,
         heidicon_tag=heidicon_tag,
+        embedding_dtype=embedding_dtype,
     )
     db.session.add(coll)
-    db.session.commit()
+    db.session.flush()
 
     # Add a corresponding entry in the Images table
-    images = Images(collection=coll.id, content=content)
+    images = Images(collection=coll.id)
     db.session.add(images)
-    db.session.commit()
 
+    # If a HeidICON tag was given, extract the content from HeidICON. If this
+    # fails, the collection is not created.
+    try:
+        if heidicon_tag is not None:
+            sync_heidicon_collection(coll)
+            coll.heidicon_next_sync = next_heidicon_sync()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    db.session.commit()
     return coll
 
 
 def delete_collection(id: int):
     """Delete a collection from the database."""
 
+    # Stop all work on the collection
+    cancel_jobs(id)
+
     coll = Collection.query.where(Collection.id == id).one()
     db.session.delete(coll)
 
     images = Images.query.where(Images.collection == id).one()
     db.session.delete(images)
 
+    db.session.execute(sqlalchemy.delete(ImageEntry).where(ImageEntry.collection == id))
+    db.session.execute(
+        sqlalchemy.delete(HeidiconObject).where(HeidiconObject.collection == id)
+    )
+
     db.session.commit()
+    remove_collection_files(id)
+
+
+def sync_heidicon_collection(coll: Collection) -> bool:
+    """Bring the content of a HeidICON collection up to date.
+
+    Only the objects that are new or whose version changed since the last
+    sync are requested from EasyDB. Images of objects whose image URLs did
+    not change are kept as they are, so that only added or removed images
+    need to be embedded. This does not commit the session.
+
+    :returns: Whether the images of the collection changed.
+    """
+
+    entries = (
+        db.session.query(
+            ImageEntry.source_id,
+            ImageEntry.source_version,
+            ImageEntry.image_url,
+            ImageEntry.repo_url,
+        )
+        .where(ImageEntry.collection == coll.id)
+        .order_by(ImageEntry.position)
+        .all()
+    )
+    known = dict(
+        db.session.query(HeidiconObject.source_id, HeidiconObject.version).where(
+            HeidiconObject.collection == coll.id
+        )
+    )
+
+    # Content that was not synced with object IDs is replaced entirely
+    legacy = any(entry.source_id is None for entry in entries)
+    if legacy:
+        db.session.execute(
+            sqlalchemy.delete(ImageEntry).where(ImageEntry.collection == coll.id)
+        )
+        db.session.execute(
+            sqlalchemy.delete(HeidiconObject).where(
+                HeidiconObject.collection == coll.id
+            )
+        )
+        entries = []
+        known = {}
+
+    object_rows = {}
+    for entry in entries:
+        object_rows.setdefault(entry.source_id, []).append(
+            (entry.image_url, entry.repo_url)
+        )
+
+    # Collections of older versions only recorded the objects with images
+    if not known and entries:
+        known = {entry.source_id: entry.source_version for entry in entries}
+        _record_heidicon_objects(coll.id, known)
+
+    changed, removed = sync_heidicon_objects(coll.heidicon_tag, known)
+
+    # Objects with new images are replaced, for all others only the version
+    # is updated. Objects without images do not change the collection.
+    replaced = {source_id for source_id in removed if source_id in object_rows}
+    new_values = []
+    version_updates = []
+    position = _next_position(coll.id)
+    for source_id, (version, rows) in changed.items():
+        if object_rows.get(source_id, []) == [tuple(row) for row in rows]:
+            if source_id in object_rows:
+                version_updates.append({"source": source_id, "version": version})
+            continue
+
+        replaced.add(source_id)
+        for row in rows:
+            values = _entry_values(coll.id, position + len(new_values), row)
+            new_values.append(dict(values, source_id=source_id, source_version=version))
+
+    if version_updates:
+        db.session.execute(
+            ImageEntry.__table__.update()
+            .where(
+                ImageEntry.collection == coll.id,
+                ImageEntry.source_id == sqlalchemy.bindparam("source"),
+            )
+            .values(source_version=sqlalchemy.bindparam("version")),
+            version_updates,
+        )
+    for ids in _chunks(list(replaced)):
+        db.session.execute(
+            sqlalchemy.delete(ImageEntry).where(
+                ImageEntry.collection == coll.id, ImageEntry.source_id.in_(ids)
+            )
+        )
+    if new_values:
+        db.session.execute(sqlalchemy.insert(ImageEntry), new_values)
+
+    for ids in _chunks(list(removed) + list(changed)):
+        db.session.execute(
+            sqlalchemy.delete(HeidiconObject).where(
+                HeidiconObject.collection == coll.id,
+                HeidiconObject.source_id.in_(ids),
+            )
+        )
+    _record_heidicon_objects(
+        coll.id, {source_id: version for source_id, (version, _) in changed.items()}
+    )
+
+    return legacy or bool(replaced or new_values)
+
+
+def _record_heidicon_objects(id: int, versions: dict) -> None:
+    """Record the versions of the objects of a HeidICON collection."""
+
+    values = [
+        {"collection": id, "source_id": source_id, "version": version}
+        for source_id, version in versions.items()
+    ]
+    if values:
+        db.session.execute(sqlalchemy.insert(HeidiconObject), values)
+
+
+def heidicon_refresh_interval() -> float:
+    """The time in seconds between two refreshes of a HeidICON collection.
+
+    A value of 0 disables the scheduled refreshes.
+    """
+
+    return float(os.environ.get("SIMILARITY_HEIDICON_REFRESH_INTERVAL", 86400))
+
+
+def heidicon_refresh_jitter() -> float:
+    """The relative random variation of the refresh interval."""
+
+    return float(os.environ.get("SIMILARITY_HEIDICON_REFRESH_JITTER", 0.2))
+
+
+def next_heidicon_sync(first: bool = False) -> datetime:
+    """The time of the next scheduled refresh of a HeidICON collection.
+
+    The refreshes of collections are spread out over time by a random
+    variation of the interval. The first refresh of a collection that was
+    never scheduled is placed anywhere within one interval, so that after an
+    upgrade not all collections are refreshed at once.
+    """
+
+    interval = heidicon_refresh_interval()
+    if first:
+        delay = random.random() * interval
+    else:
+        delay = interval * (1 + heidicon_refresh_jitter() * (random.random() - 0.5))
+    return datetime.now(timezone.utc) + timedelta(seconds=delay)
+
+
+def refresh_heidicon_collection(id: str) -> bool:
+    """Apply the changes from HeidICON to a collection and commit them.
+
+    :returns: Whether the content of the collection changed.
+    """
+
+    coll = Collection.query.where(Collection.id == id).one()
+    changed = sync_heidicon_collection(coll)
+    if changed:
+        coll.last_modified = datetime.now(timezone.utc)
+    coll.heidicon_next_sync = next_heidicon_sync()
+    db.session.commit()
+    return changed
+
+
+def schedule_heidicon_refreshes() -> list:
+    """Queue sync jobs for the HeidICON collections that are due for a refresh.
+
+    Several processes can call this concurrently, the scheduled time is
+    moved forward atomically so that only one of them queues the job.
+
+    :returns: The list of queued jobs.
+    """
+
+    if heidicon_refresh_interval() <= 0:
+        return []
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    jobs = []
+    collections = db.session.query(Collection.id, Collection.heidicon_next_sync).where(
+        Collection.heidicon_tag.is_not(None)
+    )
+    for id, next_sync in collections.all():
+        # Collections from older versions get a first scheduled time
+        if next_sync is None:
+            db.session.execute(
+                db.update(Collection)
+                .where(Collection.id == id, Collection.heidicon_next_sync.is_(None))
+                .values(heidicon_next_sync=next_heidicon_sync(first=True))
+            )
+            db.session.commit()
+            continue
+
+        if next_sync.replace(tzinfo=None) > now:
+            continue
+
+        result = db.session.execute(
+            db.update(Collection)
+            .where(Collection.id == id, Collection.heidicon_next_sync == next_sync)
+            .values(heidicon_next_sync=next_heidicon_sync())
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            jobs.append(enqueue_job(id, "sync"))
+
+    return jobs
 
 
 def update_collection_content(id: str, content: str):
-    """Update the content of a given collection."""
+    """Replace the content of a given collection with CSV content."""
 
-    # If this is based on HeidICON, extract the content
+    # If this is based on HeidICON, only apply the changes from HeidICON
     coll = Collection.query.where(Collection.id == id).one()
     if coll.heidicon_tag is not None:
-        content = extract_heidicon_content(coll.heidicon_tag)
-    else:
-        # Normalize the given string input
-        content = [
-            [token.strip() for token in line.split(",")]
-            for line in content.strip().split("\n")
-        ]
+        refresh_heidicon_collection(id)
+        return
 
-    # Update the content of the collection
-    images = Images.query.where(Images.collection == id).one()
-    images.content = content
+    # Replace the content of the collection. It is parsed like uploads, so
+    # that quoted fields may contain commas.
+    db.session.execute(sqlalchemy.delete(ImageEntry).where(ImageEntry.collection == id))
+    added = 0
+    for batch in iter_content_batches(io.BytesIO(content.encode("utf-8"))):
+        added += _insert_entries(id, batch, start=added)
 
     # Update the last modified timestamp
     coll.last_modified = datetime.now(timezone.utc)
     db.session.commit()
 
 
+def content_batch_size() -> int:
+    """The number of rows that are parsed and written together on uploads."""
+
+    return int(os.environ.get("SIMILARITY_CONTENT_BATCH_SIZE", 1000))
+
+
+def iter_content_batches(stream, batch_size: Optional[int] = None):
+    """Parse CSV content from a binary stream into batches of rows.
+
+    The stream is decoded and parsed incrementally, so that it never needs
+    to be held in memory as a whole. Empty lines are skipped.
+    """
+
+    if batch_size is None:
+        batch_size = content_batch_size()
+
+    batch = []
+    for row in csv.reader(io.TextIOWrapper(stream, encoding="utf-8", newline="")):
+        row = [token.strip() for token in row]
+        if not any(row):
+            continue
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def _editable_collection(id: str) -> Collection:
+    """Get a collection whose content can be edited through uploads."""
+
+    coll = Collection.query.where(Collection.id == id).one()
+    if coll.heidicon_tag is not None:
+        raise ValueError("The content of HeidICON collections is managed by HeidICON")
+    return coll
+
+
+def append_collection_content(id: str, batches) -> int:
+    """Append rows to the content of a collection.
+
+    :param batches: An iterable of lists of rows, e.g. from iter_content_batches.
+    :returns: The number of appended rows.
+    """
+
+    coll = _editable_collection(id)
+
+    added = 0
+    position = _next_position(id)
+    for batch in batches:
+        added += _insert_entries(id, batch, start=position + added)
+
+    if added:
+        coll.last_modified = datetime.now(timezone.utc)
+    db.session.commit()
+    return added
+
+
+def remove_collection_content(id: str, batches) -> int:
+    """Remove the rows with the given image URLs from a collection.
+
+    :param batches: An iterable of lists of rows, whose first column is the
+        image URL of the rows to remove.
+    :returns: The number of removed rows.
+    """
+
+    coll = _editable_collection(id)
+
+    removed = 0
+    for batch in batches:
+        for urls in _chunks(list({row[0] for row in batch})):
+            removed += db.session.execute(
+                sqlalchemy.delete(ImageEntry).where(
+                    ImageEntry.collection == id, ImageEntry.image_url.in_(urls)
+                )
+            ).rowcount
+
+    if removed:
+        coll.last_modified = datetime.now(timezone.utc)
+    db.session.commit()
+    return removed
+
+
+def patch_collection_content(id: str, batches) -> tuple[int, int]:
+    """Update the rows of a collection by image URL.
+
+    Rows with an image URL that is already part of the collection replace
+    the existing rows, all other rows are appended.
+
+    :param batches: An iterable of lists of rows, e.g. from iter_content_batches.
+    :returns: A tuple of the number of updated and the number of added rows.
+    """
+
+    coll = _editable_collection(id)
+
+    updated = added = 0
+    position = _next_position(id)
+    for batch in batches:
+        # The last row for an image URL wins
+        rows = {row[0]: row for row in batch}
+
+        existing = []
+        for urls in _chunks(list(rows)):
+            existing.extend(
+                ImageEntry.query.where(
+                    ImageEntry.collection == id, ImageEntry.image_url.in_(urls)
+                )
+            )
+        for entry in existing:
+            row = rows[entry.image_url]
+            repo_url = row[1] if len(row) > 1 else None
+            if entry.repo_url != repo_url:
+                entry.repo_url = repo_url
+                updated += 1
+
+        known = {entry.image_url for entry in existing}
+        new_rows = [row for url, row in rows.items() if url not in known]
+        added += _insert_entries(id, new_rows, start=position + added)
+
+    if updated or added:
+        coll.last_modified = datetime.now(timezone.utc)
+    db.session.commit()
+    return updated, added
+
+
 def update_collection_name(id: str, name: str):
     """Update the name of a given collection."""
 
@@ -125,6 +655,35 @@ def update_collection_name(id: str, name: str):
     db.session.commit()
 
 
+def update_collection_dtype(id: str, embedding_dtype: str):
+    """Change the data type that the embeddings of a collection are stored in.
+
+    The embeddings are converted during the next finetuning, which does not
+    need to embed the images again.
+    """
+
+    check_embedding_dtype(embedding_dtype)
+    coll = Collection.query.where(Collection.id == id).one()
+    if coll.embedding_dtype != embedding_dtype:
+        coll.embedding_dtype = embedding_dtype
+        coll.last_modified = datetime.now(timezone.utc)
+    db.session.commit()
+
+
+def collection_name(id) -> str:
+    """Get the name of a collection without loading its content."""
+
+    (name,) = db.session.query(Collection.name).where(Collection.id == id).one()
+    return name
+
+
+def collection_is_heidicon(id) -> bool:
+    """Whether the content of a collection is managed through HeidICON."""
+
+    (tag,) = db.session.query(Collection.heidicon_tag).where(Collection.id == id).one()
+    return tag is not None
+
+
 def list_collections():
     """List all collections."""
 
@@ -134,16 +693,21 @@ def list_collections():
 def collection_info(id):
     """Get information about a collection."""
 
-    # Get the data from the Collection and Images table
+    # Get the data from the Collection table and count the images
     coll = Collection.query.where(Collection.id == id).one()
-    images = Images.query.where(Images.collection == id).one()
+    number_of_images = count_images(id)
+    number_of_embedded_images = count_images(id, embedded=True)
 
     # Convert to a dictionary and remove the SQLAlchemy state
     info = coll.__dict__
     info.pop("_sa_instance_state")
 
     # Add some derived information
-    info["number_of_images"] = len(images.content)
+    info["number_of_images"] = number_of_images
+    info["number_of_embedded_images"] = number_of_embedded_images
+    (info["embedding_model"],) = (
+        db.session.query(Images.embedding_model).where(Images.collection == id).one()
+    )
     if coll.last_modified is not None and coll.last_finetuned is not None:
         info["requires_finetuning"] = coll.last_modified > coll.last_finetuned
     else:
@@ -151,11 +715,349 @@ def collection_info(id):
     return info
 
 
-def record_progress(id: str, progress: int = 0):
-    """Record the progress of a finetuning operation."""
+@dataclasses.dataclass
+class Job(db.Model):
+    """A background job that works on a collection, e.g. finetuning."""
+
+    id: int = db.Column(db.Integer, primary_key=True)
+    collection: int = db.Column(db.Integer, nullable=False, index=True)
+    kind: str = db.Column(db.Text, nullable=False, default="finetune")
+    status: str = db.Column(db.Text, nullable=False, default="queued")
+    created: datetime = db.Column(db.DateTime, nullable=False)
+    started: datetime = db.Column(db.DateTime, nullable=True)
+    finished: datetime = db.Column(db.DateTime, nullable=True)
+    heartbeat: datetime = db.Column(db.DateTime, nullable=True)
+    worker: str = db.Column(db.Text, nullable=True)
+    cancel_requested: bool = db.Column(db.Boolean, nullable=False, default=False)
+    error: str = db.Column(db.Text, nullable=True)
+    processed: int = db.Column(db.Integer, nullable=True)
+    total: int = db.Column(db.Integer, nullable=True)
+
+    # The embeddings computed so far, so that a job can be resumed after a
+    # crash. This is not a dataclass field to keep it out of JSON responses.
+    checkpoint = db.Column(db.LargeBinary, nullable=True)
+
+
+# The states of jobs that are not finished yet
+ACTIVE_JOB_STATES = ("queued", "running")
+
+
+def worker_name() -> str:
+    """Identify the current process as a job worker."""
+
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_job(id: str, kind: str = "finetune") -> Job:
+    """Queue a job for a collection.
+
+    If there is already an active job of the same kind for the collection,
+    that job is returned instead of queueing a new one.
+    """
+
+    ensure_collection_id(id)
+
+    job = (
+        Job.query.where(Job.collection == id)
+        .where(Job.kind == kind)
+        .where(Job.status.in_(ACTIVE_JOB_STATES))
+        .where(Job.cancel_requested.is_(False))
+        .order_by(Job.id)
+        .first()
+    )
+    if job is not None:
+        return job
+
+    job = Job(
+        collection=id, kind=kind, status="queued", created=datetime.now(timezone.utc)
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def claim_job() -> Optional[Job]:
+    """Claim the oldest queued job for the current process.
+
+    Jobs are skipped if another job for the same collection is running.
+    Claiming is an atomic update that checks this again, so that several
+    processes can share the same queue.
+    """
+
+    running = db.select(Job.collection).where(Job.status == "running")
+    candidates = (
+        Job.query.where(Job.status == "queued")
+        .where(Job.collection.not_in(running))
+        .order_by(Job.id)
+        .all()
+    )
+
+    for job in candidates:
+        now = datetime.now(timezone.utc)
+        result = db.session.execute(
+            db.update(Job)
+            .where(Job.id == job.id)
+            .where(Job.status == "queued")
+            .where(Job.collection.not_in(running))
+            .values(status="running", started=now, heartbeat=now, worker=worker_name())
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            db.session.refresh(job)
+            return job
+
+
+def get_job(job_id: int) -> Job:
+    """Get a job by its ID."""
+
+    return Job.query.where(Job.id == job_id).one()
+
+
+def cancel_jobs(id: str) -> list:
+    """Cancel the active jobs of a collection.
+
+    Queued jobs are cancelled right away, running jobs are asked to stop
+    at their next checkpoint.
+    """
+
+    ensure_collection_id(id)
+
+    jobs = (
+        Job.query.where(Job.collection == id)
+        .where(Job.status.in_(ACTIVE_JOB_STATES))
+        .all()
+    )
+    for job in jobs:
+        if job.status == "queued":
+            job.status = "cancelled"
+            job.finished = datetime.now(timezone.utc)
+        else:
+            job.cancel_requested = True
+    db.session.commit()
+
+    return jobs
+
+
+class JobCancelled(Exception):
+    """Raised in a running job when its cancellation was requested."""
+
+
+def checkpoint_job(
+    job: Job,
+    checkpoint: Optional[bytes] = None,
+    processed: Optional[int] = None,
+    total: Optional[int] = None,
+) -> None:
+    """Record that a running job is alive and optionally store a checkpoint.
+
+    Raises JobCancelled if the job was asked to stop in the meantime.
+    """
+
+    db.session.refresh(job)
+    if job.cancel_requested:
+        raise JobCancelled()
+
+    job.heartbeat = datetime.now(timezone.utc)
+    if checkpoint is not None:
+        job.checkpoint = checkpoint
+    if processed is not None:
+        job.processed = processed
+    if total is not None:
+        job.total = total
+    db.session.commit()
+
+
+def record_heartbeat(job_id: int) -> None:
+    """Record that a running job is alive without loading or changing its state.
+
+    This is safe to call from another thread than the one running the job.
+    """
+
+    db.session.execute(
+        db.update(Job)
+        .where(Job.id == job_id, Job.status == "running")
+        .values(heartbeat=datetime.now(timezone.utc))
+    )
+    db.session.commit()
+
+
+def progress_interval() -> float:
+    """The minimum time in seconds between two progress writes to the database."""
+
+    return float(os.environ.get("SIMILARITY_PROGRESS_INTERVAL", 5))
+
+
+def progress_step() -> float:
+    """The progress in percent after which progress is written to the database."""
+
+    return float(os.environ.get("SIMILARITY_PROGRESS_STEP", 5))
+
+
+# The progress trackers of the finetuning operations in this process
+_progress_trackers = {}
+_progress_trackers_lock = threading.Lock()
+
+
+class ProgressTracker:
+    """Track the progress of a finetuning operation.
+
+    The progress is kept in memory and can be queried through
+    :func:`finetuning_status`. It is written to the database only when
+    :func:`progress_interval` seconds passed or the progress advanced by
+    :func:`progress_step` percent since the last write. If the operation
+    runs as a job, a write also serves as the heartbeat of the job.
+    """
+
+    def __init__(self, id: str, total: int, job: Optional[Job] = None):
+        self.id = str(id)
+        self.total = total
+        self.job = job
+        self.processed = 0
+        self.started = time.monotonic()
+        self.last_write = self.started
+        self.last_percent = 0
+
+        with _progress_trackers_lock:
+            _progress_trackers[self.id] = self
+        self.flush()
+
+    def percent(self) -> int:
+        if self.total == 0:
+            return 100
+        return int(self.processed / self.total * 100)
+
+    def update(self, processed: int, checkpoint: Optional[bytes] = None) -> None:
+        """Update the number of processed images.
+
+        If a checkpoint is given, it is written to the database right away.
+        """
+
+        self.processed = processed
+        if (
+            checkpoint is not None
+            or time.monotonic() - self.last_write >= progress_interval()
+            or self.percent() - self.last_percent >= progress_step()
+        ):
+            self.flush(checkpoint)
+
+    def flush(self, checkpoint: Optional[bytes] = None) -> None:
+        """Write the progress to the database."""
+
+        coll = Collection.query.where(Collection.id == self.id).one()
+        coll.finetuning_progess = self.percent()
+        if self.job is not None:
+            checkpoint_job(self.job, checkpoint, self.processed, self.total)
+        else:
+            db.session.commit()
+
+        self.last_write = time.monotonic()
+        self.last_percent = self.percent()
+
+    def status(self) -> dict:
+        """The current progress with throughput and estimated time remaining."""
+
+        elapsed = time.monotonic() - self.started
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.processed) / rate if rate > 0 else None
+        return {
+            "running": True,
+            "progress": self.percent(),
+            "processed": self.processed,
+            "total": self.total,
+            "rate": rate,
+            "eta": eta,
+        }
+
+    def close(self) -> None:
+        """Remove the tracker when the operation is finished."""
+
+        with _progress_trackers_lock:
+            if _progress_trackers.get(self.id) is self:
+                del _progress_trackers[self.id]
+
+
+def finetuning_status(id: str) -> dict:
+    """Get the progress of the finetuning operation of a collection.
+
+    If the operation runs in this process, the status is taken from memory.
+    Otherwise, it is derived from what the running job last wrote to the
+    database.
+    """
+
+    with _progress_trackers_lock:
+        tracker = _progress_trackers.get(str(id))
+    if tracker is not None:
+        return tracker.status()
 
     coll = Collection.query.where(Collection.id == id).one()
-    coll.finetuning_progess = progress
+    job = (
+        Job.query.where(Job.collection == id)
+        .where(Job.status == "running")
+        .order_by(Job.id.desc())
+        .first()
+    )
+
+    status = {
+        "running": job is not None,
+        "progress": coll.finetuning_progess,
+        "processed": None,
+        "total": None,
+        "rate": None,
+        "eta": None,
+    }
+    if job is not None and job.processed is not None:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        elapsed = (now - job.started.replace(tzinfo=None)).total_seconds()
+        rate = job.processed / elapsed if elapsed > 0 else 0.0
+        status.update(
+            processed=job.processed,
+            total=job.total,
+            rate=rate,
+            eta=(job.total - job.processed) / rate if rate > 0 else None,
+        )
+    return status
+
+
+def finish_job(job: Job, status: str, error: Optional[str] = None) -> None:
+    """Mark a job as finished with the given status."""
+
+    job.status = status
+    job.error = error
+    job.finished = datetime.now(timezone.utc)
+    job.checkpoint = None
+    db.session.commit()
+
+
+def requeue_stale_jobs(timeout: float) -> None:
+    """Put running jobs back into the queue if their worker is gone.
+
+    A worker is considered gone if its heartbeat is older than ``timeout``
+    seconds or if it was a process on this host that does not exist anymore.
+    The job then resumes from its last checkpoint.
+    """
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    hostname = socket.gethostname()
+
+    for job in Job.query.where(Job.status == "running"):
+        stale = (
+            job.heartbeat is None
+            or (now - job.heartbeat.replace(tzinfo=None)).total_seconds() > timeout
+        )
+
+        host, _, pid = (job.worker or "").rpartition(":")
+        if host == hostname and pid.isdigit() and int(pid) != os.getpid():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                stale = True
+            except PermissionError:
+                pass
+
+        if stale:
+            job.status = "queued"
+            job.worker = None
+
     db.session.commit()
 
 
@@ -168,6 +1070,80 @@ class ApiKey(db.Model):
     key: str = db.Column(db.Text, nullable=False)
     created: datetime = db.Column(db.DateTime, nullable=False)
 
+    # A short, unsalted identifier of the key that is used to find the row
+    # of a given key without verifying the argon2 hash of every row.
+    lookup = db.Column(db.Text, nullable=True, index=True)
+
+
+def api_key_lookup(key: str) -> str:
+    """Compute the lookup identifier of an API key."""
+
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def api_key_cache_ttl() -> float:
+    """The time in seconds that a verified API key is cached."""
+
+    return float(os.environ.get("SIMILARITY_APIKEY_CACHE_TTL", 60))
+
+
+# Verified API keys, mapping the SHA-256 digest of the key to the ID and hash
+# of its database row and the expiry time of the cache entry
+_api_key_cache = {}
+_api_key_cache_lock = threading.Lock()
+
+
+def verify_api_key(api_key: str) -> bool:
+    """Verify an API key against the database.
+
+    Recently verified keys are cached for a short time. A cache hit still
+    checks that the row of the key exists, so that keys that were deleted
+    by another process are rejected. Otherwise, only the rows with the
+    lookup identifier of the given key are verified with argon2.
+    """
+
+    digest = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    with _api_key_cache_lock:
+        cached = _api_key_cache.get(digest)
+
+    if cached is not None:
+        key_id, key_hash, expires = cached
+        if time.monotonic() < expires:
+            keyobj = db.session.get(ApiKey, key_id)
+            if keyobj is not None and hmac.compare_digest(keyobj.key, key_hash):
+                return True
+
+        with _api_key_cache_lock:
+            _api_key_cache.pop(digest, None)
+
+    # Keys that were created before lookup identifiers existed have none
+    lookup = api_key_lookup(api_key)
+    candidates = ApiKey.query.where(
+        sqlalchemy.or_(ApiKey.lookup == lookup, ApiKey.lookup.is_(None))
+    )
+
+    for keyobj in candidates:
+        try:
+            ph.verify(keyobj.key, api_key)
+        except argon2.exceptions.VerifyMismatchError:
+            continue
+
+        # argon2 specifies that we need to occasionally rehash the password
+        if ph.check_needs_rehash(keyobj.key):
+            keyobj.key = ph.hash(api_key)
+        keyobj.lookup = lookup
+        db.session.commit()
+
+        with _api_key_cache_lock:
+            _api_key_cache[digest] = (
+                keyobj.id,
+                keyobj.key,
+                time.monotonic() + api_key_cache_ttl(),
+            )
+        return True
+
+    return False
+
 
 def require_api_key(f):
     @functools.wraps(f)
@@ -179,19 +1155,9 @@ def require_api_key(f):
                 403,
             )
 
-        # Verify API key (assuming it's hashed in the database)
-        for keyobj in ApiKey.query.all():
-            try:
-                if ph.verify(keyobj.key, api_key):
-                    # argon2 specifies that we need to occasionally rehash the password
-                    if ph.check_needs_rehash(keyobj.key):
-                        keyobj.key = ph.hash(api_key)
-                        db.session.commit()
-
-                    # Proceed with the original route function
-                    return f(*args, **kwargs)
-            except argon2.exceptions.VerifyMismatchError:
-                pass
+        # Proceed with the original route function
+        if verify_api_key(api_key):
+            return f(*args, **kwargs)
 
         # If we reach this point, the API key was not found
         return flask.jsonify(message="Invalid API key", message_type="error"), 403
@@ -203,7 +1169,12 @@ def add_new_apikey(name: str, key: str) -> None:
     """Add a new API key to the database."""
 
     db.session.add(
-        ApiKey(name=name, key=ph.hash(key), created=datetime.now(timezone.utc))
+        ApiKey(
+            name=name,
+            key=ph.hash(key),
+            lookup=api_key_lookup(key),
+            created=datetime.now(timezone.utc),
+        )
     )
     db.session.commit()
 
@@ -221,6 +1192,129 @@ def delete_apikey(id: int) -> None:
     db.session.delete(key)
     db.session.commit()
 
+    # Invalidate the verified keys of this process
+    with _api_key_cache_lock:
+        for digest, cached in list(_api_key_cache.items()):
+            if cached[0] == id:
+                del _api_key_cache[digest]
+
+
+def upgrade_database_schema() -> None:
+    """Add columns to existing tables that were introduced later on
+
+    db.create_all() only creates missing tables, so columns and indexes
+    that were added to the models after a database was created are added
+    here. All such columns need to be nullable.
+    """
+
+    inspector = sqlalchemy.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                with db.engine.begin() as connection:
+                    connection.execute(
+                        sqlalchemy.text(
+                            f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                        )
+                    )
+
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind=db.engine)
+
+
+def migrate_embedding_blobs() -> None:
+    """Move embeddings that are stored as parquet BLOBs into files.
+
+    Older versions stored the embedding matrix of a collection as a parquet
+    file in Images.parquet_data and the ANN index in Images.ann_index.
+    """
+
+    migrated = False
+    for images in Images.query.where(Images.parquet_data.is_not(None)):
+        # pandas is only needed to read the legacy format
+        import pandas as pd
+
+        feature_df = pd.read_parquet(io.BytesIO(images.parquet_data))
+        if feature_df.index.name == "image_url":
+            keys = list(feature_df.index)
+        elif len(feature_df) == len(images.content):
+            keys = [content[0] for content in images.content]
+        else:
+            # Without keys, the embeddings are recomputed on the next finetuning
+            keys = [None] * len(feature_df)
+
+        path = write_embeddings(images.collection, feature_df.values, keys)
+        if images.ann_index is not None:
+            with open(auxiliary_file(path, "ann.npz"), "wb") as f:
+                f.write(images.ann_index)
+
+        images.embedding_path = path
+        images.embedding_count = len(feature_df)
+        images.parquet_data = None
+        images.ann_index = None
+        db.session.commit()
+        migrated = True
+
+    # Give the space of the BLOBs back to the file system
+    if migrated:
+        _vacuum_database()
+
+
+def migrate_image_entries() -> None:
+    """Move the content of collections from Images.content to ImageEntry rows.
+
+    This needs to run after migrate_embedding_blobs, which uses Images.content
+    for embeddings that are not keyed by image URL.
+    """
+
+    migrated = False
+    for images in Images.query:
+        if not images.content:
+            continue
+
+        db.session.execute(
+            sqlalchemy.delete(ImageEntry).where(
+                ImageEntry.collection == images.collection
+            )
+        )
+        _insert_entries(images.collection, images.content)
+
+        # The content is embedded if it did not change since the last finetuning
+        coll = Collection.query.where(Collection.id == images.collection).one_or_none()
+        if (
+            coll is not None
+            and images.embedding_path is not None
+            and coll.last_finetuned is not None
+            and coll.last_finetuned >= coll.last_modified
+        ):
+            db.session.execute(
+                sqlalchemy.update(ImageEntry)
+                .where(ImageEntry.collection == images.collection)
+                .values(embedded=True)
+            )
+
+        images.content = []
+        db.session.commit()
+        migrated = True
+
+    if migrated:
+        _vacuum_database()
+
+
+def _vacuum_database() -> None:
+    """Give space that was freed in the database back to the file system."""
+
+    if db.engine.dialect.name == "sqlite":
+        with db.engine.connect() as connection:
+            connection.execute(sqlalchemy.text("VACUUM"))
+
 
 def startup_sanity_check() -> None:
     """Perform a sanity check at startup
@@ -229,11 +1323,27 @@ def startup_sanity_check() -> None:
     occured from a crashed previous run.
     """
 
-    for coll in Collection.query.all():
+    requeue_stale_jobs(job_timeout())
+
+    # Reset the progress of collections that are not being worked on
+    running = db.select(Job.collection).where(Job.status == "running")
+    for coll in Collection.query.where(Collection.id.not_in(running)):
         if coll.finetuning_progess is not None:
             coll.finetuning_progess = None
             db.session.commit()
 
 
+def job_timeout() -> float:
+    """The time in seconds after which a job without heartbeat is requeued."""
+
+    return float(os.environ.get("SIMILARITY_JOB_TIMEOUT", 300))
+
+
+def heartbeat_interval() -> float:
+    """The time in seconds between two heartbeats of a running job."""
+
+    return float(os.environ.get("SIMILARITY_JOB_HEARTBEAT_INTERVAL", 60))
+
+
 def ensure_collection_id(id: int) -> None:
     Collection.query.where(Collection.id == id).one()
@@ -0,0 +1,108 @@
+from typing import Optional, TYPE_CHECKING
+
+import numpy as np
+import os
+
+# torch is imported when it is used, so that the app starts quickly
+if TYPE_CHECKING:
+    import torch
+
+
+# The data types that embeddings of a collection can be stored in
+EMBEDDING_DTYPES = ("float32", "float16", "int8")
+
+
+def rerank_factor() -> int:
+    """How many candidates per result are re-ranked with the exact embeddings.
+
+    A value of 0 disables the re-ranking of quantized embeddings.
+    """
+
+    return int(os.environ.get("SIMILARITY_RERANK_FACTOR", 4))
+
+
+def quantize(features: np.ndarray, dtype: str):
+    """Quantize a matrix of embeddings with one row per image.
+
+    For int8, each row is scaled to the range [-127, 127] separately.
+
+    :returns: A tuple of the quantized values and the per-row scale factors,
+        which are None for floating point types.
+    """
+
+    features = np.asarray(features, dtype=np.float32)
+    if dtype == "float32":
+        return features, None
+    if dtype == "float16":
+        return features.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(features).max(axis=1, initial=0.0) / 127
+        scales[scales == 0] = 1.0
+        values = np.round(features / scales[:, None]).astype(np.int8)
+        return values, scales.astype(np.float32)
+
+    raise ValueError(f"Unknown embedding data type '{dtype}'")
+
+
+class QuantizedFeatures:
+    """The embeddings of a collection in the representation they are searched in.
+
+    The scores are calculated on the (possibly quantized) values directly.
+    The exact float32 embeddings are only used to re-rank the best candidates
+    and are typically memory-mapped, so they do not need to be in memory.
+    """
+
+    def __init__(
+        self,
+        values: "torch.Tensor",
+        scales: Optional["torch.Tensor"] = None,
+        exact: Optional[np.ndarray] = None,
+    ):
+        self.values = values
+        self.scales = scales
+        self.exact = exact
+
+    def __len__(self) -> int:
+        return self.values.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the values and the scale factors in bytes."""
+
+        size = self.values.element_size() * self.values.nelement()
+        if self.scales is not None:
+            size += self.scales.element_size() * self.scales.nelement()
+        return size
+
+    def scores(self, queries: "torch.Tensor", chunk_size: int = 65536):
+        """Score the queries against all embeddings.
+
+        The values are converted to float32 in chunks, so that no full
+        float32 copy of the embeddings is made.
+        """
+
+        import torch
+
+        if self.values.dtype == torch.float32:
+            return torch.matmul(queries, self.values.T)
+
+        scores = []
+        for start in range(0, len(self), chunk_size):
+            chunk = self.values[start : start + chunk_size].to(queries.dtype)
+            chunk_scores = torch.matmul(queries, chunk.T)
+            if self.scales is not None:
+                chunk_scores *= self.scales[start : start + chunk_size]
+            scores.append(chunk_scores)
+        return torch.cat(scores, dim=1)
+
+    def exact_scores(self, queries: "torch.Tensor", rows: "torch.Tensor"):
+        """Score each query against the exact embeddings of the given rows.
+
+        :param rows: The candidate rows with one row of candidates per query.
+        """
+
+        import torch
+
+        candidates = torch.from_numpy(np.asarray(self.exact[rows.cpu().numpy()]))
+        candidates = candidates.to(queries.device, queries.dtype)
+        return torch.einsum("qd,qcd->qc", queries, candidates)
@@ -0,0 +1,88 @@
+from typing import Optional
+
+import json
+import numpy as np
+import os
+import shutil
+import uuid
+
+
+def data_directory() -> str:
+    """The directory that embeddings are stored in."""
+
+    return os.environ.get("SIMILARITY_DATA_DIR", "similarity_data")
+
+
+def _collection_directory(id) -> str:
+    return os.path.join(data_directory(), f"collection_{id}")
+
+
+def write_embeddings(id, features: np.ndarray, keys: list) -> str:
+    """Write the embeddings of a collection to new files.
+
+    The embeddings are stored as a raw float32 ``.npy`` file, the keys (the
+    image URLs of the rows) as a JSON file next to it. Each call writes new
+    files, so that readers of the previous version are not disturbed.
+
+    :returns: The path of the embeddings relative to the data directory,
+        without file extension. This is stored in the database.
+    """
+
+    directory = _collection_directory(id)
+    os.makedirs(directory, exist_ok=True)
+    name = f"embeddings-{uuid.uuid4().hex}"
+    path = os.path.join(directory, name)
+
+    # Write to temporary files first, so that no partial files are visible
+    np.save(f"{path}.tmp.npy", np.ascontiguousarray(features, dtype=np.float32))
+    with open(f"{path}.tmp.json", "w") as f:
+        json.dump(list(keys), f)
+    os.replace(f"{path}.tmp.npy", f"{path}.npy")
+    os.replace(f"{path}.tmp.json", f"{path}.json")
+
+    return os.path.join(f"collection_{id}", name)
+
+
+def load_embeddings(path: str, mmap_mode: Optional[str] = "r"):
+    """Load the embeddings and keys that were written with write_embeddings.
+
+    The embeddings are memory-mapped, so loading them does not copy any data.
+    """
+
+    path = os.path.join(data_directory(), path)
+    features = np.load(f"{path}.npy", mmap_mode=mmap_mode)
+    with open(f"{path}.json", "r") as f:
+        keys = json.load(f)
+
+    return features, keys
+
+
+def auxiliary_file(path: str, name: str) -> str:
+    """The absolute path of a file that belongs to the given embeddings."""
+
+    return os.path.join(data_directory(), f"{path}.{name}")
+
+
+def remove_embeddings(path: Optional[str]) -> None:
+    """Remove the files of the given embeddings.
+
+    Memory maps of the files that are still in use stay valid.
+    """
+
+    if path is None:
+        return
+
+    prefix = os.path.join(data_directory(), path)
+    directory = os.path.dirname(prefix)
+    if not os.path.isdir(directory):
+        return
+
+    for filename in os.listdir(directory):
+        if os.path.join(directory, filename).startswith(f"{prefix}."):
+            os.remove(os.path.join(directory, filename))
+
+
+def remove_collection_files(id) -> None:
+    """Remove all files of a collection."""
+
+    shutil.rmtree(_collection_directory(id), ignore_errors=True)
@@ -1,104 +1,569 @@
 from datetime import datetime, timezone
+from typing import Optional
 import torch
 from PIL import Image
-from similarity_webservice.model import db, Images, Collection, record_progress
-import urllib.request
-import pandas as pd
+from similarity_webservice.model import (
+    db,
+    Images,
+    ImageEntry,
+    Collection,
+    Job,
+    ProgressTracker,
+    update_embedding_status,
+)
+from similarity_webservice.download import iter_preprocessed_images
+from similarity_webservice.cache import feature_cache
+from similarity_webservice.imagecache import image_cache
+from similarity_webservice.ann import IVFIndex, ann_min_size
+from similarity_webservice.encoder import load_image_only_model
+from similarity_webservice.export import ExportedEncoder, image_encoder_path
+from similarity_webservice.batching import (
+    MicroBatcher,
+    search_batch_size,
+    search_batch_wait,
+)
+from similarity_webservice.quantization import (
+    QuantizedFeatures,
+    quantize,
+    rerank_factor,
+)
+from similarity_webservice.storage import (
+    auxiliary_file,
+    load_embeddings,
+    remove_embeddings,
+    write_embeddings,
+)
+import contextlib
+import functools
+import numpy as np
 import io
-from lavis.models import load_model_and_preprocess
+import logging
+import os
+import sys
+import threading
+import time
+from lavis.common.registry import registry
+from lavis.models import load_model_and_preprocess, load_preprocess
+from omegaconf import OmegaConf
 
 
+logger = logging.getLogger("similarity_webservice")
+
+# The model that computes the embeddings
+MODEL_NAME = "blip2_feature_extractor"
+MODEL_TYPE = "coco"
+
 # Storage for the singleton model and vis_processors
 model = None
 vis_processors = None
+_model_lock = threading.Lock()
+
+
+def image_only_model() -> bool:
+    """Whether only the parts of the model that embed images are loaded."""
+
+    return os.environ.get("SIMILARITY_IMAGE_ONLY_MODEL", "1").lower() in ("1", "true")
+
+
+def _model_config():
+    return OmegaConf.load(
+        registry.get_model_class(MODEL_NAME).default_config_path(MODEL_TYPE)
+    )
+
+
+def load_eager_model():
+    """Load the PyTorch model and its image preprocessing.
+
+    By default, only the image embedding path of the model is built, see
+    :class:`~similarity_webservice.encoder.ImageOnlyBlip2`. If that fails, the full LAVIS model is loaded.
+    """
+
+    if image_only_model():
+        try:
+            config = _model_config()
+            processors, _ = load_preprocess(config.preprocess)
+            return load_image_only_model(config.model), processors
+        except Exception as e:
+            logger.warning(
+                f"Could not load the image-only model, loading all of it: {e}"
+            )
+
+    loaded, processors, _ = load_model_and_preprocess(
+        name=MODEL_NAME,
+        model_type=MODEL_TYPE,
+        is_eval=True,
+    )
+    return loaded, processors
+
+
+def load_vis_processors():
+    """Load only the image preprocessing of the model, without its weights."""
+
+    processors, _ = load_preprocess(_model_config().preprocess)
+    return processors
 
 
 def load_model_and_vis_preprocess():
     global model, vis_processors
 
-    if model is None:
-        device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
-        model, vis_processors, _ = load_model_and_preprocess(
-            name="blip2_feature_extractor",
-            model_type="coco",
-            is_eval=True,
-        )
-        model.to(device)
+    # The model is loaded in the background, but jobs might need it earlier
+    with _model_lock:
+        if model is None:
+            # An exported image encoder replaces the eager model
+            exported = image_encoder_path()
+            if exported is not None:
+                vis_processors = load_vis_processors()
+                model = ExportedEncoder(exported)
+                return
 
+            device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
+            loaded, vis_processors = load_eager_model()
+            loaded.to(device)
+            model = loaded
 
-def extract_features(images: list, model):
+
+def embedding_model_name() -> str:
+    """The name of the loaded model, which is stored with the embeddings it computed."""
+
+    name = f"{MODEL_NAME}-{MODEL_TYPE}"
+    if isinstance(model, ExportedEncoder):
+        name = f"{name}-{model.name}"
+    return name
+
+
+def embedding_model_matches(embedding_model: Optional[str]) -> bool:
+    """Whether stored embeddings were computed by the loaded model.
+
+    Embeddings of older versions, which did not record their model, were
+    computed by the eager model.
+    """
+
+    return (embedding_model or f"{MODEL_NAME}-{MODEL_TYPE}") == embedding_model_name()
+
+
+def warmup_model():
+    """Run one forward pass, so that the first search does not pay for it."""
+
+    device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
+    image = vis_processors["eval"](Image.new("RGB", (256, 256)))
+    query_batcher([image.unsqueeze(0).to(device)])
+
+
+def embedding_batch_size() -> int:
+    """The number of images that are embedded in one forward pass."""
+
+    return int(os.environ.get("SIMILARITY_EMBED_BATCH_SIZE", 32))
+
+
+def extract_features(images: list, model, batch_size: Optional[int] = None):
     """
     Extract features from an image using the BLIP2 model.
+
+    The given preprocessed images (each of shape ``(1, C, H, W)``) are
+    embedded in batches of ``batch_size`` images per forward pass. The
+    result has one row per input image. The model is either the eager
+    model or an :class:`ExportedEncoder`.
     """
 
-    image_tensor = torch.stack(images)
-    features_image = [
-        model.extract_features({"image": ten, "text_input": ""}, mode="image")
-        for ten in image_tensor
-    ]
-    features_image_stacked = torch.stack(
-        [feat.image_embeds_proj[:, 0, :].squeeze(0) for feat in features_image]
+    if batch_size is None:
+        batch_size = embedding_batch_size()
+
+    image_tensor = torch.cat(images)
+    features_image = []
+    with torch.no_grad():
+        for batch in torch.split(image_tensor, batch_size):
+            if isinstance(model, ExportedEncoder):
+                features_image.append(model(batch))
+                continue
+
+            features = model.extract_features(
+                {"image": batch, "text_input": ""}, mode="image"
+            )
+            features_image.append(features.image_embeds_proj[:, 0, :])
+
+    return torch.cat(features_image)
+
+
+def normalize_embeddings(features: torch.Tensor) -> torch.Tensor:
+    """L2-normalize embeddings, so that inner products are cosine similarities."""
+
+    return torch.nn.functional.normalize(features.float(), dim=-1)
+
+
+def checkpoint_interval() -> float:
+    """The time in seconds between two checkpoints of a finetuning job."""
+
+    return float(os.environ.get("SIMILARITY_CHECKPOINT_INTERVAL", 30))
+
+
+def serialize_embeddings(embedded: dict) -> bytes:
+    """Serialize a dictionary that maps image URLs to embeddings."""
+
+    buffer = io.BytesIO()
+    np.savez(
+        buffer,
+        urls=np.array(list(embedded), dtype=str),
+        features=torch.stack(list(embedded.values())).numpy(),
     )
-    return features_image_stacked
+    return buffer.getvalue()
+
+
+def deserialize_embeddings(data: bytes) -> dict:
+    """Deserialize embeddings that were serialized with serialize_embeddings."""
+
+    with np.load(io.BytesIO(data)) as arrays:
+        return dict(zip(arrays["urls"].tolist(), torch.from_numpy(arrays["features"])))
+
 
+def finetune_model(id: str, job: Optional[Job] = None):
+    """Finetune a model with a given collection.
 
-def finetune_model(id: str):
-    """Finetune a model with a given collection."""
+    Embeddings are stored keyed by image URL. Images that were already
+    embedded in a previous run are reused, so that only images that were
+    added to the collection need to be downloaded and embedded. Rows
+    that were removed from the collection are dropped. If the stored
+    embeddings were computed by a different model, e.g. before an encoder
+    was exported, all images are embedded again.
+
+    If this runs as a background job, the embeddings computed so far are
+    regularly stored as a checkpoint of the job. A job that is resumed
+    after a crash continues from its last checkpoint.
+    """
 
     global model, vis_processors
+    load_model_and_vis_preprocess()
     device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
     row_with_data = Images.query.filter(Images.collection == id).one()
     coll = Collection.query.filter(Collection.id == id).one()
-    content_list = row_with_data.content
-    actual_content = []
 
-    if row_with_data.parquet_data is None or (coll.last_modified > coll.last_finetuned):
-        record_progress(id, 0)
+    old_path = row_with_data.embedding_path
+    model_name = embedding_model_name()
+    same_model = embedding_model_matches(row_with_data.embedding_model)
+    if old_path is None or not same_model or (coll.last_modified > coll.last_finetuned):
+        # The IDs and image URLs of the collection content in order
+        entries = (
+            db.session.query(ImageEntry.id, ImageEntry.image_url)
+            .where(ImageEntry.collection == id)
+            .order_by(ImageEntry.position)
+            .all()
+        )
 
-        if row_with_data.parquet_data is None:
-            parquet_df = pd.DataFrame()
-            parquet_feature_tensor = torch.empty(0).to(device)
-        else:
-            parquet_df = pd.read_parquet(io.BytesIO(row_with_data.parquet_data))
-            parquet_feature_tensor = torch.tensor(parquet_df.values).to(device)
+        # Look up the embeddings of the previous run by image URL. Rows of
+        # migrated data without a known URL cannot be reused.
+        known_urls = {}
+        known_features = None
+        if old_path is not None and same_model:
+            features, keys = load_embeddings(old_path)
+            known_features = torch.tensor(np.asarray(features), dtype=torch.float32)
+            if not row_with_data.normalized:
+                known_features = normalize_embeddings(known_features)
+            for row, url in enumerate(keys):
+                if url is not None:
+                    known_urls.setdefault(url, row)
 
-        for i, content in enumerate(content_list):
-            try:
-                raw_image = Image.open(urllib.request.urlopen(content[0])).convert(
-                    "RGB"
-                )
-                preprocessed_image = [
-                    vis_processors["eval"](raw_image).unsqueeze(0).to(device)
-                ]
-
-                features_image_stacked = extract_features(preprocessed_image, model)
-                # Concatenate extracted features
-                parquet_feature_tensor = torch.cat(
-                    [parquet_feature_tensor, features_image_stacked]
+        # Resume from the checkpoint of a previous attempt of this job
+        embedded = {}
+        if job is not None and job.checkpoint is not None:
+            embedded = deserialize_embeddings(job.checkpoint)
+
+        # Only embed the images that we do not know yet, each of them once
+        new_urls = list(
+            dict.fromkeys(
+                url
+                for _, url in entries
+                if url not in known_urls and url not in embedded
+            )
+        )
+
+        # Images are downloaded and preprocessed concurrently, while this
+        # thread embeds them in batches of one forward pass each.
+        batch_size = embedding_batch_size()
+        batch_images = []
+        batch_indices = []
+        content_hashes = {}
+        last_checkpoint = time.monotonic()
+
+        # Downloaded images and their embeddings are cached on disk, so that
+        # images shared with other collections are not embedded again
+        cache = image_cache()
+        lookup = None
+        if cache is not None:
+            lookup = functools.partial(cache.get_embedding, model_name)
+
+        def _embed_batch():
+            nonlocal last_checkpoint
+
+            features_image_stacked = extract_features(batch_images, model).cpu()
+            for index, features in zip(batch_indices, features_image_stacked):
+                embedded[new_urls[index]] = features
+                if cache is not None:
+                    cache.put_embedding(
+                        model_name, content_hashes[new_urls[index]], features
+                    )
+            batch_images.clear()
+            batch_indices.clear()
+
+            # Regularly return the embeddings so far as a checkpoint of the job
+            if job is not None:
+                if time.monotonic() - last_checkpoint > checkpoint_interval():
+                    last_checkpoint = time.monotonic()
+                    return serialize_embeddings(embedded)
+
+        # The progress is tracked in memory and only written to the database
+        # from time to time. Closing the generator stops the downloads if the
+        # job is cancelled.
+        tracker = ProgressTracker(id, len(new_urls), job)
+        try:
+            with contextlib.closing(
+                iter_preprocessed_images(
+                    new_urls, vis_processors["eval"], cache=cache, lookup=lookup
                 )
+            ) as images:
+                for i, (index, image, content_hash, cached) in enumerate(images):
+                    if cached is not None:
+                        embedded[new_urls[index]] = torch.from_numpy(cached)
+                        content_hashes[new_urls[index]] = content_hash
+                    elif image is not None:
+                        batch_images.append(image.unsqueeze(0).to(device))
+                        batch_indices.append(index)
+                        content_hashes[new_urls[index]] = content_hash
 
-                actual_content.append(content)
-                record_progress(id, int((i + 1) / len(content_list) * 100))
-            except urllib.error.URLError:
-                print(f"Could not download image {content[0]}")
+                    checkpoint = None
+                    if len(batch_images) == batch_size:
+                        checkpoint = _embed_batch()
+                    tracker.update(i + 1, checkpoint)
 
-        all_feature_df = pd.DataFrame(parquet_feature_tensor.cpu().numpy())
-        parquet_file = io.BytesIO()
-        all_feature_df.to_parquet(parquet_file)
-        parquet_file.seek(0)
+            if batch_images:
+                _embed_batch()
+        finally:
+            tracker.close()
 
-        row_with_data.parquet_data = parquet_file.read()
-        row_with_data.content = actual_content
+        # Assemble the features in the order of the collection content. Rows
+        # whose image could not be downloaded are dropped from the collection.
+        feature_list = [] if known_features is None else [known_features]
+        offset = 0 if known_features is None else known_features.shape[0]
+        all_urls = dict(known_urls)
+        for row, url in enumerate(embedded, start=offset):
+            all_urls[url] = row
+        if embedded:
+            feature_list.append(torch.stack(list(embedded.values())))
 
+        actual_urls = [url for _, url in entries if url in all_urls]
+        if actual_urls:
+            feature_rows = torch.tensor([all_urls[url] for url in actual_urls])
+            feature_tensor = normalize_embeddings(torch.cat(feature_list)[feature_rows])
+        else:
+            feature_tensor = torch.empty((0, 0))
+
+        # The embeddings are written to new files, the database only
+        # references them. Large collections are searched through an
+        # approximate index that is stored next to the embeddings.
+        path = write_embeddings(id, feature_tensor.numpy(), actual_urls)
+        if len(actual_urls) >= ann_min_size():
+            IVFIndex.build(feature_tensor.numpy()).save(auxiliary_file(path, "ann.npz"))
+
+        # Collections can be searched on quantized embeddings to save memory
+        if coll.embedding_dtype not in (None, "float32"):
+            values, scales = quantize(feature_tensor.numpy(), coll.embedding_dtype)
+            np.save(auxiliary_file(path, f"{coll.embedding_dtype}.npy"), values)
+            if scales is not None:
+                np.save(auxiliary_file(path, "scales.npy"), scales)
+
+        row_with_data.embedding_path = path
+        row_with_data.embedding_count = len(actual_urls)
+        row_with_data.normalized = True
+        row_with_data.embedding_model = model_name
+        update_embedding_status(
+            embedded=[entry for entry, url in entries if url in all_urls],
+            failed=[entry for entry, url in entries if url not in all_urls],
+            content_hashes={
+                entry: content_hashes[url]
+                for entry, url in entries
+                if url in content_hashes
+            },
+        )
         coll.finetuning_progess = None
         coll.last_finetuned = datetime.now(timezone.utc)
         db.session.commit()
 
+        # Processes that still map the old files keep them until they unmap
+        remove_embeddings(old_path)
+
+        if cache is not None:
+            cache.evict()
 
-def similarity_search(id: str, images: list, num_limit=5, precision_thr=0.0):
-    """Search for similar images in a given collection."""
+
+def _read_collection_features(id: str):
+    """Read the features of a collection from its embedding files.
+
+    The exact features are memory-mapped copy-on-write, so that on the CPU no
+    copy of them is made and pages are only read from disk when they are
+    used. If quantized features were written, only those are loaded into
+    memory and the exact features are used for re-ranking.
+    """
+
+    device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
+    path, normalized = (
+        db.session.query(Images.embedding_path, Images.normalized)
+        .where(Images.collection == id)
+        .one()
+    )
+    if path is None:
+        return None
+
+    exact, keys = load_embeddings(path, mmap_mode="c")
+    if not normalized:
+        # Embeddings written by older versions are normalized when loading
+        exact = normalize_embeddings(torch.from_numpy(exact)).numpy()
+    features = QuantizedFeatures(torch.from_numpy(exact).to(device).contiguous())
+    for dtype in ("int8", "float16"):
+        if os.path.exists(auxiliary_file(path, f"{dtype}.npy")):
+            scales = None
+            if os.path.exists(auxiliary_file(path, "scales.npy")):
+                scales = torch.from_numpy(np.load(auxiliary_file(path, "scales.npy")))
+                scales = scales.to(device)
+            values = torch.from_numpy(np.load(auxiliary_file(path, f"{dtype}.npy")))
+            features = QuantizedFeatures(values.to(device), scales, exact)
+            break
+
+    index = None
+    index_file = auxiliary_file(path, "ann.npz")
+    if os.path.exists(index_file):
+        index = IVFIndex.load(index_file)
+
+    return features, keys, index
+
+
+def _collection_features_size(value) -> int:
+    """The memory used by the cached features of a collection in bytes."""
+
+    features, keys, index = value
+    size = features.nbytes + sum(sys.getsizeof(key) for key in keys)
+    if index is not None:
+        size += index.centroids.nbytes + index.order.nbytes
+    return size
+
+
+def load_collection_features(id: str):
+    """Get the features, the image URLs of their rows and the ANN index of a collection.
+
+    The decoded features are kept in the process-level feature cache until
+    the collection is finetuned again. Returns None if the collection was not
+    finetuned yet.
+
+    :raises ValueError: If the features were computed by a different model
+        than the loaded one, so that queries cannot be compared to them.
+    """
+
+    (last_finetuned,) = (
+        db.session.query(Collection.last_finetuned).where(Collection.id == id).one()
+    )
+    (embedding_model,) = (
+        db.session.query(Images.embedding_model).where(Images.collection == id).one()
+    )
+    if last_finetuned is not None and not embedding_model_matches(embedding_model):
+        raise ValueError(
+            f"Collection with id={id} was finetuned with a different model "
+            "and needs to be finetuned again"
+        )
+    return feature_cache.get(
+        str(id),
+        last_finetuned,
+        lambda: _read_collection_features(id),
+        _collection_features_size,
+    )
+
+
+def top_k_matches(scores: torch.Tensor, num_limit: int, precision_thr: float):
+    """Select the best matches from a matrix of similarity scores.
+
+    :param scores: The similarity scores with one row per query image and
+        one column per image in the collection.
+    :param num_limit: The maximum number of matches per query image.
+    :param precision_thr: The minimum score of a match.
+    :returns: A list with one list of ``(index, score)`` tuples per query
+        image, in descending order of score.
+    """
+
+    # topk returns sorted values, so the threshold only cuts off a tail
+    values, indices = torch.topk(scores, min(num_limit, scores.shape[-1]), dim=-1)
+    keep = values >= precision_thr
+
+    return [
+        [(index, value) for index, value, k in zip(*row) if k]
+        for row in zip(indices.tolist(), values.tolist(), keep.tolist())
+    ]
+
+
+def quantized_matches(
+    features: QuantizedFeatures,
+    queries: torch.Tensor,
+    num_limit: int,
+    precision_thr: float,
+):
+    """Select the best matches by scoring the (possibly quantized) features.
+
+    For quantized features, the best ``num_limit * rerank_factor()``
+    candidates are re-ranked with their exact features. The result has the
+    same format as :func:`top_k_matches`.
+    """
+
+    scores = features.scores(queries)
+    factor = rerank_factor()
+    if features.exact is None or factor == 0:
+        return top_k_matches(scores, num_limit, precision_thr)
+
+    _, rows = torch.topk(scores, min(num_limit * factor, len(features)), dim=-1)
+    exact_scores = features.exact_scores(queries, rows)
+    return [
+        [(candidates[i], score) for i, score in matches]
+        for candidates, matches in zip(
+            rows.tolist(), top_k_matches(exact_scores, num_limit, precision_thr)
+        )
+    ]
+
+
+def ann_matches(
+    index: IVFIndex,
+    features: np.ndarray,
+    queries: torch.Tensor,
+    num_limit: int,
+    precision_thr: float,
+):
+    """Select the best matches through an approximate nearest neighbour index.
+
+    The result has the same format as :func:`top_k_matches`.
+    """
+
+    indices, scores = index.search(features, queries.cpu().numpy(), num_limit)
+    return [
+        [(i, s) for i, s in zip(row.tolist(), values.tolist()) if s >= precision_thr]
+        for row, values in zip(indices, scores)
+    ]
+
+
+def _embed_queries(images: list) -> torch.Tensor:
+    return normalize_embeddings(extract_features(images, model))
+
+
+# Query images of concurrent searches are embedded together
+query_batcher = MicroBatcher(
+    _embed_queries, search_batch_size(), search_batch_wait(), concatenate=torch.cat
+)
+
+
+def embed_images(images: list):
+    """Embed a list of encoded images (e.g. PNG or JPEG bytes).
+
+    The images are decoded in the calling thread. The forward pass goes
+    through the query batcher, which embeds the images of concurrent
+    requests in one batch and splits large requests into several. The
+    embeddings are L2-normalized like the stored embeddings, so that the
+    search scores are cosine similarities.
+    """
 
     global model, vis_processors
+    load_model_and_vis_preprocess()
     device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
     preprocessed_image = [
         vis_processors["eval"](Image.open(io.BytesIO(img)).convert("RGB"))
@@ -106,46 +571,107 @@ def similarity_search(id: str, images: list, num_limit=5, precision_thr=0.0):
         .to(device)
         for img in images
     ]
-    multi_features_stacked = extract_features(preprocessed_image, model)
+    return query_batcher(preprocessed_image)
 
-    # Load features for the collection from the database
-    images_data = Images.query.filter(Images.collection == id).one()
 
-    if images_data.parquet_data is not None:
-        feature_df = pd.read_parquet(io.BytesIO(images_data.parquet_data))
-        features_tensor = torch.tensor(feature_df.values).to(device)
-    else:
+def search_collection(id: str, queries: torch.Tensor, num_limit=5, precision_thr=0.0):
+    """Search a collection with already embedded query images.
+
+    Returns one list of results per query image or None if the collection
+    was not finetuned yet.
+    """
+
+    # Load features for the collection from the cache or the database
+    collection_features = load_collection_features(id)
+    if collection_features is None:
         return
+    features, keys, index = collection_features
 
-    # calculate similarity scores, filter and sort them
-    similarity_scores = torch.matmul(
-        features_tensor, multi_features_stacked.unsqueeze(-1)
-    ).squeeze()
-    if len(feature_df) == 1:
-        return [
-            {
-                "image_url": images_data.content[0][0],
-                "repo_url": images_data.content[0][1],
-                "score": similarity_scores.item(),
-            }
-        ]
+    # Nothing to compare against in an empty collection
+    if len(features) == 0:
+        return [[] for _ in range(queries.shape[0])]
 
-    similar_image_indices = torch.nonzero(
-        similarity_scores >= precision_thr, as_tuple=True
-    )
-    sorted_indices = sorted(
-        similar_image_indices[0], key=lambda x: similarity_scores[x], reverse=True
-    )
+    # Calculate similarity scores and select the best matches. The index
+    # scores the exact features, which are memory-mapped.
+    if index is not None and len(features) >= ann_min_size():
+        exact = features.exact
+        if exact is None:
+            exact = features.values.cpu().numpy()
+        matches = ann_matches(index, exact, queries, num_limit, precision_thr)
+    else:
+        matches = quantized_matches(features, queries, num_limit, precision_thr)
 
-    # Get the IDs of the most similar images
-    most_similar_images = []
-    for i in sorted_indices[:num_limit]:
-        most_similar_images.append(
-            {
-                "image_url": images_data.content[i][0],
-                "repo_url": images_data.content[i][1],
-                "score": similarity_scores[i].item(),
-            }
+    # Look up only the matched images. Images that were removed since the
+    # last finetuning are skipped.
+    urls = list({keys[i] for query_matches in matches for i, _ in query_matches})
+    repo_urls = {}
+    for start in range(0, len(urls), 500):
+        repo_urls.update(
+            db.session.query(ImageEntry.image_url, ImageEntry.repo_url).where(
+                ImageEntry.collection == id,
+                ImageEntry.image_url.in_(urls[start : start + 500]),
+            )
         )
 
-    return most_similar_images
+    return [
+        [
+            {"image_url": keys[i], "repo_url": repo_urls[keys[i]], "score": score}
+            for i, score in query_matches
+            if keys[i] in repo_urls
+        ]
+        for query_matches in matches
+    ]
+
+
+def similarity_search(id: str, images: list, num_limit=5, precision_thr=0.0):
+    """Search for similar images in a given collection."""
+
+    results = search_collection(id, embed_images(images), num_limit, precision_thr)
+    if results is None:
+        return
+
+    # The route searches with a single image, return the matches for it
+    return results[0]
+
+
+def batch_similarity_search(
+    ids: list, images: list, num_limit=5, precision_thr=0.0
+) -> tuple:
+    """Search for similar images of several query images in several collections.
+
+    All query images are embedded together and each collection is scored
+    with one matrix product.
+
+    :returns: A tuple of one list of the overall best results per query
+        image, where each result also names its collection, and a list of
+        the collections that were skipped, each with the reason why.
+    """
+
+    queries = embed_images(images)
+    results = [[] for _ in images]
+    skipped = []
+    for id in ids:
+        try:
+            collection_results = search_collection(
+                id, queries, num_limit, precision_thr
+            )
+        except ValueError as e:
+            skipped.append({"collection": int(id), "message": str(e)})
+            continue
+        if collection_results is None:
+            skipped.append(
+                {
+                    "collection": int(id),
+                    "message": f"Collection with id={id} was not finetuned yet",
+                }
+            )
+            continue
+
+        for query_results, matches in zip(results, collection_results):
+            query_results.extend(dict(match, collection=int(id)) for match in matches)
+
+    results = [
+        sorted(query_results, key=lambda r: r["score"], reverse=True)[:num_limit]
+        for query_results in results
+    ]
+    return results, skipped
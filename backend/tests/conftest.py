@@ -1,15 +1,31 @@
 from similarity_webservice.app import create_app
+from similarity_webservice.jobs import stop_job_workers
 from similarity_webservice.model import add_new_apikey, add_collection
 from click.testing import CliRunner
+from PIL import Image, ImageOps
+
+import functools
+import http.server
+import json
+import os
+import threading
+import types
+import urllib.parse
 
 import pytest
 
 
+# The image of the test directory, which is used as a query in search tests
+TEST_IMAGE = os.path.join(os.path.dirname(__file__), "dum_similarity_img.png")
+
+
 @pytest.fixture()
 def app(monkeypatch, tmp_path):
     monkeypatch.setenv(
         "SQLALCHEMY_DATABASE_URI", f"sqlite:///{str(tmp_path)}/similarity_webservice.db"
     )
+    monkeypatch.setenv("SIMILARITY_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
 
     app = create_app()
 
@@ -21,6 +37,8 @@ def app(monkeypatch, tmp_path):
 
     yield app
 
+    stop_job_workers(app)
+
 
 @pytest.fixture()
 def client(app):
@@ -44,3 +62,163 @@ def app_context(app):
 @pytest.fixture()
 def runner(app_context):
     return CliRunner()
+
+
+class FakeEasyDB:
+    """A local stand-in for the parts of the EasyDB API that we use."""
+
+    def __init__(self, size: int):
+        self.tags = [
+            {
+                "_basetype": "taggroup",
+                "_tags": [
+                    {
+                        "_basetype": "tag",
+                        "tag": {"_id": 42, "displayname": {"de-DE": "Testtag"}},
+                    }
+                ],
+            }
+        ]
+        self.objects = [self.make_object(i) for i in range(size)]
+        self.requests = []
+        self.failures = 0
+
+        # The number of objects that were returned with all their data
+        self.full_objects = 0
+
+    def make_object(self, id: int, version: int = 1, image: str = "") -> dict:
+        return {
+            "_objecttype": "ressourcen",
+            "_system_object_id": id,
+            "ressourcen": {
+                "_id": id,
+                "_version": version,
+                "asset": [
+                    {
+                        "versions": {
+                            "full": {"status": "failed"},
+                            "small": {
+                                "status": "done",
+                                "download_url": f"https://easydb.test/{id}{image}.jpg",
+                            },
+                        }
+                    }
+                ],
+            },
+        }
+
+    def handle(self, method: str, path: str, body: dict):
+        self.requests.append(path)
+        if path == "/api/session":
+            return {"token": "token"}
+        if path == "/api/session/authenticate":
+            return {}
+        if path == "/api/tags":
+            return self.tags
+        if path == "/api/search" and method == "POST":
+            search = body["search"][0]
+            if search["fields"] == ["_system_object_id"]:
+                objects = [
+                    o for o in self.objects if o["_system_object_id"] in search["in"]
+                ]
+            elif search["in"] == [42]:
+                objects = self.objects
+            else:
+                objects = []
+
+            count = len(objects)
+            offset, limit = body.get("offset", 0), body.get("limit", 0)
+            objects = objects[offset : offset + limit]
+            if body.get("format") == "short":
+                objects = [
+                    {
+                        "_objecttype": o["_objecttype"],
+                        "_system_object_id": o["_system_object_id"],
+                        "ressourcen": {
+                            key: value
+                            for key, value in o["ressourcen"].items()
+                            if key in ("_id", "_version")
+                        },
+                    }
+                    for o in objects
+                ]
+            else:
+                self.full_objects += len(objects)
+            return {"count": count, "objects": objects}
+
+
+@pytest.fixture()
+def easydb_server(monkeypatch):
+    easydb = FakeEasyDB(2500)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def _respond(self, method):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length)) if length else {}
+            result = None
+            if easydb.failures > 0:
+                easydb.failures -= 1
+            else:
+                path = urllib.parse.urlparse(self.path).path
+                result = easydb.handle(method, path, body)
+
+            if result is None:
+                self.send_response(503)
+                self.end_headers()
+                return
+
+            data = json.dumps(result).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._respond("GET")
+
+        def do_POST(self):
+            self._respond("POST")
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setenv(
+        "SIMILARITY_HEIDICON_URL", f"http://127.0.0.1:{server.server_address[1]}"
+    )
+    yield easydb
+
+    server.shutdown()
+
+
+@pytest.fixture()
+def image_urls(tmp_path):
+    """Serve a few distinct images locally, so that finetuning runs offline."""
+
+    directory = tmp_path / "images"
+    directory.mkdir()
+    image = Image.open(TEST_IMAGE).convert("RGB")
+    image.save(directory / "dummyuser.png")
+    image.rotate(90, expand=True).save(directory / "liam.jpeg")
+    ImageOps.invert(image).save(directory / "inga.jpeg")
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(Handler, directory=str(directory))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield types.SimpleNamespace(
+        dummy=f"{url}/dummyuser.png", liam=f"{url}/liam.jpeg", inga=f"{url}/inga.jpeg"
+    )
+
+    server.shutdown()
@@ -0,0 +1,36 @@
+from similarity_webservice.ann import IVFIndex, clustered_vectors, recall_at_k
+
+import numpy as np
+
+
+def test_ivf_recall():
+    data = clustered_vectors(5100, 64, clusters=50)
+    features, queries = data[:5000], data[5000:]
+
+    index = IVFIndex.build(features)
+    assert recall_at_k(index, features, queries, 10, n_probe=8) > 0.9
+
+    # Probing all lists is an exact search
+    assert recall_at_k(index, features, queries, 10, n_probe=1000) == 1.0
+
+
+def test_ivf_search_order():
+    features = clustered_vectors(1000, 16, clusters=10)
+    index = IVFIndex.build(features, n_lists=10)
+
+    indices, scores = index.search(features, features[:3], 5, n_probe=2)
+    for i, (row, values) in enumerate(zip(indices, scores)):
+        assert row[0] == i
+        assert np.all(np.diff(values) <= 0)
+        assert np.allclose(values, features[row] @ features[i])
+
+
+def test_ivf_serialization(tmp_path):
+    features = clustered_vectors(1000, 16, clusters=10)
+    index = IVFIndex.build(features)
+    index.save(tmp_path / "index.npz")
+    loaded = IVFIndex.load(tmp_path / "index.npz")
+
+    assert np.array_equal(index.centroids, loaded.centroids)
+    assert np.array_equal(index.order, loaded.order)
+    assert np.array_equal(index.offsets, loaded.offsets)
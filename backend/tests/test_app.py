@@ -1,5 +1,13 @@
+from similarity_webservice.jobs import stop_job_workers
+from similarity_webservice.loading import wait_for_model
+from similarity_webservice.model import db, Job, claim_job, enqueue_job
+import similarity_webservice.app as app_module
+import similarity_webservice.model as model_module
+
 import os
 import base64
+import subprocess
+import sys
 
 
 def test_verify(client, apikey):
@@ -47,6 +55,35 @@ def test_create_collection_missing_name(client, apikey):
     assert res.status_code == 400
 
 
+def test_create_collection_invalid_dtype(client, apikey):
+    res = client.post(
+        "/api/collection/create",
+        json={"name": "newcollection", "embedding_dtype": "int4"},
+        headers={"API-Key": apikey},
+    )
+    assert res.status_code == 400
+
+
+def test_update_dtype_collection(client, apikey):
+    res = client.post(
+        "/api/collection/1/updatedtype",
+        json={"embedding_dtype": "int8"},
+        headers={"API-Key": apikey},
+    )
+    assert res.status_code == 200
+
+    res = client.get("/api/collection/1/info")
+    assert res.status_code == 200
+    assert res.json["embedding_dtype"] == "int8"
+
+    res = client.post(
+        "/api/collection/1/updatedtype",
+        json={"embedding_dtype": "int4"},
+        headers={"API-Key": apikey},
+    )
+    assert res.status_code == 400
+
+
 def test_delete_collection(client, apikey):
     res = client.post("/api/collection/1/delete", headers={"API-Key": apikey})
     assert res.status_code == 200
@@ -83,6 +120,18 @@ def test_update_name_collection_invalid_id(client, apikey):
     assert res.status_code == 400
 
 
+def test_progress_collection(client):
+    res = client.get("/api/collection/1/progress")
+    assert res.status_code == 200
+    assert res.json["running"] is False
+    assert res.json["progress"] is None
+
+
+def test_progress_collection_invalid_id(client):
+    res = client.get("/api/collection/112/progress")
+    assert res.status_code == 400
+
+
 def test_update_collection(client, apikey):
     res = client.post(
         "/api/collection/1/updatecontent",
@@ -95,6 +144,25 @@ def test_update_collection(client, apikey):
     assert res.status_code == 200
 
 
+def test_update_heidicon_collection(app, client, apikey, easydb_server):
+    stop_job_workers(app)
+    res = client.post(
+        "/api/collection/create",
+        json={"name": "heidicon", "heidicon_tag": "Testtag"},
+        headers={"API-Key": apikey},
+    )
+    assert res.status_code == 200
+    id = res.json["id"]
+
+    # The update is queued as a job instead of blocking the request
+    res = client.post(
+        f"/api/collection/{id}/updatecontent", headers={"API-Key": apikey}
+    )
+    assert res.status_code == 200
+    res = client.get(f"/api/job/{res.json['job']}")
+    assert (res.json["kind"], res.json["status"]) == ("sync", "queued")
+
+
 def test_update_collection_invalid_id(client, apikey):
     res = client.post(
         "/api/collection/700/updatecontent",
@@ -104,6 +172,58 @@ def test_update_collection_invalid_id(client, apikey):
     assert res.status_code == 400
 
 
+def test_update_collection_quoted_content(client, apikey):
+    # Fields are parsed as CSV, like in the content routes
+    content = 'a.png,"https://repo.test/?ids=1,2"\n\nb.png, b\n'
+    res = client.post(
+        "/api/collection/1/updatecontent", data=content, headers={"API-Key": apikey}
+    )
+    assert res.status_code == 200
+
+    res = client.get("/api/collection/1/csvfile")
+    assert res.data.decode("utf-8").splitlines() == [
+        'a.png,"https://repo.test/?ids=1,2"',
+        "b.png,b",
+    ]
+
+
+def test_edit_collection_content(client, apikey):
+    headers = {"API-Key": apikey}
+    res = client.post(
+        "/api/collection/1/content/append",
+        headers=headers,
+        data="a.png, a\nb.png, b\n\nc.png, c\n",
+    )
+    assert res.status_code == 200
+    assert res.json["added"] == 3
+
+    res = client.post(
+        "/api/collection/1/content/patch",
+        headers=headers,
+        data="b.png, b2\nd.png, d\n",
+    )
+    assert res.status_code == 200
+    assert (res.json["updated"], res.json["added"]) == (1, 1)
+
+    res = client.post(
+        "/api/collection/1/content/remove", headers=headers, data="a.png\nx.png\n"
+    )
+    assert res.status_code == 200
+    assert res.json["removed"] == 1
+
+    res = client.get("/api/collection/1/csvfile")
+    assert res.data.decode("utf-8").splitlines() == ["b.png,b2", "c.png,c", "d.png,d"]
+
+
+def test_edit_collection_content_invalid(client, apikey):
+    headers = {"API-Key": apikey}
+    res = client.post("/api/collection/700/content/append", headers=headers, data="")
+    assert res.status_code == 400
+
+    res = client.post("/api/collection/1/content/replace", headers=headers, data="")
+    assert res.status_code == 404
+
+
 def test_csvfile_download(client):
     res = client.get("/api/collection/1/csvfile")
     assert res.status_code == 200
@@ -111,6 +231,39 @@ def test_csvfile_download(client):
     assert res.headers["Content-Disposition"] == "attachment; filename=collection1.csv"
 
 
+def test_csvfile_download_content(client, apikey):
+    content = "\n".join(
+        f"https://example.org/{i}.png, https://example.org/{i}" for i in range(2500)
+    )
+    res = client.post(
+        "/api/collection/1/updatecontent", headers={"API-Key": apikey}, data=content
+    )
+    assert res.status_code == 200
+
+    res = client.get("/api/collection/1/csvfile")
+    assert res.status_code == 200
+    assert res.is_streamed
+    lines = res.data.decode("utf-8").splitlines()
+    assert len(lines) == 2500
+    assert lines[1] == "https://example.org/1.png,https://example.org/1"
+
+
+def test_csvfile_download_unicode_name(client, apikey):
+    res = client.post(
+        "/api/collection/1/updatename",
+        json={"name": "Sammlung Käfer"},
+        headers={"API-Key": apikey},
+    )
+    assert res.status_code == 200
+
+    res = client.get("/api/collection/1/csvfile")
+    assert res.status_code == 200
+    assert (
+        "filename*=UTF-8''Sammlung%20K%C3%A4fer.csv"
+        in res.headers["Content-Disposition"]
+    )
+
+
 def test_csvfile_download_invalid_id(client):
     res = client.get("/api/collection/5/csvfile")
     assert res.status_code == 400
@@ -125,6 +278,60 @@ def test_finetune_collection(client, apikey):
     assert res.status_code == 200
 
 
+def test_finetune_collection_dedup_and_cancel(app, client, apikey):
+    # Keep the jobs in the queue
+    stop_job_workers(app)
+
+    res = client.post("/api/collection/1/finetune", headers={"API-Key": apikey})
+    assert res.status_code == 200
+    job = res.json["job"]
+
+    # Finetuning the same collection again does not queue another job
+    res = client.post("/api/collection/1/finetune", headers={"API-Key": apikey})
+    assert res.json["job"] == job
+
+    res = client.get(f"/api/job/{job}")
+    assert res.status_code == 200
+    assert res.json["status"] == "queued"
+    assert res.json["collection"] == 1
+
+    res = client.post("/api/collection/1/finetune/cancel", headers={"API-Key": apikey})
+    assert res.status_code == 200
+    assert res.json["jobs"] == [job]
+
+    res = client.get(f"/api/job/{job}")
+    assert res.json["status"] == "cancelled"
+
+    # After cancellation, a new job can be queued
+    res = client.post("/api/collection/1/finetune", headers={"API-Key": apikey})
+    assert res.json["job"] != job
+
+
+def test_claim_job_race(app, monkeypatch):
+    stop_job_workers(app)
+
+    with app.app_context():
+        finetune = enqueue_job(1)
+        sync = enqueue_job(1, "sync")
+
+        # Another process claims the sync job while this one is claiming
+        def _worker_name():
+            db.session.execute(
+                db.update(Job).where(Job.id == sync.id).values(status="running")
+            )
+            return "other:1"
+
+        monkeypatch.setattr(model_module, "worker_name", _worker_name)
+        assert claim_job() is None
+        db.session.refresh(finetune)
+        assert finetune.status == "queued"
+
+
+def test_job_info_invalid_id(client):
+    res = client.get("/api/job/112")
+    assert res.status_code == 400
+
+
 def test_finetune_collection_invalid_id(client, apikey):
     res = client.post(
         "/api/collection/112/finetune",
@@ -145,6 +352,65 @@ def test_similarity_search(client):
     assert res.status_code == 200
 
 
+def test_ready(client):
+    assert wait_for_model()
+    res = client.get("/api/ready")
+    assert res.status_code == 200
+    assert res.json["state"] == "ready"
+    assert res.json["load_time"] is not None
+
+
+def test_search_while_model_loading(client, monkeypatch):
+    monkeypatch.setattr(app_module, "wait_for_model", lambda timeout: False)
+    monkeypatch.setattr(
+        app_module,
+        "model_status",
+        lambda: {"state": "loading", "error": None, "load_time": None},
+    )
+
+    res = client.get("/api/ready")
+    assert res.status_code == 503
+    assert res.json["state"] == "loading"
+
+    # Searches are rejected, but other routes are served
+    res = client.post("/api/collection/1/search", data=b"")
+    assert res.status_code == 503
+    assert res.headers["Retry-After"]
+    res = client.get("/api/collection/list")
+    assert res.status_code == 200
+
+
+def test_preloaded_worker(app, monkeypatch):
+    monkeypatch.setenv("SIMILARITY_PRELOAD_MODEL", "1")
+    preloaded = app_module.create_app()
+
+    # The job workers are only started in the forked worker processes
+    assert "similarity_jobs" not in preloaded.extensions
+    app_module.init_forked_worker(preloaded)
+    assert "similarity_jobs" in preloaded.extensions
+    assert wait_for_model()
+    stop_job_workers(preloaded)
+
+
+def test_preload_failure(app, monkeypatch):
+    from similarity_webservice import vision
+
+    def _fail():
+        raise RuntimeError("out of memory")
+
+    # The service starts even if the model cannot be preloaded
+    monkeypatch.setenv("SIMILARITY_PRELOAD_MODEL", "1")
+    monkeypatch.setattr(vision, "load_model_and_vis_preprocess", _fail)
+    preloaded = app_module.create_app()
+    assert "similarity_jobs" not in preloaded.extensions
+
+
+def test_import_does_not_load_torch():
+    code = "import sys, similarity_webservice.app; print('torch' in sys.modules)"
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+    assert output.strip() == "False"
+
+
 def test_similarity_search_invalid_id(client):
     image_path = os.path.join(os.path.dirname(__file__), "dum_similarity_img.png")
     with open(image_path, "rb") as img_file:
@@ -154,3 +420,66 @@ def test_similarity_search_invalid_id(client):
     encoded_image = base64.b64encode(image_data)
     res = client.post("/api/collection/112/search", data=encoded_image)
     assert res.status_code == 400
+
+
+def test_batch_search(client):
+    image_path = os.path.join(os.path.dirname(__file__), "dum_similarity_img.png")
+    with open(image_path, "rb") as img_file:
+        encoded_image = base64.b64encode(img_file.read()).decode("utf-8")
+
+    res = client.post(
+        "/api/search",
+        json={"images": [encoded_image, encoded_image], "collections": [1, 2]},
+    )
+    assert res.status_code == 200
+    assert res.json["results"] == [[], []]
+
+    # The collections were not finetuned yet
+    assert [r["collection"] for r in res.json["skipped"]] == [1, 2]
+
+
+def test_batch_search_invalid_id(client):
+    image_path = os.path.join(os.path.dirname(__file__), "dum_similarity_img.png")
+    with open(image_path, "rb") as img_file:
+        encoded_image = base64.b64encode(img_file.read()).decode("utf-8")
+
+    res = client.post(
+        "/api/search", json={"images": [encoded_image], "collections": [1, 112]}
+    )
+    assert res.status_code == 400
+
+
+def test_batch_search_missing_images(client):
+    res = client.post("/api/search", json={"collections": [1]})
+    assert res.status_code == 400
+
+
+def test_batch_search_invalid_payload(client):
+    for payload in [
+        {"images": "image", "collections": [1]},
+        {"images": ["image"], "collections": 1},
+        {"images": [1], "collections": [1]},
+        {"images": ["image"], "collections": [{"id": 1}]},
+        ["image"],
+    ]:
+        res = client.post("/api/search", json=payload)
+        assert res.status_code == 400
+
+
+def test_search_negative_num_results(client):
+    image_path = os.path.join(os.path.dirname(__file__), "dum_similarity_img.png")
+    with open(image_path, "rb") as img_file:
+        encoded_image = base64.b64encode(img_file.read())
+
+    res = client.post("/api/collection/1/search?num_results=-1", data=encoded_image)
+    assert res.status_code == 400
+
+    res = client.post(
+        "/api/search",
+        json={
+            "images": [encoded_image.decode("utf-8")],
+            "collections": [1],
+            "num_results": -1,
+        },
+    )
+    assert res.status_code == 400
@@ -1,4 +1,21 @@
 from similarity_webservice.auth import *
+from similarity_webservice.model import ApiKey, api_key_lookup, db
+import similarity_webservice.model as model
+
+
+class CountingHasher:
+    """Wraps the password hasher to count the argon2 verifications."""
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+        self.calls = 0
+
+    def verify(self, *args):
+        self.calls += 1
+        return self.hasher.verify(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.hasher, name)
 
 
 def test_missing_key(client):
@@ -49,3 +66,46 @@ def test_delete_key(runner, apikey):
     # Delete invalid apikey
     result = runner.invoke(delete, ["1"])
     assert result.exit_code == 0
+
+
+def test_wrong_key_skips_hashing(client, apikey, monkeypatch):
+    hasher = CountingHasher(model.ph)
+    monkeypatch.setattr(model, "ph", hasher)
+
+    res = client.post("/api/verify", headers={"API-Key": "wrongkey"})
+    assert res.status_code == 403
+    assert hasher.calls == 0
+
+
+def test_cached_key(client, apikey, monkeypatch):
+    res = client.post("/api/verify", headers={"API-Key": apikey})
+    assert res.status_code == 200
+
+    # The second request is served from the cache
+    hasher = CountingHasher(model.ph)
+    monkeypatch.setattr(model, "ph", hasher)
+    res = client.post("/api/verify", headers={"API-Key": apikey})
+    assert res.status_code == 200
+    assert hasher.calls == 0
+
+
+def test_deleted_key_not_cached(app, client, apikey, runner):
+    res = client.post("/api/verify", headers={"API-Key": apikey})
+    assert res.status_code == 200
+
+    result = runner.invoke(delete, ["1"])
+    assert result.exit_code == 0
+
+    res = client.post("/api/verify", headers={"API-Key": apikey})
+    assert res.status_code == 403
+
+
+def test_legacy_key_without_lookup(client, apikey, app_context):
+    # Keys created before lookup identifiers existed are still accepted
+    key = ApiKey.query.one()
+    key.lookup = None
+    db.session.commit()
+
+    res = client.post("/api/verify", headers={"API-Key": apikey})
+    assert res.status_code == 200
+    assert ApiKey.query.one().lookup == api_key_lookup(apikey)
@@ -0,0 +1,72 @@
+from similarity_webservice.batching import MicroBatcher
+
+import concurrent.futures
+import threading
+
+import pytest
+
+
+def test_micro_batcher_gathers_requests():
+    batches = []
+    started = threading.Event()
+
+    def _double(inputs):
+        batches.append(list(inputs))
+        started.wait()
+        return [2 * x for x in inputs]
+
+    batcher = MicroBatcher(_double, max_batch_size=4, max_wait=0.5)
+
+    # While the first (full) batch is processed, the other requests queue up
+    first = batcher.submit([0, 0, 0, 0])
+    futures = [batcher.submit([i, i + 1]) for i in range(1, 7, 2)]
+    started.set()
+
+    assert first.result() == [0, 0, 0, 0]
+    assert [f.result() for f in futures] == [[2, 4], [6, 8], [10, 12]]
+
+    # Small requests are not split and batches do not exceed the maximum size
+    assert batches[0] == [0, 0, 0, 0]
+    assert batches[1:] == [[1, 2, 3, 4], [5, 6]]
+
+
+def test_micro_batcher_splits_large_requests():
+    batches = []
+    started = threading.Event()
+
+    def _double(inputs):
+        batches.append(list(inputs))
+        started.wait()
+        return [2 * x for x in inputs]
+
+    batcher = MicroBatcher(_double, max_batch_size=4, max_wait=0.01)
+
+    # A small request that is submitted while the large one is processed
+    # does not wait for all of its chunks
+    large = batcher.submit(list(range(10)))
+    small = batcher.submit([100])
+    started.set()
+
+    assert large.result() == [2 * x for x in range(10)]
+    assert small.result() == [200]
+    assert batches[0] == [0, 1, 2, 3]
+    assert 100 in batches[1]
+    assert max(len(batch) for batch in batches) == 4
+
+
+def test_micro_batcher_concurrent_callers():
+    batcher = MicroBatcher(lambda inputs: list(inputs), max_batch_size=8, max_wait=0.01)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(lambda i: batcher([i]), range(100)))
+
+    assert results == [[i] for i in range(100)]
+
+
+def test_micro_batcher_exceptions():
+    def _fail(inputs):
+        raise ValueError("broken")
+
+    batcher = MicroBatcher(_fail, max_batch_size=8, max_wait=0.01)
+    with pytest.raises(ValueError):
+        batcher([1])
@@ -0,0 +1,48 @@
+from similarity_webservice.cache import FeatureCache
+
+
+def test_cache_hit():
+    cache = FeatureCache(100)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return "value"
+
+    assert cache.get("a", 1, loader, len) == "value"
+    assert cache.get("a", 1, loader, len) == "value"
+    assert len(loads) == 1
+
+
+def test_cache_version_invalidates():
+    cache = FeatureCache(100)
+    assert cache.get("a", 1, lambda: "old", len) == "old"
+    assert cache.get("a", 2, lambda: "new", len) == "new"
+    assert cache.size == 3
+
+
+def test_cache_lru_eviction():
+    cache = FeatureCache(10)
+    cache.get("a", 1, lambda: "aaaa", len)
+    cache.get("b", 1, lambda: "bbbb", len)
+
+    # Touch a, so that b is the least recently used entry
+    cache.get("a", 1, lambda: "xxxx", len)
+    cache.get("c", 1, lambda: "cccc", len)
+
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.size == 8
+
+
+def test_cache_too_large_value():
+    cache = FeatureCache(2)
+    assert cache.get("a", 1, lambda: "aaaa", len) == "aaaa"
+    assert cache.size == 0
+
+
+def test_cache_invalidate():
+    cache = FeatureCache(10)
+    cache.get("a", 1, lambda: "aaaa", len)
+    cache.invalidate("a")
+    assert cache.size == 0
+    assert cache.get("a", 1, lambda: "bbbb", len) == "bbbb"
@@ -0,0 +1,72 @@
+from similarity_webservice.download import iter_preprocessed_images
+from similarity_webservice.imagecache import ImageCache
+
+import functools
+import http.server
+import os
+import threading
+
+import pytest
+
+
+@pytest.fixture()
+def image_server():
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler, directory=os.path.dirname(__file__)
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_iter_preprocessed_images(image_server):
+    urls = [
+        f"{image_server}/dum_similarity_img.png",
+        f"{image_server}/does_not_exist.png",
+        f"{image_server}/dum_similarity_img.png",
+    ]
+
+    results = {
+        index: (image, content_hash)
+        for index, image, content_hash, _ in iter_preprocessed_images(
+            urls, lambda img: img.size
+        )
+    }
+
+    # Every URL is reported exactly once, failed downloads as None
+    assert sorted(results) == [0, 1, 2]
+    assert results[0][0] is not None
+    assert results[1] == (None, None)
+    assert results[2] == results[0]
+    assert len(results[0][1]) == 64
+
+
+def test_iter_preprocessed_images_cached(image_server, monkeypatch, tmp_path):
+    cache = ImageCache(str(tmp_path), 2**20)
+    url = f"{image_server}/dum_similarity_img.png"
+
+    def _download(**kwargs):
+        return list(iter_preprocessed_images([url], lambda img: img.size, **kwargs))
+
+    ((_, image, content_hash, _),) = _download(cache=cache)
+    assert cache.lookup(url)["sha256"] == content_hash
+    assert cache.lookup(url)["last_modified"] is not None
+
+    # Stale entries are revalidated with a conditional request
+    monkeypatch.setenv("SIMILARITY_IMAGE_CACHE_MAX_AGE", "0")
+    assert _download(cache=cache) == [(0, image, content_hash, None)]
+
+    # Fresh entries are used without a request
+    monkeypatch.setenv("SIMILARITY_IMAGE_CACHE_MAX_AGE", "3600")
+    unreachable = "http://127.0.0.1:1/dum_similarity_img.png"
+    cache.revalidated(unreachable, cache.lookup(url))
+    results = list(
+        iter_preprocessed_images([unreachable], lambda img: img.size, cache=cache)
+    )
+    assert results == [(0, image, content_hash, None)]
+
+    # A cached value replaces the preprocessing of the image
+    results = _download(cache=cache, lookup=lambda h: "cached")
+    assert results == [(0, None, content_hash, "cached")]
@@ -0,0 +1,113 @@
+from similarity_webservice.encoder import ImageOnlyBlip2
+from lavis.models.blip2_models.blip2 import LayerNorm
+from lavis.models.blip2_models.blip2_qformer import Blip2Qformer
+from lavis.models.blip2_models.Qformer import BertConfig, BertLMHeadModel
+from lavis.models.eva_vit import VisionTransformer
+
+from functools import partial
+
+import pytest
+import torch
+
+
+# A tiny version of the BLIP-2 architecture, so that no weights are needed
+VISION = dict(img_size=28, vision_width=32, vision_depth=2, vision_heads=4)
+QUERIES = dict(num_query_token=4, embed_dim=8)
+
+
+def _bert_config():
+    return BertConfig(
+        vocab_size=100,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=64,
+    )
+
+
+def _full_model():
+    """The full LAVIS model, built without its tokenizer and pretrained weights."""
+
+    torch.manual_seed(0)
+    model = Blip2Qformer.__new__(Blip2Qformer)
+    torch.nn.Module.__init__(model)
+    model.visual_encoder = VisionTransformer(
+        img_size=28,
+        patch_size=14,
+        use_mean_pooling=False,
+        embed_dim=32,
+        depth=2,
+        num_heads=4,
+        qkv_bias=True,
+        norm_layer=partial(torch.nn.LayerNorm, eps=1e-6),
+    )
+    model.ln_vision = LayerNorm(32)
+
+    config = _bert_config()
+    config.encoder_width = 32
+    config.add_cross_attention = True
+    config.cross_attention_freq = 2
+    config.query_length = 4
+    model.Qformer = BertLMHeadModel(config)
+    model.query_tokens = torch.nn.Parameter(torch.randn(1, 4, 32))
+    model.vision_proj = torch.nn.Linear(32, 8)
+    model.text_proj = torch.nn.Linear(32, 8)
+    return model.eval()
+
+
+def _image_only_model(full, dtype=None):
+    return ImageOnlyBlip2.from_state_dict(
+        full.state_dict(),
+        dtype=dtype,
+        mlp_ratio=4.0,
+        bert_config=_bert_config(),
+        **VISION,
+        **QUERIES,
+    )
+
+
+def test_image_only_parity():
+    full = _full_model()
+    model = _image_only_model(full)
+    images = torch.randn(3, 3, 28, 28)
+
+    with torch.no_grad():
+        expected = full.extract_features({"image": images}, mode="image")
+        features = model.extract_features({"image": images}, mode="image")
+    assert torch.allclose(features.image_embeds_proj, expected.image_embeds_proj)
+
+    # The text side is not part of the image-only model
+    params = dict(model.named_parameters())
+    assert not any("word_embeddings" in name for name in params)
+    assert not any(".intermediate." in name for name in params)
+    assert sum(p.numel() for p in params.values()) < sum(
+        p.numel() for p in full.parameters()
+    )
+    with pytest.raises(ValueError):
+        model.extract_features({"image": images}, mode="text")
+
+
+def test_image_only_dtype():
+    full = _full_model()
+    model = _image_only_model(full, dtype=torch.bfloat16)
+    assert model.visual_encoder.cls_token.dtype == torch.bfloat16
+    assert model.query_tokens.dtype == torch.float32
+
+    images = torch.randn(3, 3, 28, 28)
+    with torch.no_grad():
+        expected = full.extract_features({"image": images}, mode="image")
+        features = model.extract_features({"image": images}, mode="image")
+    similarity = torch.nn.functional.cosine_similarity(
+        features.image_embeds_proj, expected.image_embeds_proj, dim=-1
+    )
+    assert torch.all(similarity > 0.95)
+
+
+def test_image_only_missing_weights():
+    state_dict = _full_model().state_dict()
+    del state_dict["vision_proj.weight"]
+
+    with pytest.raises(RuntimeError):
+        ImageOnlyBlip2.from_state_dict(
+            state_dict, mlp_ratio=4.0, bert_config=_bert_config(), **VISION, **QUERIES
+        )
@@ -0,0 +1,94 @@
+from similarity_webservice.export import (
+    ExportedEncoder,
+    export,
+    export_onnx,
+    export_torchscript,
+    image_encoder_path,
+)
+from similarity_webservice.vision import (
+    extract_features,
+    load_model_and_vis_preprocess,
+)
+import similarity_webservice.vision as vision
+
+from PIL import Image
+
+import os
+import pytest
+import torch
+
+
+def _images():
+    load_model_and_vis_preprocess()
+    image_path = os.path.join(os.path.dirname(__file__), "dum_similarity_img.png")
+    image = Image.open(image_path).convert("RGB")
+    return [vision.vis_processors["eval"](image).unsqueeze(0) for _ in range(3)]
+
+
+def _eager_model():
+    # The eager model is the one that the exports are made from
+    model, _ = vision.load_eager_model()
+    return model
+
+
+def test_torchscript_parity(app, tmp_path):
+    images = _images()
+    model = _eager_model()
+    filename = str(tmp_path / "image_encoder.pt")
+    export_torchscript(model, torch.cat(images[:2]), filename)
+
+    expected = extract_features(images, model)
+    exported = extract_features(images, ExportedEncoder(filename))
+    assert exported.shape == expected.shape
+    assert torch.allclose(exported, expected, atol=1e-4)
+
+
+def test_onnx_parity(app, tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+
+    images = _images()
+    model = _eager_model()
+    filename = str(tmp_path / "image_encoder.onnx")
+    export_onnx(model, torch.cat(images[:2]), filename)
+
+    # The batch size of the export is not fixed
+    expected = extract_features(images, model)
+    exported = extract_features(images, ExportedEncoder(filename))
+    assert exported.shape == expected.shape
+    assert torch.allclose(exported, expected, atol=1e-4)
+
+    # Quantized weights approximate the embeddings. The quantized encoder is
+    # a different model, although it was written to the same file.
+    name = ExportedEncoder(filename).name
+    export_onnx(model, torch.cat(images[:2]), filename, quantize=True)
+    assert ExportedEncoder(filename).name != name
+    quantized = extract_features(images, ExportedEncoder(filename))
+    similarity = torch.nn.functional.cosine_similarity(quantized, expected)
+    assert torch.all(similarity > 0.9)
+
+
+def test_exported_encoder_is_used(app, monkeypatch, tmp_path):
+    assert image_encoder_path() is None
+
+    images = _images()
+    filename = tmp_path / "data" / "image_encoder.pt"
+    filename.parent.mkdir(exist_ok=True)
+    export_torchscript(_eager_model(), torch.cat(images), str(filename))
+    assert image_encoder_path() == str(filename)
+
+    monkeypatch.setattr(vision, "model", None)
+    monkeypatch.setattr(vision, "vis_processors", None)
+    load_model_and_vis_preprocess()
+    assert isinstance(vision.model, ExportedEncoder)
+    assert vision.embedding_model_name().startswith("blip2_feature_extractor-")
+    assert "-torchscript-" in vision.embedding_model_name()
+
+
+def test_export_command(runner):
+    result = runner.invoke(export, ["--format", "torchscript"])
+    assert result.exit_code == 0
+    assert image_encoder_path().endswith("image_encoder.pt")
+
+    result = runner.invoke(export, ["--format", "torchscript", "--quantize"])
+    assert result.exit_code != 0
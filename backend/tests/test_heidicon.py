@@ -1,7 +1,234 @@
-from similarity_webservice.heidicon import extract_heidicon_content
+from similarity_webservice.heidicon import sync_heidicon_objects
+from similarity_webservice.jobs import run_job, stop_job_workers
+from similarity_webservice.model import (
+    db,
+    Collection,
+    ImageEntry,
+    Job,
+    add_collection,
+    claim_job,
+    count_images,
+    enqueue_job,
+    refresh_heidicon_collection,
+    schedule_heidicon_refreshes,
+    update_embedding_status,
+    update_collection_content,
+)
+from datetime import datetime, timezone
+
+import similarity_webservice.heidicon as heidicon
+import pytest
+import similarity_webservice.jobs as jobs
+import time
 
 
 def test_extract_heidicon_content():
-    images = extract_heidicon_content("DANAM Similarity Search")
+    changed, _ = sync_heidicon_objects("DANAM Similarity Search", {})
+
+    assert any(rows for _, rows in changed.values())
+
+
+def test_crawl_local_easydb(easydb_server, monkeypatch):
+    monkeypatch.setattr(heidicon, "_tag_cache", {})
+
+    changed, removed = sync_heidicon_objects("Testtag", {})
+
+    # All objects were requested with all their data
+    assert len(changed) == 2500
+    assert removed == set()
+    version, rows = changed[1234]
+    assert version == 1
+    assert rows[0][0] == "https://easydb.test/1234.jpg"
+    assert rows[0][1].endswith("/#/detail/1234")
+    assert easydb_server.full_objects == 2500
+
+    # The tag tree is cached
+    sync_heidicon_objects("42", {})
+    assert easydb_server.requests.count("/api/tags") == 1
+
+
+def test_tag_cache_refreshed_on_miss(easydb_server, monkeypatch):
+    monkeypatch.setattr(heidicon, "_tag_cache", {})
+    sync_heidicon_objects("Testtag", {})
+
+    # A tag that was created after the tag tree was cached
+    easydb_server.tags[0]["_tags"][0]["tag"]["displayname"]["en-US"] = "New tag"
+    changed, _ = sync_heidicon_objects("New tag", {})
+    assert len(changed) == 2500
+    assert easydb_server.requests.count("/api/tags") == 2
+
+
+def test_crawl_retries_failed_requests(easydb_server, monkeypatch):
+    monkeypatch.setattr(heidicon, "_tag_cache", {})
+
+    # The server is overloaded for the first requests
+    easydb_server.failures = 2
+    changed, _ = sync_heidicon_objects("Testtag", {})
+    assert len(changed) == 2500
+
+
+def _change_objects(easydb):
+    """Change some objects on the EasyDB stand-in server."""
+
+    # A new version of an object, but with the same image
+    easydb.objects[5]["ressourcen"]["_version"] = 2
+    # A new version of an object with a different image
+    easydb.objects[6] = easydb.make_object(6, version=2, image="-new")
+    # Removed and added objects
+    del easydb.objects[7]
+    easydb.objects.append(easydb.make_object(3000))
+
+
+def test_sync_heidicon_objects(easydb_server):
+    known = {i: 1 for i in range(2500)}
+    _change_objects(easydb_server)
+
+    changed, removed = sync_heidicon_objects("Testtag", known)
+
+    # Only the changed objects were requested with all their data
+    assert sorted(changed) == [5, 6, 3000]
+    assert changed[6][0] == 2
+    assert changed[6][1][0][0] == "https://easydb.test/6-new.jpg"
+    assert removed == {7}
+    assert easydb_server.full_objects == 3
+
+
+def test_sync_heidicon_objects_without_version(easydb_server):
+    # Objects without a version could never be detected as changed
+    del easydb_server.objects[3]["ressourcen"]["_version"]
+
+    with pytest.raises(ValueError):
+        sync_heidicon_objects("Testtag", {})
+
+
+def test_sync_heidicon_collection(easydb_server, app_context):
+    coll = add_collection("heidicon", heidicon_tag="Testtag")
+    assert count_images(coll.id) == 2500
+
+    # Pretend that the collection was finetuned
+    last_modified = coll.last_modified
+    ImageEntry.query.where(ImageEntry.collection == coll.id).update({"embedded": True})
+    db.session.commit()
+
+    # Nothing changed, so the collection does not need to be finetuned again
+    update_collection_content(coll.id, "")
+    assert coll.last_modified == last_modified
+
+    _change_objects(easydb_server)
+    update_collection_content(coll.id, "")
+    assert coll.last_modified > last_modified
+
+    # Only the added and the changed image need to be embedded
+    assert count_images(coll.id) == 2500
+    pending = ImageEntry.query.where(
+        ImageEntry.collection == coll.id, ImageEntry.embedded.is_(False)
+    )
+    assert sorted(entry.source_id for entry in pending) == [6, 3000]
+    entry = ImageEntry.query.where(
+        ImageEntry.collection == coll.id, ImageEntry.source_id == 5
+    ).one()
+    assert (entry.source_version, entry.embedded) == (2, True)
+
+
+def test_sync_objects_without_images(easydb_server, app_context):
+    # An object whose only asset is still being processed by EasyDB
+    easydb_server.objects[10]["ressourcen"]["asset"][0]["versions"]["small"][
+        "status"
+    ] = "pending"
+    coll = add_collection("heidicon", heidicon_tag="Testtag")
+    assert count_images(coll.id) == 2499
+
+    # An image that could not be downloaded during finetuning
+    entry = ImageEntry.query.where(
+        ImageEntry.collection == coll.id, ImageEntry.source_id == 11
+    ).one()
+    update_embedding_status([], [entry.id])
+    db.session.commit()
+
+    # Neither object is requested again or changes the collection
+    full_objects = easydb_server.full_objects
+    for _ in range(3):
+        assert not refresh_heidicon_collection(coll.id)
+    assert easydb_server.full_objects == full_objects
+    assert count_images(coll.id) == 2498
+
+    # The object is synced once its asset is ready
+    easydb_server.objects[10] = easydb_server.make_object(10, version=2)
+    assert refresh_heidicon_collection(coll.id)
+    assert count_images(coll.id) == 2499
+
+
+def test_schedule_heidicon_refreshes(easydb_server, app, app_context):
+    stop_job_workers(app)
+    coll = add_collection("heidicon", heidicon_tag="Testtag")
+
+    # The first refresh is scheduled when the collection is created
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    assert coll.heidicon_next_sync.replace(tzinfo=None) > now
+    assert schedule_heidicon_refreshes() == []
+
+    # A due collection is queued for a refresh exactly once
+    coll.heidicon_next_sync = datetime(2000, 1, 1)
+    db.session.commit()
+    jobs = schedule_heidicon_refreshes()
+    assert [(job.collection, job.kind) for job in jobs] == [(coll.id, "sync")]
+    assert schedule_heidicon_refreshes() == []
+
+    # Collections from older versions are spread over the next interval
+    coll.heidicon_next_sync = None
+    db.session.commit()
+    assert schedule_heidicon_refreshes() == []
+    assert coll.heidicon_next_sync is not None
+
+
+def test_sync_job_queues_finetuning(easydb_server, app, app_context):
+    stop_job_workers(app)
+    coll = add_collection("heidicon", heidicon_tag="Testtag")
+
+    # Without changes, the collection is not finetuned again
+    enqueue_job(coll.id, "sync")
+    run_job(claim_job())
+    assert Job.query.where(Job.kind == "finetune").count() == 0
+
+    _change_objects(easydb_server)
+    enqueue_job(coll.id, "sync")
+    run_job(claim_job())
+    assert Job.query.where(Job.kind == "finetune", Job.status == "queued").count() == 1
+
+
+def test_job_heartbeat(easydb_server, app, app_context, monkeypatch):
+    stop_job_workers(app)
+    monkeypatch.setenv("SIMILARITY_JOB_HEARTBEAT_INTERVAL", "0.05")
+    coll = add_collection("heidicon", heidicon_tag="Testtag")
+
+    # A long phase of a job that does not report any progress
+    heartbeats = []
+
+    def _refresh(id):
+        time.sleep(0.5)
+        query = db.session.query(Job.heartbeat).where(Job.id == job.id)
+        heartbeats.append(query.scalar())
+        return False
+
+    monkeypatch.setattr(jobs, "refresh_heidicon_collection", _refresh)
+    enqueue_job(coll.id, "sync")
+    job = claim_job()
+    started = job.heartbeat
+    run_job(job)
+
+    assert heartbeats[0] > started.replace(tzinfo=None)
+
+
+def test_sync_job_fails_for_unknown_tag(easydb_server, app, app_context, monkeypatch):
+    stop_job_workers(app)
+    coll = add_collection("heidicon", heidicon_tag="Testtag")
 
-    assert len(images) > 0
+    # The tag was renamed on EasyDB, the content is kept
+    monkeypatch.setattr(heidicon, "_tag_cache", {})
+    easydb_server.tags[0]["_tags"][0]["tag"]["displayname"] = {"de-DE": "Other"}
+    job = enqueue_job(coll.id, "sync")
+    run_job(claim_job())
+    db.session.refresh(job)
+    assert job.status == "failed"
+    assert "Testtag" in job.error
+    assert count_images(coll.id) == 2500
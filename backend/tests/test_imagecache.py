@@ -0,0 +1,60 @@
+from similarity_webservice.imagecache import ImageCache, image_cache
+
+import hashlib
+import os
+
+import numpy as np
+
+
+def test_image_cache_store(tmp_path):
+    cache = ImageCache(str(tmp_path), 2**20)
+    assert cache.lookup("https://example.com/a.png") is None
+
+    # Identical data under several URLs is stored once
+    content_hash = cache.store("https://example.com/a.png", b"data", etag='"1"')
+    assert content_hash == hashlib.sha256(b"data").hexdigest()
+    assert cache.store("https://example.com/b.png", b"data") == content_hash
+    assert len(os.listdir(tmp_path / "blobs" / content_hash[:2])) == 1
+
+    entry = cache.lookup("https://example.com/a.png")
+    assert entry["sha256"] == content_hash
+    assert entry["etag"] == '"1"'
+    assert entry["last_modified"] is None
+    assert cache.is_fresh(entry)
+    assert cache.read(content_hash) == b"data"
+
+
+def test_image_cache_embeddings(tmp_path):
+    cache = ImageCache(str(tmp_path), 2**20)
+    embedding = np.random.rand(32, 256).astype(np.float32)
+
+    assert cache.get_embedding("model", "abc") is None
+    cache.put_embedding("model", "abc", embedding)
+    assert np.array_equal(cache.get_embedding("model", "abc"), embedding)
+
+    # Embeddings of other models are separate
+    assert cache.get_embedding("other", "abc") is None
+
+
+def test_image_cache_evict(tmp_path):
+    cache = ImageCache(str(tmp_path), 2500)
+    hashes = [
+        cache.store(f"https://example.com/{i}.png", bytes([i]) * 1000) for i in range(3)
+    ]
+    for i, content_hash in enumerate(hashes):
+        filename = tmp_path / "blobs" / content_hash[:2] / content_hash
+        os.utime(filename, (i, i))
+
+    # The least recently used data is removed first
+    assert cache.evict() > 0
+    assert cache.read(hashes[0]) is None
+    assert cache.read(hashes[2]) is not None
+    assert cache.lookup("https://example.com/0.png") is None
+
+
+def test_image_cache_config(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    assert image_cache().directory == str(tmp_path / "similarity_webservice")
+
+    monkeypatch.setenv("SIMILARITY_IMAGE_CACHE_MB", "0")
+    assert image_cache() is None
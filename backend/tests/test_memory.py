@@ -0,0 +1,19 @@
+from similarity_webservice.memory import child_pids, memory_usage
+
+import os
+import subprocess
+import sys
+
+
+def test_memory_usage():
+    usage = memory_usage(os.getpid())
+    assert 0 < usage["uss"] <= usage["pss"] <= usage["rss"]
+
+
+def test_child_pids():
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"])
+    try:
+        assert child.pid in child_pids(os.getpid())
+    finally:
+        child.kill()
+        child.wait()
@@ -0,0 +1,66 @@
+from similarity_webservice.quantization import QuantizedFeatures, quantize
+from similarity_webservice.vision import quantized_matches, top_k_matches
+
+import numpy as np
+import pytest
+import torch
+
+
+def _unit_vectors(size, dim, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((size, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16", "int8"])
+def test_quantize_roundtrip(dtype):
+    features = _unit_vectors(100, 64)
+    values, scales = quantize(features, dtype)
+    assert values.dtype == np.dtype(dtype)
+
+    restored = values.astype(np.float32)
+    if scales is not None:
+        restored *= scales[:, None]
+    assert np.abs(restored - features).max() < 0.01
+
+
+def test_quantize_invalid_dtype():
+    with pytest.raises(ValueError):
+        quantize(_unit_vectors(10, 8), "int4")
+
+
+def test_quantize_zero_vector():
+    values, scales = quantize(np.zeros((1, 8), dtype=np.float32), "int8")
+    assert np.all(values == 0)
+    assert np.all(np.isfinite(scales))
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_quantized_scores(dtype):
+    features = _unit_vectors(1000, 64)
+    queries = torch.from_numpy(_unit_vectors(5, 64, seed=1))
+    values, scales = quantize(features, dtype)
+    quantized = QuantizedFeatures(
+        torch.from_numpy(values),
+        None if scales is None else torch.from_numpy(scales),
+        features,
+    )
+    assert quantized.nbytes < features.nbytes / 1.9
+
+    exact = torch.matmul(queries, torch.from_numpy(features).T)
+    assert torch.allclose(quantized.scores(queries, chunk_size=300), exact, atol=0.02)
+
+
+def test_quantized_matches_rerank():
+    features = _unit_vectors(1000, 64)
+    queries = torch.from_numpy(_unit_vectors(5, 64, seed=1))
+    values, scales = quantize(features, "int8")
+    quantized = QuantizedFeatures(
+        torch.from_numpy(values), torch.from_numpy(scales), features
+    )
+
+    exact = top_k_matches(torch.matmul(queries, torch.from_numpy(features).T), 10, -1.0)
+    matches = quantized_matches(quantized, queries, 10, -1.0)
+    for query_matches, exact_matches in zip(matches, exact):
+        assert [i for i, _ in query_matches] == [i for i, _ in exact_matches]
+        for (_, score), (_, exact_score) in zip(query_matches, exact_matches):
+            assert score == pytest.approx(exact_score, abs=1e-5)
@@ -0,0 +1,92 @@
+from similarity_webservice.model import (
+    db,
+    Images,
+    ImageEntry,
+    count_images,
+    delete_collection,
+    images_as_csv,
+    migrate_embedding_blobs,
+    migrate_image_entries,
+)
+from similarity_webservice.storage import (
+    auxiliary_file,
+    data_directory,
+    load_embeddings,
+    remove_embeddings,
+    write_embeddings,
+)
+
+import io
+import numpy as np
+import os
+import pandas as pd
+
+
+def test_write_and_load_embeddings(app_context):
+    features = np.random.default_rng(0).standard_normal((3, 4)).astype(np.float32)
+    path = write_embeddings(1, features, ["a", "b", "c"])
+
+    loaded, keys = load_embeddings(path)
+    assert isinstance(loaded, np.memmap)
+    assert np.array_equal(loaded, features)
+    assert keys == ["a", "b", "c"]
+
+    # A second version does not touch the first one
+    other = write_embeddings(1, features[:1], ["a"])
+    assert other != path
+    remove_embeddings(path)
+    assert not os.path.exists(os.path.join(data_directory(), f"{path}.npy"))
+    assert load_embeddings(other)[1] == ["a"]
+
+
+def test_migrate_embedding_blobs(app_context):
+    features = np.random.default_rng(0).standard_normal((2, 4)).astype(np.float32)
+    parquet_file = io.BytesIO()
+    pd.DataFrame(features, index=pd.Index(["a", "b"], name="image_url")).to_parquet(
+        parquet_file
+    )
+
+    images = Images.query.where(Images.collection == 1).one()
+    images.content = [["a", "a"], ["b", "b"]]
+    images.parquet_data = parquet_file.getvalue()
+    images.ann_index = b"index"
+    db.session.commit()
+
+    migrate_embedding_blobs()
+
+    images = Images.query.where(Images.collection == 1).one()
+    assert images.parquet_data is None
+    assert images.ann_index is None
+    assert images.embedding_count == 2
+    loaded, keys = load_embeddings(images.embedding_path)
+    assert np.array_equal(loaded, features)
+    assert keys == ["a", "b"]
+    with open(auxiliary_file(images.embedding_path, "ann.npz"), "rb") as f:
+        assert f.read() == b"index"
+
+    # Deleting the collection removes its files
+    directory = os.path.dirname(auxiliary_file(images.embedding_path, "npy"))
+    delete_collection(1)
+    assert not os.path.exists(directory)
+
+
+def test_migrate_image_entries(app_context):
+    images = Images.query.where(Images.collection == 2).one()
+    images.content = [["a", "a"], ["b", "b"], ["c"]]
+    db.session.commit()
+
+    migrate_image_entries()
+
+    images = Images.query.where(Images.collection == 2).one()
+    assert images.content == []
+    assert count_images(2) == 3
+    assert count_images(2, embedded=True) == 0
+    assert b"".join(images_as_csv(2)).decode("utf-8").splitlines() == [
+        "a,a",
+        "b,b",
+        "c",
+    ]
+
+    # Running the migration again does not duplicate the content
+    migrate_image_entries()
+    assert ImageEntry.query.where(ImageEntry.collection == 2).count() == 3
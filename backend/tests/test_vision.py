@@ -1,6 +1,32 @@
-from similarity_webservice.vision import extract_features
-from similarity_webservice.model import Images
+from similarity_webservice.vision import (
+    extract_features,
+    finetune_model,
+    serialize_embeddings,
+    top_k_matches,
+)
+from similarity_webservice.model import (
+    Images,
+    ImageEntry,
+    Job,
+    ProgressTracker,
+    finetuning_status,
+    claim_job,
+    count_images,
+    enqueue_job,
+    requeue_stale_jobs,
+    update_collection_content,
+    update_collection_dtype,
+)
+from similarity_webservice.jobs import run_job, stop_job_workers
+from similarity_webservice.loading import wait_for_model
+from similarity_webservice.storage import auxiliary_file, load_embeddings
+import similarity_webservice.vision as vision
+from datetime import datetime
+from similarity_webservice.model import db
+
+import numpy as np
 import os
+import pytest
 import torch
 from PIL import Image
 import time
@@ -8,21 +34,84 @@ import requests
 import base64
 
 
-def test_extract_features(app):
-    from similarity_webservice.vision import model, vis_processors
+# The image of the test directory, which is also used as a search query
+RAW_IMAGE_PATH = os.path.join(os.path.dirname(__file__), "dum_similarity_img.png")
+
+
+@pytest.fixture()
+def loaded_model(app):
+    """The model and its preprocessing, after loading them in the background."""
 
+    assert wait_for_model()
+    return vision.model, vision.vis_processors
+
+
+@pytest.fixture()
+def preprocessed_image(loaded_model):
+    _, vis_processors = loaded_model
     device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
+    raw_image = Image.open(RAW_IMAGE_PATH).convert("RGB")
+    return vis_processors["eval"](raw_image).unsqueeze(0).to(device)
+
+
+@pytest.fixture()
+def encoded_image():
+    with open(RAW_IMAGE_PATH, "rb") as img_file:
+        return base64.b64encode(img_file.read())
+
+
+def _content(*urls) -> str:
+    """Collection content with one row per image URL."""
+
+    return "\n".join(f"{url}, {url}" for url in urls)
+
+
+def _count_embedded(monkeypatch) -> list:
+    """Record the images that are embedded from now on."""
+
+    embedded = []
+
+    def _extract_features(images, model):
+        embedded.extend(images)
+        return extract_features(images, model)
+
+    monkeypatch.setattr(vision, "extract_features", _extract_features)
+    return embedded
+
+
+def test_extract_features(loaded_model, preprocessed_image):
+    model, _ = loaded_model
     # Test extract_features function
-    raw_image_path = os.path.join(os.path.dirname(__file__), "dum_similarity_img.png")
-    raw_image = Image.open(raw_image_path).convert("RGB")
-    preprocessed_image = [vis_processors["eval"](raw_image).unsqueeze(0).to(device)]
-    features = extract_features(preprocessed_image, model)
+    features = extract_features([preprocessed_image], model)
 
     assert isinstance(features, torch.Tensor)
     assert features.shape[0] == 1
 
 
-def test_finetune(app, client, apikey):
+def test_extract_features_batched(loaded_model, preprocessed_image):
+    model, _ = loaded_model
+
+    # Batches that do not evenly divide the input still give one row per image
+    features = extract_features([preprocessed_image] * 3, model, batch_size=2)
+    single = extract_features([preprocessed_image], model, batch_size=1)
+
+    assert features.shape == (3, single.shape[1])
+    assert torch.allclose(features, single.expand(3, -1), atol=1e-4)
+
+
+def test_top_k_matches():
+    scores = torch.tensor([[0.1, 0.9, 0.5, 0.7], [0.2, 0.1, 0.3, 0.0]])
+
+    matches = top_k_matches(scores, 3, 0.4)
+    assert [[i for i, _ in m] for m in matches] == [[1, 3, 2], []]
+    assert matches[0][0][1] == pytest.approx(0.9)
+
+    # Asking for more results than there are images
+    matches = top_k_matches(scores[:, :2], 5, 0.0)
+    assert [[i for i, _ in m] for m in matches] == [[1, 0], [0, 1]]
+
+
+def test_finetune(app, client, apikey, image_urls):
     with app.app_context():
         # Retrieve the initial value of last_finetuned
         res = client.get("/api/collection/3/info")
@@ -32,7 +121,7 @@ def test_finetune(app, client, apikey):
         res = client.post(
             "/api/collection/3/updatecontent",
             headers={"API-Key": apikey},
-            data="https://www.ssc.uni-heidelberg.de/sites/default/files/styles/img_free_aspect_1540/public/2021-06/dummyuser.png, https://www.ssc.uni-heidelberg.de/sites/default/files/styles/img_free_aspect_1540/public/2021-06/dummyuser.png",
+            data=_content(image_urls.dummy),
         )
         assert res.status_code == 200
         # Initiate the finetuning process
@@ -60,11 +149,231 @@ def test_finetune(app, client, apikey):
         assert l_ft != l_ft_b4
 
         img = Images.query.filter(Images.collection == 3).one()
-        # Check if the parquet data was calculated
-        assert img.parquet_data is not None
+        # Check if the embeddings were calculated
+        assert img.embedding_path is not None
+
+
+def test_finetune_incremental(app, image_urls, monkeypatch):
+    with app.app_context():
+        update_collection_content(2, _content(image_urls.dummy, image_urls.liam))
+        finetune_model(2)
+
+        # Count the images that are embedded in the second run
+        embedded = _count_embedded(monkeypatch)
+
+        update_collection_content(
+            2, _content(image_urls.liam, image_urls.inga, image_urls.liam)
+        )
+        finetune_model(2)
+
+        # Only the added image was embedded and the removed one was dropped
+        assert len(embedded) == 1
+        img = Images.query.filter(Images.collection == 2).one()
+        features, keys = load_embeddings(img.embedding_path)
+        assert keys == [image_urls.liam, image_urls.inga, image_urls.liam]
+        assert features.shape[0] == img.embedding_count == 3
+        assert count_images(2) == count_images(2, embedded=True) == 3
+        entry = ImageEntry.query.where(ImageEntry.image_url == image_urls.inga).one()
+        assert entry.content_hash is not None
+
+
+def test_finetune_reuses_cached_embeddings(app, image_urls, monkeypatch):
+    with app.app_context():
+        update_collection_content(1, _content(image_urls.dummy))
+        finetune_model(1)
+
+        embedded = _count_embedded(monkeypatch)
+
+        # The image is shared with another collection and not embedded again
+        update_collection_content(2, _content(image_urls.dummy))
+        finetune_model(2)
+
+        assert embedded == []
+        first = Images.query.filter(Images.collection == 1).one()
+        second = Images.query.filter(Images.collection == 2).one()
+        assert np.allclose(
+            load_embeddings(first.embedding_path)[0],
+            load_embeddings(second.embedding_path)[0],
+        )
+
+
+def test_finetune_after_model_change(app, image_urls, monkeypatch):
+    with app.app_context():
+        update_collection_content(2, _content(image_urls.dummy, image_urls.liam))
+        finetune_model(2)
+        img = Images.query.filter(Images.collection == 2).one()
+        assert img.embedding_model == vision.embedding_model_name()
+
+        embedded = _count_embedded(monkeypatch)
+
+        # Embeddings of the same model are up to date
+        finetune_model(2)
+        assert embedded == []
+
+        # A different model embeds all images again, even without changes
+        monkeypatch.setattr(vision, "embedding_model_name", lambda: "exported")
+        finetune_model(2)
+        assert len(embedded) == 2
+        img = Images.query.filter(Images.collection == 2).one()
+        assert img.embedding_model == "exported"
+        assert img.embedding_count == 2
+
+
+def test_search_after_model_change(
+    app, client, image_urls, loaded_model, encoded_image, monkeypatch
+):
+    with app.app_context():
+        update_collection_content(2, _content(image_urls.dummy, image_urls.liam))
+        finetune_model(2)
 
+    res = client.get("/api/collection/2/info")
+    assert res.json["requires_finetuning"] is False
 
-def test_similarity_search(app, client, apikey):
+    # The queries of another model cannot be compared to the embeddings
+    monkeypatch.setattr(vision, "embedding_model_name", lambda: "exported")
+    res = client.get("/api/collection/2/info")
+    assert res.json["requires_finetuning"] is True
+    res = client.post("/api/collection/2/search", data=encoded_image)
+    assert res.status_code == 400
+
+
+def test_finetune_job_resume(
+    app, image_urls, loaded_model, preprocessed_image, monkeypatch
+):
+    # Process the job queue manually
+    stop_job_workers(app)
+
+    with app.app_context():
+        update_collection_content(2, _content(image_urls.dummy, image_urls.liam))
+
+        # Simulate a job that crashed after embedding the first image
+        model, _ = loaded_model
+        features = extract_features([preprocessed_image], model)
+
+        enqueue_job(2)
+        job = claim_job()
+        job.checkpoint = serialize_embeddings({image_urls.dummy: features[0]})
+        job.worker = "no-such-host:1"
+        job.heartbeat = datetime(2000, 1, 1)
+        db.session.commit()
+
+        requeue_stale_jobs(300)
+        job = claim_job()
+        assert job is not None
+
+        # Count the images that are embedded when resuming
+        embedded = _count_embedded(monkeypatch)
+        run_job(job)
+
+        assert len(embedded) == 1
+        assert Job.query.where(Job.id == job.id).one().status == "done"
+        img = Images.query.filter(Images.collection == 2).one()
+        stored, keys = load_embeddings(img.embedding_path)
+        assert keys == [image_urls.dummy, image_urls.liam]
+        assert torch.allclose(torch.tensor(stored[0]), features[0])
+
+
+def test_finetune_ann_index(app, client, image_urls, encoded_image, monkeypatch):
+    # Use the approximate index even for this tiny collection
+    monkeypatch.setenv("SIMILARITY_ANN_MIN_SIZE", "1")
+
+    with app.app_context():
+        update_collection_content(2, _content(image_urls.dummy, image_urls.liam))
+        finetune_model(2)
+
+        img = Images.query.filter(Images.collection == 2).one()
+        assert os.path.exists(auxiliary_file(img.embedding_path, "ann.npz"))
+
+    res = client.post("/api/collection/2/search", data=encoded_image)
+    assert res.status_code == 200
+    assert len(res.json) == 2
+
+
+def test_embeddings_are_normalized(app, client, image_urls, encoded_image, monkeypatch):
+    # Pretend that the model returns embeddings that are not unit length
+    def _extract_features(images, model):
+        return 3 * extract_features(images, model)
+
+    monkeypatch.setattr(vision, "extract_features", _extract_features)
+
+    with app.app_context():
+        update_collection_content(2, _content(image_urls.dummy, image_urls.liam))
+        finetune_model(2)
+
+        img = Images.query.filter(Images.collection == 2).one()
+        assert img.normalized
+        features, _ = load_embeddings(img.embedding_path)
+        assert np.allclose(np.linalg.norm(features, axis=1), 1.0, atol=1e-5)
+
+    # The scores are cosine similarities
+    res = client.post("/api/collection/2/search", data=encoded_image)
+    assert res.status_code == 200
+    assert all(-1.0 <= r["score"] <= 1.0 + 1e-5 for r in res.json)
+
+
+@pytest.mark.parametrize("embedding_dtype", ["float16", "int8"])
+def test_quantized_similarity_search(
+    app, client, image_urls, encoded_image, embedding_dtype
+):
+    with app.app_context():
+        update_collection_content(1, _content(image_urls.dummy, image_urls.liam))
+        finetune_model(1)
+        update_collection_content(2, _content(image_urls.dummy, image_urls.liam))
+        update_collection_dtype(2, embedding_dtype)
+        finetune_model(2)
+
+        img = Images.query.filter(Images.collection == 2).one()
+        assert os.path.exists(
+            auxiliary_file(img.embedding_path, f"{embedding_dtype}.npy")
+        )
+
+    # The re-ranked results match the search on the exact embeddings
+    exact = client.post("/api/collection/1/search", data=encoded_image).json
+    quantized = client.post("/api/collection/2/search", data=encoded_image).json
+    assert [r["image_url"] for r in quantized] == [r["image_url"] for r in exact]
+    for q, e in zip(quantized, exact):
+        assert q["score"] == pytest.approx(e["score"], abs=1e-5)
+
+
+def test_batch_similarity_search(app, client, image_urls, encoded_image, monkeypatch):
+    with app.app_context():
+        update_collection_content(1, _content(image_urls.dummy))
+        finetune_model(1)
+        update_collection_content(2, _content(image_urls.liam))
+        finetune_model(2)
+
+    # Count the forward passes of the search
+    forward_passes = []
+
+    def _extract_features(images, model):
+        forward_passes.append(len(images))
+        return extract_features(images, model)
+
+    monkeypatch.setattr(vision, "extract_features", _extract_features)
+
+    res = client.post(
+        "/api/search",
+        json={
+            "images": [encoded_image.decode("utf-8")] * 3,
+            "collections": [1, 2, 3],
+        },
+    )
+    assert res.status_code == 200
+    assert forward_passes == [3]
+
+    # The collection that was not finetuned is reported
+    assert [r["collection"] for r in res.json["skipped"]] == [3]
+
+    # Each query gets results from both finetuned collections, best first
+    results = res.json["results"]
+    assert len(results) == 3
+    for query_results in results:
+        assert {r["collection"] for r in query_results} == {1, 2}
+        scores = [r["score"] for r in query_results]
+        assert scores == sorted(scores, reverse=True)
+
+
+def test_similarity_search(app, client, apikey, image_urls):
     with app.app_context():
         # Retrieve the initial value of last_finetuned
         res = client.get("/api/collection/3/info")
@@ -74,7 +383,7 @@ def test_similarity_search(app, client, apikey):
         res = client.post(
             "/api/collection/3/updatecontent",
             headers={"API-Key": apikey},
-            data="https://www.ssc.uni-heidelberg.de/sites/default/files/styles/img_free_aspect_1540/public/2021-06/dummyuser.png, https://www.ssc.uni-heidelberg.de/sites/default/files/styles/img_free_aspect_1540/public/2021-06/dummyuser.png\nhttps://www.ssc.uni-heidelberg.de/sites/default/files/styles/img_free_aspect_3380/public/2023-04/liam_3582.jpeg,https://www.ssc.uni-heidelberg.de/sites/default/files/styles/img_free_aspect_3380/public/2023-04/liam_3582.jpeg\nhttps://www.ssc.uni-heidelberg.de/sites/default/files/styles/img_free_aspect_3380/public/2023-04/inga_3567.jpeg,https://www.ssc.uni-heidelberg.de/sites/default/files/styles/img_free_aspect_3380/public/2023-04/inga_3567.jpeg",
+            data=_content(image_urls.dummy, image_urls.liam, image_urls.inga),
         )
         assert res.status_code == 200
         # Initiate the finetuning process
@@ -99,23 +408,42 @@ def test_similarity_search(app, client, apikey):
             # If the loop completes without finding the updated value, raise an assertion error
             assert False, "Finetuning process did not complete within the expected time"
 
-        # get and encode test image
-        response = requests.get(
-            "https://www.ssc.uni-heidelberg.de/sites/default/files/styles/img_free_aspect_3380/public/2023-04/dominic_3439.jpeg"
-        )
+        # Search with one of the images of the collection
+        response = requests.get(image_urls.liam)
         image_data = response.content
         encoded_image = base64.b64encode(image_data)
 
         res = client.post("/api/collection/3/search", data=encoded_image)
         # Check if the response is successful, and if the response contains the expected number of results
         assert res.status_code == 200
-        assert len(res.json) > 0
+        assert len(res.json) == 3
 
-        assert res.json[0]["score"] > 0.3
-        assert res.json[1]["score"] > 0.3
-        assert res.json[2]["score"] < 0.3
+        # The image itself is the best match, the results are sorted by score
+        assert res.json[0]["image_url"] == image_urls.liam
+        assert res.json[0]["score"] > 0.99
+        scores = [r["score"] for r in res.json]
+        assert scores == sorted(scores, reverse=True)
 
-        assert (
-            res.json[2]["image_url"]
-            == "https://www.ssc.uni-heidelberg.de/sites/default/files/styles/img_free_aspect_1540/public/2021-06/dummyuser.png"
-        )
+
+def test_progress_tracker_throttling(app, monkeypatch):
+    monkeypatch.setenv("SIMILARITY_PROGRESS_INTERVAL", "3600")
+    monkeypatch.setenv("SIMILARITY_PROGRESS_STEP", "10")
+
+    with app.app_context():
+        commits = []
+        monkeypatch.setattr(db.session, "commit", lambda: commits.append(1))
+
+        tracker = ProgressTracker(2, 1000)
+        for i in range(1000):
+            tracker.update(i + 1)
+
+        # One write at the start and one per 10 percent
+        assert len(commits) == 11
+
+        status = finetuning_status(2)
+        assert status["processed"] == 1000
+        assert status["rate"] > 0
+        assert status["eta"] == 0
+
+        tracker.close()
+        assert finetuning_status(2)["running"] is False